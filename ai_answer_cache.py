@@ -0,0 +1,141 @@
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+# キャッシュしたAI回答の有効期間（秒）
+AI_ANSWER_CACHE_TTL_SECONDS = int(os.getenv('AI_ANSWER_CACHE_TTL_SECONDS', 7 * 24 * 60 * 60))
+
+# SQLite に保持する回答数の上限（超えた分は最終利用の古い順に削除）
+AI_ANSWER_CACHE_MAX_ENTRIES = int(os.getenv('AI_ANSWER_CACHE_MAX_ENTRIES', 5000))
+
+# プロセス内（メモリ）に保持する回答数の上限
+AI_ANSWER_CACHE_MEMORY_ENTRIES = int(os.getenv('AI_ANSWER_CACHE_MEMORY_ENTRIES', 500))
+
+# SQLiteから期限切れの回答を削除する間隔（秒）
+AI_ANSWER_CACHE_PURGE_INTERVAL_SECONDS = 3600
+
+_WHITESPACE = re.compile(r'\s+')
+# 日本語（ASCII以外の文字）の前後の空白は意味を持たないため取り除く
+_SPACE_AROUND_WIDE = re.compile(r' ?([^\x00-\x7f]) ?')
+
+
+def normalize_question(question):
+    """質問文をキャッシュのキーに正規化
+
+    NFKC で全角・半角の英数字や記号をそろえ、大文字・小文字と空白の違い、
+    末尾の「？」「。」などを無視する。
+    """
+    text = unicodedata.normalize('NFKC', question).casefold()
+    text = _WHITESPACE.sub(' ', text).strip()
+    text = _SPACE_AROUND_WIDE.sub(r'\1', text)
+    return text.rstrip('?!。.、 ')
+
+
+class AIAnswerCache:
+    """AI回答の2段キャッシュ（プロセス内のLRU + SQLite）
+
+    キーは正規化した質問文とユーザーのレベル。メモリにない回答は SQLite から読み、
+    どちらにもなければ OpenAI で生成した回答を両方に保存する。
+    SQLite に残るため、再起動後や別のプロセスでもキャッシュが使われる。
+    """
+
+    def __init__(self, db, ttl_seconds=AI_ANSWER_CACHE_TTL_SECONDS,
+                 max_entries=AI_ANSWER_CACHE_MAX_ENTRIES, memory_entries=AI_ANSWER_CACHE_MEMORY_ENTRIES):
+        self.db = db
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.memory_entries = memory_entries
+        self._lock = threading.Lock()
+        # {(question_key, level): (answer, 保存時刻（monotonic））}。最近使った順に末尾へ
+        self._entries = OrderedDict()
+        self._last_purge = time.monotonic()
+        self.stats = {
+            'memory_hits': 0, 'db_hits': 0, 'misses': 0,
+            'hit_seconds': 0.0, 'generated': 0, 'generation_seconds': 0.0,
+        }
+
+    def get(self, question, level):
+        """キャッシュした回答を取得（なければNone）"""
+        start = time.perf_counter()
+        key = (normalize_question(question), level)
+        now = time.monotonic()
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached is not None and now - cached[1] < self.ttl_seconds:
+                self._entries.move_to_end(key)
+                self.stats['memory_hits'] += 1
+                self.stats['hit_seconds'] += time.perf_counter() - start
+                return cached[0]
+            self._entries.pop(key, None)
+
+        try:
+            row = self.db.get_cached_ai_answer(key[0], level, self.ttl_seconds)
+        except Exception as e:
+            print(f"⚠️ AI回答キャッシュの読み込みエラー: {e}")
+            row = None
+
+        with self._lock:
+            if row is None:
+                self.stats['misses'] += 1
+                return None
+            answer, age_seconds = row
+            self._remember(key, answer, now - age_seconds)
+            self.stats['db_hits'] += 1
+            self.stats['hit_seconds'] += time.perf_counter() - start
+            return answer
+
+    def put(self, question, level, answer, generation_seconds=None):
+        """生成した回答を保存
+
+        Args:
+            generation_seconds: 回答の生成にかかった秒数（キャッシュで短縮できた時間の推定に使う）
+        """
+        key = (normalize_question(question), level)
+        with self._lock:
+            self._remember(key, answer, time.monotonic())
+            if generation_seconds is not None:
+                self.stats['generated'] += 1
+                self.stats['generation_seconds'] += generation_seconds
+            purge_due = time.monotonic() - self._last_purge >= AI_ANSWER_CACHE_PURGE_INTERVAL_SECONDS
+            if purge_due:
+                self._last_purge = time.monotonic()
+
+        try:
+            self.db.save_cached_ai_answer(key[0], level, answer, self.max_entries)
+            if purge_due:
+                self.db.purge_cached_ai_answers(self.ttl_seconds)
+        except Exception as e:
+            print(f"⚠️ AI回答キャッシュの保存エラー: {e}")
+
+    def _remember(self, key, answer, stored_at):
+        """メモリに保存し、上限を超えた分を最近使っていない順に捨てる（ロック内で呼ぶ）"""
+        self._entries[key] = (answer, stored_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.memory_entries:
+            self._entries.popitem(last=False)
+
+    def get_stats(self):
+        """ヒット率と短縮できた時間の推定"""
+        with self._lock:
+            stats = dict(self.stats, memory_entries=len(self._entries))
+        hits = stats['memory_hits'] + stats['db_hits']
+        lookups = hits + stats['misses']
+        avg_generation = stats['generation_seconds'] / stats['generated'] if stats['generated'] else 0.0
+        avg_hit = stats['hit_seconds'] / hits if hits else 0.0
+        return {
+            'lookups': lookups,
+            'memory_hits': stats['memory_hits'],
+            'db_hits': stats['db_hits'],
+            'misses': stats['misses'],
+            'hit_rate': round(hits / lookups, 4) if lookups else 0.0,
+            'memory_entries': stats['memory_entries'],
+            'avg_hit_ms': round(avg_hit * 1000, 2),
+            'avg_generation_seconds': round(avg_generation, 3),
+            # ヒットごとに OpenAI の平均応答時間を短縮できたとみなす
+            'saved_seconds': round(max(0.0, avg_generation - avg_hit) * hits, 1),
+            'ttl_seconds': self.ttl_seconds,
+            'max_entries': self.max_entries,
+        }
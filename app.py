@@ -2,11 +2,12 @@ from flask import Flask, request, abort, redirect, render_template_string
 import os
 from dotenv import load_dotenv
 from line_bot import LineBotHandler
-from scheduler import LearningScheduler
-import threading
+from scheduler import LearningScheduler, JOB_CATCHUP_GRACE_MINUTES, JOB_HANDLERS, DELIVERY_SLOTS, DELIVERY_WINDOW_MINUTES
 import sys
 from database import LearningDatabase
 from stripe_handler import StripeHandler
+from webhook_dispatcher import DispatcherFullError
+from content_store import get_content_store
 from datetime import datetime
 
 # 環境変数を読み込み
@@ -31,26 +32,16 @@ except Exception as e:
     print(f"❌ Stripeハンドラーの初期化に失敗しました: {e}")
     stripe_handler = None
 
-# スケジューラーを初期化
-scheduler = LearningScheduler()
+# スケジューラーを初期化（LINE Botハンドラーと各マネージャーを共有）
+scheduler = LearningScheduler(line_bot=line_bot_handler)
 
-# スケジューラーをバックグラウンドで起動
-def start_scheduler_in_background():
-    try:
-        print("🚀 バックグラウンドでスケジューラーを起動中...")
-        scheduler.start()
-        print("✅ スケジューラーの起動が完了しました")
-        # スケジューラーループを開始
-        scheduler.run_scheduler()
-    except Exception as e:
-        print(f"❌ スケジューラーの開始に失敗しました: {e}")
-
-# Flaskアプリ起動時にスケジューラーを自動起動
+# Flaskアプリ起動時にスケジューラーを自動起動（ジョブの登録とループはスケジューラースレッドで行う）
 print("🔄 スケジューラースレッドを開始中...")
-scheduler_thread = threading.Thread(target=start_scheduler_in_background)
-scheduler_thread.daemon = True
-scheduler_thread.start()
-print("✅ スケジューラースレッドを開始しました")
+try:
+    scheduler.start()
+    print("✅ スケジューラースレッドを開始しました")
+except Exception as e:
+    print(f"❌ スケジューラーの開始に失敗しました: {e}")
 
 @app.route('/')
 def home():
@@ -494,7 +485,13 @@ def callback():
     signature = request.headers.get('X-Line-Signature', '')
     print(f"body: {body}", flush=True)
     print(f"signature: {signature}", flush=True)
-    if line_bot_handler.handle_webhook(body, signature):
+    try:
+        accepted = line_bot_handler.handle_webhook(body, signature)
+    except DispatcherFullError as e:
+        # 受け付けずに 503 を返し、LINEの再送に任せる
+        print(f"⚠️ Webhookを受け付けられません: {e}", flush=True)
+        abort(503)
+    if accepted:
         print("Webhook処理成功", flush=True)
         return 'OK'
     else:
@@ -536,12 +533,19 @@ def status():
     for task in next_tasks:
         status_html += f"<li>{task['function']}: {task['next_run']}</li>"
     
-    status_html += """
+    dispatcher_stats = line_bot_handler.dispatcher.get_stats()
+    dedup_stats = line_bot_handler.event_deduplicator.get_stats()
+    status_html += f"""
     </ul>
+    <h2>📨 Webhook処理</h2>
+    <p>受付: {dispatcher_stats['accepted']} / 処理済み: {dispatcher_stats['processed']} / 失敗: {dispatcher_stats['failed']} / 拒否: {dispatcher_stats['rejected']}</p>
+    <p>処理待ち: {dispatcher_stats['pending']} / 処理中: {dispatcher_stats['active']} / 最大待ち時間: {dispatcher_stats['max_wait_seconds']}秒</p>
+    <p>重複判定: {dedup_stats['checked']}件 / 重複: {dedup_stats['duplicates']}件（メモリ {dedup_stats['memory_hits']} / DB {dedup_stats['db_hits']}、ヒット率 {dedup_stats['hit_rate'] * 100:.1f}%） / 再送フラグ付き: {dedup_stats['redeliveries']}件</p>
     <h2>🔧 管理機能</h2>
     <ul>
         <li><a href="/test/lesson/test_user_1">テストレッスン送信</a></li>
         <li><a href="/test/quiz/test_user_1">テストクイズ送信</a></li>
+        <li><a href="/admin/ai_answer_cache">AI回答キャッシュ</a></li>
     </ul>
     """
     
@@ -560,8 +564,9 @@ def start_scheduler():
 def stop_scheduler():
     """スケジューラーを停止"""
     try:
-        scheduler.stop()
-        return "⏹️ スケジューラーを停止しました"
+        if scheduler.stop():
+            return "⏹️ スケジューラーを停止しました"
+        return "⏳ 実行中のジョブの終了後にスケジューラーを停止します"
     except Exception as e:
         return f"❌ スケジューラーの停止に失敗しました: {e}"
 
@@ -573,14 +578,28 @@ def scheduler_status():
         next_tasks = scheduler.get_next_scheduled_tasks()
         active_users = scheduler.get_active_users()
         
-        status_html = """
+        lease = db.get_lease(scheduler.leader_election.name)
+        leader_text = f"{lease[0]}（期限 {lease[2]} UTC）" if lease else "なし"
+        role_text = "リーダー" if scheduler.leader_election.is_leader else "待機中"
+        
+        status_html = f"""
         <h1>📊 スケジューラー詳細ステータス</h1>
+        <h2>👑 リーダー</h2>
+        <p>現在のリーダー: {leader_text}</p>
+        <p>このプロセス: {scheduler.leader_election.holder}（{role_text}）</p>
         <h2>📅 スケジュール</h2>
         <ul>
         """
         
         for task in next_tasks:
-            status_html += f"<li>{task['function']}: {task['next_run']}</li>"
+            status_html += f"<li>{task['function']}: {task['next_run']}"
+            if task['last_started_at']:
+                result_text = "成功" if task['last_succeeded'] else "失敗"
+                status_html += (
+                    f"（前回: 予定 {task['last_scheduled_at']} / 開始 {task['last_started_at']}"
+                    f" / 遅延 {task['last_delay_seconds']}秒 / 所要 {task['last_duration_seconds']}秒 / {result_text}）"
+                )
+            status_html += "</li>"
         
         status_html += f"""
         </ul>
@@ -591,13 +610,37 @@ def scheduler_status():
         
         for user_id in active_users:
             status_html += f"<li>{user_id}</li>"
-        
+
+        status_html += """
+        </ul>
+        <h2>📤 直近の配信結果</h2>
+        <ul>
+        """
+
+        for job_name, stats in scheduler.last_delivery_stats.items():
+            status_html += (
+                f"<li>{job_name}: 成功 {stats['sent']} / 失敗 {stats['failed']}, "
+                f"{stats['elapsed_seconds']}秒 ({stats['throughput_per_second']}件/秒) - {stats['finished_at']}</li>"
+            )
+
+        status_html += """
+        </ul>
+        <h2>📮 配信アウトボックス</h2>
+        <ul>
+        """
+
+        for job_id, counts in sorted(db.get_outbox_stats().items()):
+            counts_text = ", ".join(f"{state}: {count}" for state, count in sorted(counts.items()))
+            status_html += f"<li>{job_id}: {counts_text}</li>"
+
         status_html += """
         </ul>
         <h2>🔧 管理機能</h2>
         <ul>
             <li><a href="/scheduler/test/04:30">04:30のジョブを手動実行</a></li>
             <li><a href="/scheduler/restart">スケジューラーを再起動</a></li>
+            <li><a href="/admin/scheduled_jobs">スケジュールジョブの定義</a></li>
+            <li><a href="/admin/delivery_load">配信枠ごとの予定送信数</a></li>
         </ul>
         """
         
@@ -613,8 +656,12 @@ def test_scheduler_job(time):
     """指定時刻のジョブを手動実行"""
     try:
         if time == "04:30":
-            scheduler.send_evening_lesson()
-            return "✅ 04:30のジョブを手動実行しました"
+            result = scheduler.send_evening_lesson()
+            message = f"✅ 04:30のジョブを手動実行しました（送信 {result['sent']}人 / 失敗 {result['failed']}人）"
+            if result.get('already_queued'):
+                # 配信台帳・アウトボックスで同じ日の同じ配信を重複させないため、2回目以降は送信されない
+                message += f"\nℹ️ {result['already_queued']}人は本日の夜の配信が実行済みのため、重複防止により送信しませんでした"
+            return message
         else:
             return f"❌ 未対応の時刻: {time}"
     except Exception as e:
@@ -624,6 +671,7 @@ def test_scheduler_job(time):
 def restart_scheduler():
     """スケジューラーを再起動"""
     try:
+        # stop() で古いループの終了を待ち、start() で新しいループのスレッドを起動する
         scheduler.stop()
         scheduler.start()
         return "✅ スケジューラーを再起動しました"
@@ -834,10 +882,9 @@ def admin_check_user(user_id):
 def admin_list_users():
     """管理者用：全ユーザーのレベル一覧を表示"""
     try:
-        import sqlite3
         db = LearningDatabase()
 
-        with sqlite3.connect(db.db_path) as conn:
+        with db.get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('SELECT user_id, level, created_at, last_activity FROM users ORDER BY level, user_id')
             all_users = cursor.fetchall()
@@ -912,11 +959,10 @@ def admin_list_users():
 def admin_downgrade_advanced_users():
     """管理者用：上級者を中級にダウングレード"""
     try:
-        import sqlite3
         db = LearningDatabase()
 
         # 上級者を取得
-        with sqlite3.connect(db.db_path) as conn:
+        with db.get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('SELECT user_id FROM users WHERE level = ?', ('advanced',))
             advanced_users = [row[0] for row in cursor.fetchall()]
@@ -967,6 +1013,150 @@ def admin_downgrade_user(user_id):
     except Exception as e:
         return {"status": "error", "message": str(e)}, 500
 
+@app.route('/admin/rebuild_quiz_rollups')
+def admin_rebuild_quiz_rollups():
+    """管理者用：クイズ統計の集計テーブルをquiz_resultsから再構築"""
+    try:
+        db = LearningDatabase()
+        answer_count = db.rebuild_quiz_rollups()
+
+        return {
+            "status": "success",
+            "message": "クイズ統計の集計テーブルを再構築しました",
+            "answer_count": answer_count
+        }
+
+    except Exception as e:
+        return {"status": "error", "message": str(e)}, 500
+
+@app.route('/admin/scheduled_jobs')
+def admin_scheduled_jobs():
+    """管理者用：スケジュールジョブの定義と前回の成功時刻を一覧表示"""
+    try:
+        db = LearningDatabase()
+        next_runs = {task['function']: task['next_run'] for task in scheduler.get_next_scheduled_tasks()}
+
+        jobs = []
+        for definition in db.get_job_definitions():
+            definition['next_run'] = str(next_runs[definition['name']]) if definition['name'] in next_runs else None
+            jobs.append(definition)
+
+        return {
+            "status": "success",
+            "catchup_grace_minutes": JOB_CATCHUP_GRACE_MINUTES,
+            "handlers": list(JOB_HANDLERS),
+            "jobs": jobs
+        }
+
+    except Exception as e:
+        return {"status": "error", "message": str(e)}, 500
+
+@app.route('/admin/scheduled_jobs/<name>/update')
+def admin_update_scheduled_job(name):
+    """管理者用：スケジュールジョブの定義を作成・変更
+
+    クエリパラメータ: handler, day（monday〜sunday または daily）, at（HH:MM）, enabled（1/0）
+    """
+    try:
+        enabled = request.args.get('enabled')
+        definition = scheduler.update_job_definition(
+            name,
+            handler=request.args.get('handler'),
+            day_of_week=request.args.get('day'),
+            at_time=request.args.get('at'),
+            enabled=None if enabled is None else enabled.lower() in ('1', 'true', 'on')
+        )
+
+        return {
+            "status": "success",
+            "message": "ジョブ定義を更新しました（リーダーのプロセスが1分以内に反映します）",
+            "job": definition
+        }
+
+    except ValueError as e:
+        return {"status": "error", "message": str(e)}, 400
+    except Exception as e:
+        return {"status": "error", "message": str(e)}, 500
+
+@app.route('/admin/delivery_load')
+def admin_delivery_load():
+    """管理者用：配信枠ごとの1分あたりの予定送信数"""
+    try:
+        return {
+            "status": "success",
+            "window_minutes": DELIVERY_WINDOW_MINUTES,
+            "slots": scheduler.project_delivery_load()
+        }
+
+    except Exception as e:
+        return {"status": "error", "message": str(e)}, 500
+
+@app.route('/admin/delivery_preference/<user_id>')
+def admin_delivery_preference(user_id):
+    """管理者用：ユーザーの配信枠ごとの希望配信時刻を設定
+
+    クエリパラメータ: slot（morning/afternoon/evening）, at（HH:MM、省略すると削除して既定の分散に戻す）
+    """
+    try:
+        slot = request.args.get('slot')
+        preferred_time = request.args.get('at') or None
+        if slot not in DELIVERY_SLOTS:
+            return {"status": "error", "message": f"slot は {', '.join(DELIVERY_SLOTS)} のいずれかを指定してください"}, 400
+        if preferred_time is not None:
+            try:
+                preferred_time = datetime.strptime(preferred_time, '%H:%M').strftime('%H:%M')
+            except ValueError:
+                return {"status": "error", "message": f"時刻の形式が正しくありません: {preferred_time}"}, 400
+
+        db = LearningDatabase()
+        db.set_delivery_preference(user_id, slot, preferred_time)
+
+        return {
+            "status": "success",
+            "user_id": user_id,
+            "slot": slot,
+            "preferred_time": preferred_time
+        }
+
+    except Exception as e:
+        return {"status": "error", "message": str(e)}, 500
+
+@app.route('/admin/reload_content')
+def admin_reload_content():
+    """管理者用：学習データ・クイズデータを読み直して検索索引を作り直す（このプロセスのみ）"""
+    try:
+        store = get_content_store()
+        store.reload()
+        # LINE Botハンドラーと共有しているマネージャーが保持する参照を差し替える
+        scheduler.learning_manager.load_learning_data()
+        scheduler.quiz_manager.load_quiz_data()
+
+        return {
+            "status": "success",
+            "message": "コンテンツを読み直しました",
+            "lessons": sum(len(lessons) for lessons in store.learning_data.values()),
+            "indexed_documents": store.search_index.document_count
+        }
+
+    except Exception as e:
+        return {"status": "error", "message": str(e)}, 500
+
+@app.route('/admin/ai_answer_cache')
+def admin_ai_answer_cache():
+    """管理者用：AI回答キャッシュのヒット率と短縮できた時間"""
+    try:
+        if not line_bot_handler:
+            return {"status": "error", "message": "LINE Bot機能が無効です"}, 503
+
+        return {
+            "status": "success",
+            "process": line_bot_handler.answer_cache.get_stats(),
+            "stored": line_bot_handler.db.get_ai_answer_cache_summary()
+        }
+
+    except Exception as e:
+        return {"status": "error", "message": str(e)}, 500
+
 if __name__ == '__main__':
     # Flaskアプリケーションを開始
     port = int(os.getenv('PORT', 5000))
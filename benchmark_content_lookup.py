@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+レッスン・クイズ検索のベンチマーク
+240レッスン・240クイズを100倍に複製したデータで、全件走査と索引検索を比較
+"""
+
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.dirname(__file__))
+
+from content_store import ContentStore
+
+SCALE = 100
+LOOKUPS = 2000
+
+
+def build_scaled_data(tmp):
+    """IDを付け替えながらデータをSCALE倍に複製して一時ファイルに保存"""
+    with open("data/learning_data.json", 'r', encoding='utf-8') as f:
+        lessons = json.load(f)
+    with open("data/quiz_data.json", 'r', encoding='utf-8') as f:
+        quizzes = json.load(f)
+
+    scaled_lessons = []
+    for copy in range(SCALE):
+        for number, lesson in enumerate(lessons, 1):
+            lesson = {key: value for key, value in lesson.items() if key not in ('lesson', 'lesson_number', 'lesson_id')}
+            lesson['lesson'] = f"Lesson {copy * len(lessons) + number:06d}"
+            scaled_lessons.append(lesson)
+
+    scaled_quizzes = {}
+    for quiz_set, items in quizzes.items():
+        scaled_quizzes[quiz_set] = [
+            dict(quiz, id=f"{quiz['id']}_{copy}") for copy in range(SCALE) for quiz in items
+        ]
+
+    learning_path = os.path.join(tmp, "learning_data.json")
+    quiz_path = os.path.join(tmp, "quiz_data.json")
+    with open(learning_path, 'w', encoding='utf-8') as f:
+        json.dump(scaled_lessons, f, ensure_ascii=False)
+    with open(quiz_path, 'w', encoding='utf-8') as f:
+        json.dump(scaled_quizzes, f, ensure_ascii=False)
+    return learning_path, quiz_path
+
+
+def scan_lesson(learning_data, lesson_id):
+    """旧方式：全レッスンを走査"""
+    for level in learning_data.values():
+        for lesson in level:
+            if (lesson.get('id') == lesson_id or
+                lesson.get('lesson') == lesson_id or
+                lesson.get('lesson_number') == lesson_id):
+                return lesson
+    return None
+
+
+def scan_quiz(quiz_data, quiz_id):
+    """旧方式：全クイズを走査"""
+    for level_quizzes in quiz_data.values():
+        for quiz in level_quizzes:
+            if quiz['id'] == quiz_id:
+                return quiz
+    return None
+
+
+def measure(label, ids, func):
+    start = time.perf_counter()
+    for item_id in ids:
+        assert func(item_id) is not None
+    per_call = (time.perf_counter() - start) / len(ids) * 1_000_000
+    print(f"   {label:<12} {per_call:10.2f} μs/回")
+    return per_call
+
+
+def run_benchmark():
+    with tempfile.TemporaryDirectory() as tmp:
+        learning_path, quiz_path = build_scaled_data(tmp)
+        store = ContentStore(learning_path, quiz_path)
+
+    lesson_ids = [lesson['id'] for lesson in store.iter_lessons()]
+    quiz_ids = [quiz['id'] for quiz in store.iter_quizzes()]
+    rng = random.Random(0)
+    sample_lessons = [rng.choice(lesson_ids) for _ in range(LOOKUPS)]
+    sample_quizzes = [rng.choice(quiz_ids) for _ in range(LOOKUPS)]
+
+    print(f"📊 検索ベンチマーク（レッスン{len(lesson_ids)}件・クイズ{len(quiz_ids)}件、{LOOKUPS}回検索）")
+    print("🔹 get_lesson_by_id")
+    scan_us = measure("全件走査", sample_lessons, lambda i: scan_lesson(store.learning_data, i))
+    index_us = measure("索引検索", sample_lessons, store.get_lesson)
+    print(f"   ⚡ 高速化: {scan_us / index_us:.0f}倍")
+    print("🔹 get_quiz_by_id")
+    scan_us = measure("全件走査", sample_quizzes, lambda i: scan_quiz(store.quiz_data, i))
+    index_us = measure("索引検索", sample_quizzes, store.get_quiz)
+    print(f"   ⚡ 高速化: {scan_us / index_us:.0f}倍")
+
+
+if __name__ == "__main__":
+    run_benchmark()
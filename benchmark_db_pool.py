@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+DB接続プールのマイクロベンチマーク
+呼び出しごとにsqlite3.connectする旧方式と、プール済み接続を使う方式を比較
+"""
+
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.dirname(__file__))
+
+from database import LearningDatabase
+
+ITERATIONS = 2000
+USER_ID = "U_benchmark_user"
+
+
+def legacy_get_user_level(db_path, user_id):
+    with sqlite3.connect(db_path) as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT level FROM users WHERE user_id = ?', (user_id,))
+        result = cursor.fetchone()
+        return result[0] if result else None
+
+
+def legacy_record_lesson_sent(db_path, user_id, lesson_id, level):
+    with sqlite3.connect(db_path) as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO learning_history (user_id, lesson_id, level)
+            VALUES (?, ?, ?)
+        ''', (user_id, lesson_id, level))
+        conn.commit()
+
+
+def legacy_get_user_subscription(db_path, user_id):
+    with sqlite3.connect(db_path) as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT plan_type, status, expires_at, stripe_subscription_id
+            FROM premium_subscriptions
+            WHERE user_id = ? AND status = 'active' AND expires_at > CURRENT_TIMESTAMP
+            ORDER BY created_at DESC LIMIT 1
+        ''', (user_id,))
+        return cursor.fetchone()
+
+
+def measure(label, func, finish=None):
+    """ITERATIONS回実行して1回あたりの平均時間(μs)を返す
+
+    finish を渡した場合は、その実行時間（書き込みキューのコミット待ちなど）も計測に含める。
+    """
+    start = time.perf_counter()
+    for _ in range(ITERATIONS):
+        func()
+    if finish is not None:
+        finish()
+    elapsed = time.perf_counter() - start
+    per_call = elapsed / ITERATIONS * 1_000_000
+    print(f"   {label:<32} {per_call:8.1f} μs/回")
+    return per_call
+
+
+def run_benchmark():
+    """ホットなメソッドで旧方式とプール方式を比較"""
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "benchmark.db")
+        db = LearningDatabase(db_path=db_path)
+        db.add_user(USER_ID)
+
+        cases = [
+            (
+                "get_user_level",
+                lambda: legacy_get_user_level(db_path, USER_ID),
+                lambda: db.get_user_level(USER_ID),
+                None,
+            ),
+            (
+                # 旧方式と同じくコミット完了まで待つ
+                "record_lesson_sent（sync=True）",
+                lambda: legacy_record_lesson_sent(db_path, USER_ID, "Lesson 001", "beginner"),
+                lambda: db.record_lesson_sent(USER_ID, "Lesson 001", "beginner", sync=True),
+                None,
+            ),
+            (
+                # キューに積むだけの呼び出しは、最後に全件がコミットされるまでを計測に含める
+                "record_lesson_sent（書き込みキュー、flush込み）",
+                lambda: legacy_record_lesson_sent(db_path, USER_ID, "Lesson 001", "beginner"),
+                lambda: db.record_lesson_sent(USER_ID, "Lesson 001", "beginner"),
+                db.flush_writes,
+            ),
+            (
+                "get_user_subscription",
+                lambda: legacy_get_user_subscription(db_path, USER_ID),
+                lambda: db.get_user_subscription(USER_ID),
+                None,
+            ),
+        ]
+
+        print(f"📊 DB接続ベンチマーク（{ITERATIONS}回/メソッド）")
+        for name, legacy, pooled, finish in cases:
+            print(f"🔹 {name}")
+            legacy_us = measure("呼び出しごとに接続", legacy)
+            pooled_us = measure("プール済み接続", pooled, finish)
+            print(f"   ⚡ 高速化: {legacy_us / pooled_us:.1f}倍")
+
+        db.pool.close_all()
+
+
+if __name__ == "__main__":
+    run_benchmark()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+配信エンジンのベンチマーク
+応答遅延を再現した偽のプッシュエンドポイントに対して、
+旧方式（1人ずつ送信＋0.5秒待機）と DeliveryEngine のスループットを比較
+後半はローカルの偽 Messaging API サーバーに対して、
+リクエストごとに接続する requests.post と非同期クライアント（コネクションプール）、
+同じ内容のメッセージをマルチキャストにまとめた場合を比較
+"""
+
+import asyncio
+import os
+import sys
+import threading
+import time
+
+import requests
+from aiohttp import web
+
+sys.path.append(os.path.dirname(__file__))
+
+from line_push_client import PushSession, PUSH_ENDPOINT, MULTICAST_ENDPOINT
+from scheduler import DeliveryEngine
+
+USER_COUNT = 2000
+TARGET_USERS = 10000
+PUSH_LATENCY = 0.08  # LINE APIのプッシュ1回あたりの応答時間（秒）
+LEGACY_SAMPLE = 10
+
+
+class FakePushEndpoint:
+    """プッシュ送信の応答遅延を再現し、1秒あたりの最大送信数を記録する"""
+
+    def __init__(self, latency=PUSH_LATENCY):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.sent_at = []
+
+    def push_message(self, user_id, message):
+        time.sleep(self.latency)
+        with self.lock:
+            self.sent_at.append(time.monotonic())
+        return True
+
+    def peak_per_second(self):
+        """1秒間の窓で数えた最大送信数"""
+        times = sorted(self.sent_at)
+        peak = 0
+        start = 0
+        for end, sent_time in enumerate(times):
+            while sent_time - times[start] >= 1.0:
+                start += 1
+            peak = max(peak, end - start + 1)
+        return peak
+
+
+def legacy_fan_out(endpoint, user_ids):
+    """旧方式：1人ずつ送信して0.5秒待機"""
+    for user_id in user_ids:
+        endpoint.push_message(user_id, "lesson")
+        time.sleep(0.5)
+
+
+class FakeMessagingApiServer:
+    """プッシュエンドポイントだけを持つローカルHTTPサーバー（別スレッドで起動）"""
+
+    def __init__(self, latency=PUSH_LATENCY):
+        self.latency = latency
+        self.requests = 0
+        self.connections = set()
+        self.ready = threading.Event()
+        self.thread = threading.Thread(target=self._serve, daemon=True)
+
+    async def push(self, request):
+        await request.json()
+        self.requests += 1
+        self.connections.add(request.transport.get_extra_info('peername'))
+        await asyncio.sleep(self.latency)
+        return web.json_response({})
+
+    async def multicast(self, request):
+        payload = await request.json()
+        if len(payload["to"]) > 500:
+            return web.json_response({"message": "too many recipients"}, status=400)
+        return await self.push(request)
+
+    def _serve(self):
+        self.loop = asyncio.new_event_loop()
+        app = web.Application()
+        app.router.add_post(PUSH_ENDPOINT, self.push)
+        app.router.add_post(MULTICAST_ENDPOINT, self.multicast)
+        self.runner = web.AppRunner(app, access_log=None)
+        self.loop.run_until_complete(self.runner.setup())
+        site = web.TCPSite(self.runner, "127.0.0.1", 0, backlog=1024)
+        self.loop.run_until_complete(site.start())
+        self.port = site._server.sockets[0].getsockname()[1]
+        self.ready.set()
+        self.loop.run_forever()
+
+    def start(self):
+        self.thread.start()
+        self.ready.wait()
+        return f"http://127.0.0.1:{self.port}"
+
+    def reset(self):
+        self.requests = 0
+        self.connections = set()
+
+
+def run_http_benchmark(user_ids, workers=64, rate=2000):
+    """偽 Messaging API サーバーに対して送信方式を比較"""
+    server = FakeMessagingApiServer()
+    base_url = server.start()
+    # ユーザーごとに内容の異なるメッセージ（マルチキャストにまとまらない）
+    items = [(user_id, [f"lesson for {user_id}"]) for user_id in user_ids]
+
+    def post_without_session(user_id, text):
+        response = requests.post(base_url + PUSH_ENDPOINT, json={"to": user_id, "messages": [{"type": "text", "text": text}]})
+        return response.status_code == 200
+
+    rows = []
+    engine = DeliveryEngine(workers=workers, rate_per_second=rate)
+    result = engine.deliver("http:requests", items, push_func=post_without_session)
+    engine.shutdown()
+    rows.append(("requests.post（スレッド）", result, server.requests, len(server.connections)))
+
+    server.reset()
+    with PushSession("benchmark_token", base_url=base_url, max_connections=workers) as push_session:
+        result = engine.deliver("http:async", items, push_session=push_session)
+    rows.append(("非同期クライアント", result, server.requests, len(server.connections)))
+
+    server.reset()
+    with PushSession("benchmark_token", base_url=base_url, max_connections=workers) as push_session:
+        result = engine.deliver("http:multicast", [(user_id, ["announcement"]) for user_id in user_ids], push_session=push_session)
+    rows.append(("同一内容（マルチキャスト）", result, server.requests, len(server.connections)))
+
+    print()
+    print(f"📊 HTTP配信ベンチマーク（{len(user_ids)}人、同時 {workers}、サーバー応答 {PUSH_LATENCY * 1000:.0f} ms）")
+    print(f"   {'方式':<24} {'人/秒':>8} {'リクエスト数':>12} {'TCP接続数':>10}")
+    for label, result, request_count, connections in rows:
+        print(f"   {label:<24} {result['throughput_per_second']:8.1f} {request_count:12d} {connections:10d}")
+
+
+def run_benchmark():
+    user_ids = [f"U{i:06d}" for i in range(USER_COUNT)]
+
+    endpoint = FakePushEndpoint()
+    start = time.perf_counter()
+    legacy_fan_out(endpoint, user_ids[:LEGACY_SAMPLE])
+    legacy_per_user = (time.perf_counter() - start) / LEGACY_SAMPLE
+
+    results = []
+    for workers, rate in ((8, 2000), (32, 2000), (128, 2000), (128, 500)):
+        endpoint = FakePushEndpoint()
+        engine = DeliveryEngine(workers=workers, rate_per_second=rate)
+        result = engine.deliver("benchmark", [(user_id, ["lesson"]) for user_id in user_ids], push_func=endpoint.push_message)
+        engine.shutdown()
+        results.append((workers, rate, result, endpoint.peak_per_second()))
+
+    print()
+    print(f"📊 配信ベンチマーク（{USER_COUNT}人、プッシュ応答 {PUSH_LATENCY * 1000:.0f} ms）")
+    print(f"   {'方式':<24} {'件/秒':>8} {'最大件/秒':>10} {f'{TARGET_USERS}人の所要時間':>16}")
+    print(f"   {'旧方式（逐次＋0.5秒）':<24} {1 / legacy_per_user:8.1f} {'-':>10} {legacy_per_user * TARGET_USERS / 60:13.1f} 分")
+    for workers, rate, result, peak in results:
+        label = f"エンジン w={workers} 上限={rate}/秒"
+        throughput = result['throughput_per_second']
+        print(f"   {label:<24} {throughput:8.1f} {peak:10d} {TARGET_USERS / throughput / 60:13.1f} 分")
+
+    run_http_benchmark(user_ids)
+
+
+if __name__ == "__main__":
+    run_benchmark()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+レッスン選択・整形のシャード並列化ベンチマーク
+多数のユーザーについて、1プロセス（単一スレッド）と、ユーザーIDのハッシュで
+シャードに分けた multiprocessing のプールでの処理時間を比較
+シャード数は1からCPUコア数まで（引数で上限を指定可能）
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.dirname(__file__))
+
+USER_COUNT = 200000
+LEVELS = ("beginner", "intermediate", "advanced")
+
+
+def create_users(db, count):
+    """ベンチマーク用のユーザーを一括登録"""
+    with db.get_connection() as conn:
+        conn.executemany(
+            'INSERT OR REPLACE INTO users (user_id, level) VALUES (?, ?)',
+            [(f"U{i:08d}", LEVELS[i % len(LEVELS)]) for i in range(count)]
+        )
+    return [f"U{i:08d}" for i in range(count)]
+
+
+def measure(manager, user_ids, processes):
+    """全ユーザー分のレッスンを選択・整形するまでの時間（カーソルは送信時に保存するため含まない）"""
+    start = time.perf_counter()
+    first_batch_at = None
+    rendered = 0
+    for batch in manager.iter_rendered_lessons(user_ids, processes=processes):
+        if first_batch_at is None:
+            first_batch_at = time.perf_counter() - start
+        rendered += len(batch)
+    return time.perf_counter() - start, first_batch_at, rendered
+
+
+def run_benchmark(max_shards):
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["DATABASE_PATH"] = os.path.join(tmp, "benchmark.db")
+        from learning_content import LearningContentManager
+
+        manager = LearningContentManager()
+        user_ids = create_users(manager.db, USER_COUNT)
+
+        rows = []
+        for shards in range(1, max_shards + 1):
+            elapsed, first_batch_at, rendered = measure(manager, user_ids, shards)
+            rows.append((shards, elapsed, first_batch_at, rendered))
+
+        print()
+        print(f"📊 レッスン選択・整形ベンチマーク（{USER_COUNT}人、CPUコア数 {os.cpu_count()}）")
+        print(f"   {'シャード数':<10} {'処理時間':>10} {'最初の送信可能':>14} {'人/秒':>10} {'高速化':>8}")
+        baseline = rows[0][1]
+        for shards, elapsed, first_batch_at, rendered in rows:
+            print(
+                f"   {shards:<10} {elapsed:9.2f}秒 {first_batch_at:13.2f}秒 "
+                f"{rendered / elapsed:10.0f} {baseline / elapsed:7.2f}倍"
+            )
+
+        manager.db.pool.close_all()
+
+
+if __name__ == "__main__":
+    run_benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else os.cpu_count() or 1)
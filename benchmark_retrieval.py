@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+AI質問のレッスン検索（TF-IDF）のオフライン評価
+レッスンとは別に書いた質問集（data/retrieval_eval.tsv、正解のレッスン付き）について、
+OpenAI を呼ばずにレッスンで答える割合・その正解率・レッスンにない質問を誤ってレッスンで答える割合・
+検索の遅延分布を計測する
+しきい値ごとの結果も表示する（RETRIEVAL_ANSWER_THRESHOLD の調整用）
+
+引数に別の質問集（同じ形式のTSV）を渡すと、その質問集で評価する
+"""
+
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.append(os.path.dirname(__file__))
+
+from content_store import get_content_store
+from lesson_retrieval import RETRIEVAL_ANSWER_THRESHOLD, RETRIEVAL_CONTEXT_LESSONS
+
+DEFAULT_EVAL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'retrieval_eval.tsv')
+
+THRESHOLDS = (0.2, 0.25, 0.3, 0.35, 0.4, 0.45, 0.5, 0.55, 0.6)
+
+
+def lesson_key(lesson):
+    return lesson.get('id') or lesson.get('lesson_id')
+
+
+def load_eval_set(path):
+    """質問集を読み込む
+
+    Returns:
+        [(質問, 正解のレッスンIDの集合)] のリスト（レッスンにない質問は空集合）
+    """
+    questions = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if not line.strip() or line.startswith('#'):
+                continue
+            expected, question = line.split('\t', 1)
+            answers = set() if expected == '-' else {answer.strip() for answer in expected.split(',')}
+            questions.append((question.strip(), answers))
+    return questions
+
+
+def retrieve_all(store, questions):
+    """全質問を検索し、(上位の結果, 遅延ミリ秒) を返す"""
+    results, latencies = [], []
+    for question in questions:
+        start = time.perf_counter()
+        matches = store.retrieve_lessons(question)
+        latencies.append((time.perf_counter() - start) * 1000)
+        results.append(matches)
+    return results, np.array(latencies)
+
+
+def top_score(matches):
+    return matches[0][1] if matches else 0.0
+
+
+def print_latency(label, latencies):
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+    print(f"   {label}: 平均 {latencies.mean():.3f}ms / p50 {p50:.3f}ms / p90 {p90:.3f}ms / p99 {p99:.3f}ms / 最大 {latencies.max():.3f}ms")
+
+
+def evaluate(store, path):
+    eval_set = load_eval_set(path)
+    results, latencies = retrieve_all(store, [question for question, _ in eval_set])
+    covered = [(answers, matches) for (_, answers), matches in zip(eval_set, results) if answers]
+    novel = [matches for (_, answers), matches in zip(eval_set, results) if not answers]
+
+    in_context = sum(
+        bool(answers & {lesson_key(lesson) for lesson, _ in matches})
+        for answers, matches in covered
+    )
+
+    print()
+    print(f"📊 {path}（レッスンにある質問 {len(covered)}問、レッスンにない質問 {len(novel)}問）")
+    if covered:
+        print(f"   上位{RETRIEVAL_CONTEXT_LESSONS}件に正解のレッスンを含む割合: {in_context / len(covered) * 100:.1f}%")
+    print()
+    print(f"   {'しきい値':<8} {'レッスン回答率':>12} {'うち正解':>8} {'誤ってレッスン回答':>16}")
+    for threshold in THRESHOLDS:
+        answered = [
+            (answers, matches) for answers, matches in covered
+            if top_score(matches) >= threshold
+        ]
+        correct = sum(lesson_key(matches[0][0]) in answers for answers, matches in answered)
+        false_local = sum(top_score(matches) >= threshold for matches in novel)
+        marker = " ← 現在の設定" if abs(threshold - RETRIEVAL_ANSWER_THRESHOLD) < 1e-9 else ""
+        print(
+            f"   {threshold:<8.2f} {(len(answered) / len(covered) * 100 if covered else 0):11.1f}% "
+            f"{(correct / len(answered) * 100 if answered else 0):7.1f}% "
+            f"{(false_local / len(novel) * 100 if novel else 0):15.1f}%{marker}"
+        )
+
+    print()
+    print("🔎 しきい値付近の質問（上位のレッスンと類似度）")
+    for (question, answers), matches in zip(eval_set, results):
+        score = top_score(matches)
+        if abs(score - RETRIEVAL_ANSWER_THRESHOLD) > 0.1:
+            continue
+        top = lesson_key(matches[0][0]) if matches else '-'
+        mark = '✅' if top in answers else ('❌' if answers or score >= RETRIEVAL_ANSWER_THRESHOLD else '・')
+        print(f"   {mark} {score:.2f} {top:<11} {question}")
+
+    print()
+    print("⏱️ 検索の遅延（1問あたり）")
+    print_latency("全質問", latencies)
+
+
+def run_benchmark(path=DEFAULT_EVAL_PATH):
+    store = get_content_store()
+    start = time.perf_counter()
+    retriever = store.retriever
+    print(f"🔧 TF-IDF行列の作成: {(time.perf_counter() - start) * 1000:.1f}ms（{retriever.matrix.shape[0]}レッスン × {retriever.matrix.shape[1]}語）")
+
+    evaluate(store, path)
+
+
+if __name__ == "__main__":
+    run_benchmark(sys.argv[1] if len(sys.argv) > 1 else DEFAULT_EVAL_PATH)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+起動時のコンテンツ読み込みベンチマーク
+旧方式（マネージャーごとにJSONを読み込み・正規化）と共有コンテンツストアを比較
+起動時と同じく LearningContentManager・QuizManager をそれぞれ3つ作成する
+"""
+
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.dirname(__file__))
+
+MANAGER_COUNT = 3
+
+
+def legacy_load():
+    """旧方式：インスタンスごとにJSONを読み込んで正規化"""
+    from content_store import normalize_lesson
+    managers = []
+    for _ in range(MANAGER_COUNT):
+        with open("data/learning_data.json", 'r', encoding='utf-8') as f:
+            raw_data = json.load(f)
+        learning_data = {"beginner": [], "intermediate": [], "advanced": []}
+        for lesson in raw_data:
+            lesson = normalize_lesson(lesson)
+            learning_data[lesson['level']].append(lesson)
+        with open("data/quiz_data.json", 'r', encoding='utf-8') as f:
+            quiz_data = json.load(f)
+        managers.append((learning_data, quiz_data))
+    return managers
+
+
+def shared_load():
+    """新方式：共有コンテンツストアを使うマネージャーを作成"""
+    from learning_content import LearningContentManager
+    from quiz_manager import QuizManager
+    managers = []
+    for _ in range(MANAGER_COUNT):
+        managers.append((LearningContentManager(), QuizManager()))
+    return managers
+
+
+def run_mode(mode):
+    """子プロセスで1つの方式を計測してJSONで結果を出力"""
+    # モジュールのimportとDBスキーマ作成は計測対象外にする
+    import learning_content
+    import quiz_manager
+    from database import LearningDatabase
+    LearningDatabase()
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    managers = legacy_load() if mode == "legacy" else shared_load()
+    elapsed = time.perf_counter() - start
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({
+        "elapsed_ms": elapsed * 1000,
+        "rss_kb": peak_rss,
+        "rss_delta_kb": peak_rss - baseline_rss,
+        "managers": len(managers),
+    }))
+
+
+def run_benchmark():
+    """旧方式と共有ストア方式をそれぞれ別プロセスで計測"""
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ, DATABASE_PATH=os.path.join(tmp, "benchmark.db"))
+        for mode in ("legacy", "shared"):
+            output = subprocess.run(
+                [sys.executable, __file__, mode],
+                capture_output=True, text=True, env=env, check=True
+            ).stdout
+            results[mode] = json.loads(output.strip().splitlines()[-1])
+
+    print(f"📊 起動時コンテンツ読み込み（マネージャー各{MANAGER_COUNT}つ）")
+    for mode, label in (("legacy", "インスタンスごとに読み込み"), ("shared", "共有コンテンツストア")):
+        r = results[mode]
+        print(f"   {label:<24} {r['elapsed_ms']:8.1f} ms  RSS {r['rss_kb'] / 1024:6.1f} MB (+{r['rss_delta_kb'] / 1024:.1f} MB)")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        run_mode(sys.argv[1])
+    else:
+        run_benchmark()
@@ -0,0 +1,230 @@
+import json
+import re
+import threading
+from types import MappingProxyType
+
+from lesson_retrieval import LessonRetriever, RETRIEVAL_CONTEXT_LESSONS
+from lesson_search import LessonSearchIndex, SEARCH_RESULT_LIMIT
+
+LEVELS = ("beginner", "intermediate", "advanced")
+QUIZ_SETS = ("beginner_quiz", "intermediate_quiz", "advanced_quiz")
+
+DEFAULT_LEARNING_DATA_PATH = "data/learning_data.json"
+DEFAULT_QUIZ_DATA_PATH = "data/quiz_data.json"
+
+
+def extract_lesson_number(lesson_str):
+    """レッスン文字列から番号を抽出"""
+    if not lesson_str:
+        return 0
+    # "Lesson 001", "Lesson 123"などから数字を抽出
+    match = re.search(r'(\d+)', lesson_str)
+    if match:
+        return int(match.group(1))
+    return 0
+
+
+def _freeze(value):
+    """JSONから読み込んだ値を読み取り専用の型に変換"""
+    if isinstance(value, dict):
+        return MappingProxyType({key: _freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+def normalize_lesson(lesson):
+    """レッスンにid・content・levelフィールドを補完した新しい辞書を返す"""
+    lesson = dict(lesson)
+
+    # lesson_idを追加（lessonフィールドから生成）
+    if 'lesson' in lesson:
+        lesson['id'] = lesson['lesson']
+    elif 'lesson_number' in lesson:
+        lesson['id'] = lesson['lesson_number']
+        lesson['lesson'] = lesson['lesson_number']
+
+    # contentフィールドを追加（point、description、summaryフィールドを使用）
+    if 'point' in lesson:
+        lesson['content'] = lesson['point']
+    elif 'description' in lesson:
+        lesson['content'] = lesson['description']
+    elif 'summary' in lesson:
+        lesson['content'] = lesson['summary']
+
+    # レッスン番号からレベルを判定
+    lesson_num = extract_lesson_number(lesson.get('lesson', ''))
+    if lesson_num <= 80:
+        lesson['level'] = 'beginner'
+    elif lesson_num <= 160:
+        lesson['level'] = 'intermediate'
+    else:
+        lesson['level'] = 'advanced'
+    return lesson
+
+
+class ContentStore:
+    """学習データとクイズデータを保持する読み取り専用ストア
+
+    JSONの読み込みと正規化はプロセス内で一度だけ行い、
+    LearningContentManager・QuizManagerの全インスタンスで共有する。
+    レッスンとクイズは MappingProxyType / tuple で凍結してあるため変更できない。
+    全文検索の索引と質問に近いレッスンを探すベクトルは初めて使うときに作り、
+    reload() のたびに作り直す。
+    """
+
+    _stores = {}
+    _stores_lock = threading.Lock()
+
+    def __init__(self, learning_data_path=DEFAULT_LEARNING_DATA_PATH, quiz_data_path=DEFAULT_QUIZ_DATA_PATH):
+        self.learning_data_path = learning_data_path
+        self.quiz_data_path = quiz_data_path
+        self.learning_data = self._load_learning_data()
+        self.quiz_data = self._load_quiz_data()
+        self.lesson_index = self._build_lesson_index()
+        self.quiz_index = self._build_quiz_index()
+        self._search_index = None
+        self._retriever = None
+        self._search_index_lock = threading.Lock()
+
+    @classmethod
+    def get(cls, learning_data_path=DEFAULT_LEARNING_DATA_PATH, quiz_data_path=DEFAULT_QUIZ_DATA_PATH):
+        """プロセス内で共有されるストアを取得（初回のみ読み込み）"""
+        key = (learning_data_path, quiz_data_path)
+        with cls._stores_lock:
+            store = cls._stores.get(key)
+            if store is None:
+                store = cls(learning_data_path, quiz_data_path)
+                cls._stores[key] = store
+            return store
+
+    def reload(self):
+        """JSONを読み直してデータと索引を差し替える（このプロセスのストアのみ）"""
+        learning_data = self._load_learning_data()
+        quiz_data = self._load_quiz_data()
+        with self._search_index_lock:
+            self.learning_data = learning_data
+            self.quiz_data = quiz_data
+            self.lesson_index = self._build_lesson_index()
+            self.quiz_index = self._build_quiz_index()
+            old_index, self._search_index = self._search_index, LessonSearchIndex(self)
+            self._retriever = LessonRetriever(self)
+        if old_index is not None:
+            old_index.close()
+        print(f"🔎 検索索引を作り直しました: {self._search_index.document_count}件（語彙 {len(self._retriever.vocabulary)}語）")
+
+    @property
+    def search_index(self):
+        """レッスンとクイズ解説の全文検索索引"""
+        with self._search_index_lock:
+            if self._search_index is None:
+                self._search_index = LessonSearchIndex(self)
+            return self._search_index
+
+    @property
+    def retriever(self):
+        """質問に近いレッスンを探す TF-IDF ベクトル"""
+        with self._search_index_lock:
+            if self._retriever is None:
+                self._retriever = LessonRetriever(self)
+            return self._retriever
+
+    def retrieve_lessons(self, question, k=RETRIEVAL_CONTEXT_LESSONS):
+        """質問に近いレッスンを探す（LessonRetriever.retrieve を参照）"""
+        return self.retriever.retrieve(question, k=k)
+
+    def search(self, query, limit=SEARCH_RESULT_LIMIT, kind=None):
+        """レッスンとクイズ解説を全文検索（LessonSearchIndex.search を参照）"""
+        return self.search_index.search(query, limit=limit, kind=kind)
+
+    def _load_learning_data(self):
+        """学習データを読み込んでレベル別に分類"""
+        learning_data = {level: [] for level in LEVELS}
+        try:
+            with open(self.learning_data_path, 'r', encoding='utf-8') as f:
+                raw_data = json.load(f)
+
+            for raw_lesson in raw_data:
+                lesson = normalize_lesson(raw_lesson)
+                learning_data[lesson['level']].append(_freeze(lesson))
+
+            # レベル別データ数をログ出力
+            print(f"Learning data loaded successfully:")
+            print(f"   Beginner: {len(learning_data['beginner'])} lessons")
+            print(f"   Intermediate: {len(learning_data['intermediate'])} lessons")
+            print(f"   Advanced: {len(learning_data['advanced'])} lessons")
+
+        except FileNotFoundError:
+            print(f"学習データファイルが見つかりません: {self.learning_data_path}")
+            learning_data = {level: [] for level in LEVELS}
+        except Exception as e:
+            print(f"学習データ読み込みエラー: {e}")
+            learning_data = {level: [] for level in LEVELS}
+
+        return MappingProxyType({level: tuple(lessons) for level, lessons in learning_data.items()})
+
+    def _load_quiz_data(self):
+        """クイズデータを読み込み"""
+        try:
+            with open(self.quiz_data_path, 'r', encoding='utf-8') as f:
+                quiz_data = json.load(f)
+        except FileNotFoundError:
+            print(f"クイズデータファイルが見つかりません: {self.quiz_data_path}")
+            quiz_data = {quiz_set: [] for quiz_set in QUIZ_SETS}
+        return _freeze(quiz_data)
+
+    def _build_lesson_index(self):
+        """id・lesson・lesson_numberの値からレッスンを引くハッシュ索引を作成
+
+        全件走査で最初に一致したレッスンを返していた挙動に合わせ、
+        同じ値が複数ある場合は先に現れたレッスンを優先する。
+        """
+        index = {}
+        for lesson in self.iter_lessons():
+            for field in ('id', 'lesson', 'lesson_number'):
+                value = lesson.get(field)
+                if value is not None:
+                    index.setdefault(value, lesson)
+        return MappingProxyType(index)
+
+    def _build_quiz_index(self):
+        """クイズIDからクイズを引くハッシュ索引を作成"""
+        index = {}
+        for quiz in self.iter_quizzes():
+            index.setdefault(quiz['id'], quiz)
+        return MappingProxyType(index)
+
+    def get_lesson(self, lesson_id):
+        """id・lesson・lesson_numberのいずれかでレッスンを取得（O(1)）"""
+        if lesson_id is None:
+            return None
+        return self.lesson_index.get(lesson_id)
+
+    def get_quiz(self, quiz_id):
+        """IDでクイズを取得（O(1)）"""
+        if quiz_id is None:
+            return None
+        return self.quiz_index.get(quiz_id)
+
+    def get_lessons(self, level):
+        """指定レベルのレッスン一覧（tuple）を取得"""
+        return self.learning_data.get(level, ())
+
+    def get_quizzes(self, quiz_set):
+        """指定クイズセットのクイズ一覧（tuple）を取得"""
+        return self.quiz_data.get(quiz_set, ())
+
+    def iter_lessons(self):
+        """全レベルのレッスンを順に返す"""
+        for lessons in self.learning_data.values():
+            yield from lessons
+
+    def iter_quizzes(self):
+        """全クイズセットのクイズを順に返す"""
+        for quizzes in self.quiz_data.values():
+            yield from quizzes
+
+
+def get_content_store(learning_data_path=DEFAULT_LEARNING_DATA_PATH, quiz_data_path=DEFAULT_QUIZ_DATA_PATH):
+    """プロセス内で共有されるコンテンツストアを取得"""
+    return ContentStore.get(learning_data_path, quiz_data_path)
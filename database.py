@@ -1,8 +1,594 @@
 import sqlite3
 import json
-from datetime import datetime, timedelta
+import threading
+import queue
+import atexit
+import signal
+import time
+import uuid
+import weakref
+from datetime import datetime, timedelta, timezone
 import os
 
+
+class ConnectionPool:
+    """スレッドごとに長寿命のSQLite接続を保持するプール
+
+    Flaskのワーカースレッドとスケジューラースレッドがそれぞれ自分専用の接続を使い回す。
+    PRAGMAは接続作成時に一度だけ適用する。
+    スレッドが終了すると、そのスレッドの接続は閉じてプールから外す
+    （リクエストごとにスレッドを作るFlaskの開発サーバーでも接続が増え続けない）。
+    """
+
+    # 接続ごとに一度だけ適用するPRAGMA
+    PRAGMAS = (
+        "PRAGMA journal_mode=WAL",
+        "PRAGMA synchronous=NORMAL",
+        "PRAGMA cache_size=-16000",      # 約16MBのページキャッシュ
+        "PRAGMA mmap_size=67108864",     # 64MBのメモリマップ
+        "PRAGMA temp_store=MEMORY",
+        "PRAGMA busy_timeout=5000",
+    )
+
+    _pools = {}
+    _pools_lock = threading.Lock()
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = set()
+        self._pid = os.getpid()
+        # スキーマ初期化はプロセス内でDBパスごとに一度だけ行う
+        self.init_lock = threading.Lock()
+        self.schema_ready = False
+        # 高頻度INSERT用の書き込みキュー（DBパスごとに1つ）
+        self.writer = WriteBehindQueue(self)
+
+    @classmethod
+    def for_path(cls, db_path):
+        """DBパスごとにプロセス内で共有されるプールを取得"""
+        with cls._pools_lock:
+            pool = cls._pools.get(db_path)
+            if pool is None:
+                pool = cls(db_path)
+                cls._pools[db_path] = pool
+            return pool
+
+    def _reset_after_fork(self):
+        """fork後は親プロセスの接続を使わずに作り直す"""
+        self._local = threading.local()
+        self._connections = set()
+        self._pid = os.getpid()
+
+    def get_connection(self):
+        """現在のスレッド専用の接続を取得（なければ作成）"""
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._reset_after_fork()
+        holder = getattr(self._local, "holder", None)
+        if holder is None:
+            # 終了したスレッドの接続は終了処理で（別スレッドから）閉じるため check_same_thread を外す
+            conn = sqlite3.connect(self.db_path, timeout=5.0, check_same_thread=False)
+            for pragma in self.PRAGMAS:
+                conn.execute(pragma)
+            holder = _ThreadConnection(conn)
+            # スレッドが終了してスレッドローカルの値が破棄されたら接続を閉じる
+            finalizer = weakref.finalize(holder, self._discard, conn, os.getpid())
+            finalizer.atexit = False
+            self._local.holder = holder
+            with self._lock:
+                self._connections.add(conn)
+        return holder.conn
+
+    def _discard(self, conn, pid):
+        """終了したスレッドの接続を閉じてプールから外す"""
+        if pid != os.getpid():
+            # fork前の親プロセスの接続は子プロセスで閉じない
+            return
+        with self._lock:
+            self._connections.discard(conn)
+        conn.close()
+
+    def close_all(self):
+        """プールが保持している全接続を閉じる"""
+        with self._lock:
+            connections = self._connections
+            self._connections = set()
+        self._local = threading.local()
+        for conn in connections:
+            conn.close()
+
+
+class _ThreadConnection:
+    """スレッドローカルに保持する接続の入れ物（スレッド終了時の破棄を検知するため）"""
+
+    __slots__ = ('conn', '__weakref__')
+
+    def __init__(self, conn):
+        self.conn = conn
+
+
+def utc_timestamp():
+    """CURRENT_TIMESTAMPと同じ形式（UTC）の現在時刻文字列"""
+    return datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+
+class _WriteWaiter:
+    """同期書き込みの呼び出し元がコミット完了を待つためのハンドル"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.error = None
+
+    def done(self, error=None):
+        self.error = error
+        self.event.set()
+
+    def wait(self):
+        self.event.wait()
+        if self.error is not None:
+            raise self.error
+
+
+class WriteBehindQueue:
+    """INSERTをバッファしてexecutemanyでまとめてコミットする書き込みキュー
+
+    バックグラウンドのライタースレッドが、batch_size件たまるか
+    flush_interval秒経過するごとに1トランザクションで書き込む。
+    同期書き込み（wait=True）がキューに入った場合は待たずにすぐ書き込む。
+    プロセス終了時（atexit）と SIGTERM 受信時（Render・gunicorn の停止）には残りを必ず書き込む。
+    """
+
+    _STOP = object()
+    # プロセス内の全キュー（SIGTERM受信時にまとめて書き込む）
+    _instances = []
+    # SIGTERMハンドラーを登録したプロセスのPID（fork後の子プロセスでは登録し直す）
+    _sigterm_pid = None
+
+    def __init__(self, pool, batch_size=500, flush_interval=0.02):
+        self.pool = pool
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._thread = None
+        self._pid = None
+        self._atexit_registered = False
+        WriteBehindQueue._instances.append(self)
+        self._install_sigterm_handler()
+
+    @classmethod
+    def _install_sigterm_handler(cls):
+        """SIGTERMで終了する前に全キューの残りを書き込む（atexitはSIGTERMでは実行されない）
+
+        シグナルハンドラーはメインスレッドでしか登録できないため、
+        それ以外のスレッドから呼ばれた場合は次の機会（メインスレッドでの書き込み）に登録する。
+        既存のハンドラー（gunicornなど）があれば書き込み後にそれを呼ぶ。
+        """
+        if cls._sigterm_pid == os.getpid() or threading.current_thread() is not threading.main_thread():
+            return
+        previous = signal.getsignal(signal.SIGTERM)
+
+        def handle_sigterm(signum, frame):
+            print("🛑 SIGTERMを受信: 書き込みキューの残りを書き込みます")
+            for writer in list(cls._instances):
+                writer.close()
+            if callable(previous):
+                previous(signum, frame)
+            elif previous != signal.SIG_IGN:
+                # 既定の動作（終了）に戻して同じシグナルで終了する
+                signal.signal(signum, signal.SIG_DFL)
+                os.kill(os.getpid(), signum)
+
+        signal.signal(signal.SIGTERM, handle_sigterm)
+        cls._sigterm_pid = os.getpid()
+
+    def _ensure_started(self):
+        """ライタースレッドを起動（fork後は作り直す）"""
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._queue = queue.Queue()
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="db-write-behind", daemon=True)
+            self._thread.start()
+            self._install_sigterm_handler()
+            if not self._atexit_registered:
+                atexit.register(self.close)
+                self._atexit_registered = True
+
+    def submit(self, sql, params, wait=False):
+        """書き込みをキューに積む（wait=Trueならコミット完了まで待つ）"""
+        self.submit_statements([(sql, params)], wait=wait)
+
+    def submit_statements(self, statements, wait=False):
+        """同じトランザクションでコミットされるべき複数の (sql, params) をまとめて積む"""
+        self._ensure_started()
+        waiter = _WriteWaiter() if wait else None
+        self._queue.put((statements, waiter))
+        if waiter:
+            waiter.wait()
+
+    def flush(self):
+        """キューに積まれた書き込みがすべてコミットされるまで待つ"""
+        if self._thread is None or self._pid != os.getpid():
+            return
+        waiter = _WriteWaiter()
+        self._queue.put(([], waiter))
+        waiter.wait()
+
+    def close(self):
+        """残りを書き込んでライタースレッドを停止"""
+        with self._lock:
+            thread = self._thread
+            if thread is None or self._pid != os.getpid():
+                return
+            self._thread = None
+        self._queue.put(self._STOP)
+        thread.join(timeout=10)
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is self._STOP:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            # 同期書き込みが来たら待たずに書き込む
+            while len(batch) < self.batch_size and item[1] is None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is self._STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            if stopping:
+                batch.extend(self._drain())
+            self._write_batch(batch)
+
+    def _drain(self):
+        """停止時にキューに残っている書き込みをすべて取り出す"""
+        items = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return items
+            if item is not self._STOP:
+                items.append(item)
+
+    def _write_batch(self, batch):
+        """同じSQLごとにexecutemanyして1トランザクションでコミット"""
+        groups = {}
+        for statements, _ in batch:
+            for sql, params in statements:
+                groups.setdefault(sql, []).append(params)
+        try:
+            if groups:
+                with self.pool.get_connection() as conn:
+                    for sql, rows in groups.items():
+                        conn.executemany(sql, rows)
+        except Exception as e:
+            print(f"❌ まとめ書き込みエラー（{len(batch)}件）: {e}", flush=True)
+            self._write_individually(batch)
+            return
+        for _, waiter in batch:
+            if waiter:
+                waiter.done()
+
+    def _write_individually(self, batch):
+        """まとめ書き込みに失敗した場合は1件ずつ書き込んで失敗行だけを捨てる"""
+        conn = self.pool.get_connection()
+        for statements, waiter in batch:
+            error = None
+            try:
+                with conn:
+                    for sql, params in statements:
+                        conn.execute(sql, params)
+            except Exception as e:
+                print(f"❌ 書き込みエラー: {e} - {statements}", flush=True)
+                error = e
+            if waiter:
+                waiter.done(error)
+
+
+# クイズ統計の集計テーブル（record_quiz_resultと同じトランザクションで更新する）
+# レベル接頭辞はクイズIDの先頭2文字（'bq'=初級, 'iq'=中級, 'aq'=上級）
+QUIZ_ROLLUP_TABLES = [
+    '''
+    CREATE TABLE IF NOT EXISTS quiz_stats_by_level (
+        user_id TEXT,
+        level_prefix TEXT,
+        total INTEGER NOT NULL DEFAULT 0,
+        correct INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, level_prefix)
+    ) WITHOUT ROWID
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS quiz_stats_by_quiz (
+        user_id TEXT,
+        quiz_id TEXT,
+        total INTEGER NOT NULL DEFAULT 0,
+        correct INTEGER NOT NULL DEFAULT 0,
+        last_answered_at TIMESTAMP,
+        PRIMARY KEY (user_id, quiz_id)
+    ) WITHOUT ROWID
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS quiz_stats_daily (
+        user_id TEXT,
+        day TEXT,
+        level_prefix TEXT,
+        total INTEGER NOT NULL DEFAULT 0,
+        correct INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, day, level_prefix)
+    ) WITHOUT ROWID
+    ''',
+]
+
+# quiz_resultsから集計テーブルを作り直すSQL（マイグレーションと再構築コマンドで共用）
+QUIZ_ROLLUP_BACKFILL = [
+    '''
+    INSERT INTO quiz_stats_by_level (user_id, level_prefix, total, correct)
+    SELECT user_id, substr(quiz_id, 1, 2), COUNT(*), SUM(CASE WHEN is_correct THEN 1 ELSE 0 END)
+    FROM quiz_results
+    WHERE user_id IS NOT NULL AND quiz_id IS NOT NULL
+    GROUP BY user_id, substr(quiz_id, 1, 2)
+    ''',
+    '''
+    INSERT INTO quiz_stats_by_quiz (user_id, quiz_id, total, correct, last_answered_at)
+    SELECT user_id, quiz_id, COUNT(*), SUM(CASE WHEN is_correct THEN 1 ELSE 0 END), MAX(answered_at)
+    FROM quiz_results
+    WHERE user_id IS NOT NULL AND quiz_id IS NOT NULL
+    GROUP BY user_id, quiz_id
+    ''',
+    '''
+    INSERT INTO quiz_stats_daily (user_id, day, level_prefix, total, correct)
+    SELECT user_id, substr(answered_at, 1, 10), substr(quiz_id, 1, 2),
+           COUNT(*), SUM(CASE WHEN is_correct THEN 1 ELSE 0 END)
+    FROM quiz_results
+    WHERE user_id IS NOT NULL AND quiz_id IS NOT NULL AND answered_at IS NOT NULL
+    GROUP BY user_id, substr(answered_at, 1, 10), substr(quiz_id, 1, 2)
+    ''',
+]
+
+QUIZ_ROLLUP_UPSERTS = {
+    'level': '''
+        INSERT INTO quiz_stats_by_level (user_id, level_prefix, total, correct)
+        VALUES (?, ?, 1, ?)
+        ON CONFLICT (user_id, level_prefix) DO UPDATE SET
+            total = total + 1, correct = correct + excluded.correct
+    ''',
+    'quiz': '''
+        INSERT INTO quiz_stats_by_quiz (user_id, quiz_id, total, correct, last_answered_at)
+        VALUES (?, ?, 1, ?, ?)
+        ON CONFLICT (user_id, quiz_id) DO UPDATE SET
+            total = total + 1, correct = correct + excluded.correct,
+            last_answered_at = excluded.last_answered_at
+    ''',
+    'daily': '''
+        INSERT INTO quiz_stats_daily (user_id, day, level_prefix, total, correct)
+        VALUES (?, ?, ?, 1, ?)
+        ON CONFLICT (user_id, day, level_prefix) DO UPDATE SET
+            total = total + 1, correct = correct + excluded.correct
+    ''',
+}
+
+
+# スキーマのマイグレーション定義: (バージョン, 説明, SQLのリスト)
+# 新しいマイグレーションは末尾にバージョンを増やして追加する（既存のものは変更しない）
+MIGRATIONS = [
+    (1, "履歴・キュー・サブスクリプションのセカンダリインデックスを追加", [
+        "CREATE INDEX IF NOT EXISTS idx_learning_history_user_sent "
+        "ON learning_history (user_id, sent_at)",
+        "CREATE INDEX IF NOT EXISTS idx_quiz_results_user_answered "
+        "ON quiz_results (user_id, answered_at)",
+        "CREATE INDEX IF NOT EXISTS idx_question_history_user_asked "
+        "ON question_history (user_id, asked_at)",
+        "CREATE INDEX IF NOT EXISTS idx_review_queue_user_priority "
+        "ON review_queue (user_id, priority DESC, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_review_queue_user_lesson "
+        "ON review_queue (user_id, lesson_id)",
+        "CREATE INDEX IF NOT EXISTS idx_premium_subscriptions_user_status "
+        "ON premium_subscriptions (user_id, status, expires_at)",
+    ]),
+    (2, "user_stateテーブルを作成", [
+        '''
+        CREATE TABLE IF NOT EXISTS user_state (
+            user_id TEXT PRIMARY KEY,
+            last_quiz_id TEXT
+        )
+        ''',
+    ]),
+    (3, "1日の質問回数カウンターを作成", [
+        '''
+        CREATE TABLE IF NOT EXISTS daily_question_usage (
+            user_id TEXT,
+            day TEXT,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, day)
+        ) WITHOUT ROWID
+        ''',
+        # 既存の質問履歴からカウンターを復元
+        '''
+        INSERT OR IGNORE INTO daily_question_usage (user_id, day, count)
+        SELECT user_id, substr(asked_at, 1, 10), COUNT(*)
+        FROM question_history
+        WHERE user_id IS NOT NULL AND asked_at IS NOT NULL
+        GROUP BY user_id, substr(asked_at, 1, 10)
+        ''',
+    ]),
+    (4, "クイズ統計の集計テーブルを作成", QUIZ_ROLLUP_TABLES + [
+        "CREATE INDEX IF NOT EXISTS idx_quiz_stats_by_quiz_user_last "
+        "ON quiz_stats_by_quiz (user_id, last_answered_at)",
+    ] + QUIZ_ROLLUP_BACKFILL),
+    (5, "レッスン配信カーソルテーブルを作成", [
+        '''
+        CREATE TABLE IF NOT EXISTS lesson_cursor (
+            user_id TEXT PRIMARY KEY,
+            level TEXT,
+            seed INTEGER NOT NULL,
+            pass_number INTEGER NOT NULL DEFAULT 0,
+            position INTEGER NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ]),
+    (6, "翌日分の配信計画テーブルを作成", [
+        '''
+        CREATE TABLE IF NOT EXISTS delivery_plan (
+            user_id TEXT,
+            plan_date TEXT,
+            slot TEXT,
+            lesson_id TEXT,
+            level TEXT,
+            rendered_text TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (plan_date, slot, user_id)
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_delivery_plan_user_date "
+        "ON delivery_plan (user_id, plan_date)",
+    ]),
+    (7, "配信アウトボックスを作成", [
+        '''
+        CREATE TABLE IF NOT EXISTS delivery_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            job_id TEXT NOT NULL,
+            user_id TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            state TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE (job_id, user_id)
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_delivery_outbox_due "
+        "ON delivery_outbox (state, next_attempt_at)",
+    ]),
+    (8, "配信台帳と再送キーを追加", [
+        "ALTER TABLE delivery_outbox ADD COLUMN retry_key TEXT",
+        '''
+        CREATE TABLE IF NOT EXISTS delivery_ledger (
+            user_id TEXT NOT NULL,
+            slot TEXT NOT NULL,
+            delivery_date TEXT NOT NULL,
+            retry_key TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 1,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, slot, delivery_date)
+        )
+        ''',
+    ]),
+    (9, "スケジューラーのリーダー選出用リースを作成", [
+        '''
+        CREATE TABLE IF NOT EXISTS scheduler_lease (
+            name TEXT PRIMARY KEY,
+            holder TEXT NOT NULL,
+            acquired_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            expires_at TIMESTAMP NOT NULL
+        )
+        ''',
+    ]),
+    (10, "スケジュールジョブの定義を作成", [
+        '''
+        CREATE TABLE IF NOT EXISTS scheduled_jobs (
+            name TEXT PRIMARY KEY,
+            handler TEXT NOT NULL,
+            day_of_week TEXT,
+            at_time TEXT NOT NULL,
+            enabled INTEGER NOT NULL DEFAULT 1,
+            last_success_at TEXT,
+            revision INTEGER NOT NULL DEFAULT 1,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ]),
+    (11, "配信枠ごとの希望配信時刻を作成", [
+        '''
+        CREATE TABLE IF NOT EXISTS delivery_preferences (
+            user_id TEXT NOT NULL,
+            slot TEXT NOT NULL,
+            preferred_time TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, slot)
+        )
+        ''',
+    ]),
+    (12, "処理済みWebhookイベントの記録を作成", [
+        '''
+        CREATE TABLE IF NOT EXISTS webhook_events (
+            event_id TEXT PRIMARY KEY,
+            received_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_webhook_events_received_at ON webhook_events (received_at)",
+    ]),
+    (13, "AI回答のキャッシュを作成", [
+        '''
+        CREATE TABLE IF NOT EXISTS ai_answer_cache (
+            question_key TEXT NOT NULL,
+            level TEXT NOT NULL,
+            answer TEXT NOT NULL,
+            hit_count INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_used_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (question_key, level)
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_ai_answer_cache_last_used_at ON ai_answer_cache (last_used_at)",
+    ]),
+    # 配信計画の作成時ではなく送信時にカーソルを進めるため、計画に送信後のカーソルを持たせる
+    (14, "配信計画に送信後のレッスンカーソルを追加", [
+        "ALTER TABLE delivery_plan ADD COLUMN cursor_level TEXT",
+        "ALTER TABLE delivery_plan ADD COLUMN cursor_seed INTEGER",
+        "ALTER TABLE delivery_plan ADD COLUMN cursor_pass_number INTEGER",
+        "ALTER TABLE delivery_plan ADD COLUMN cursor_position INTEGER",
+    ]),
+]
+
+# レッスンカーソルの保存（送信の再送などで古いカーソルが後から届いても巻き戻さない）
+LESSON_CURSOR_UPSERT = '''
+    INSERT INTO lesson_cursor (user_id, level, seed, pass_number, position, updated_at)
+    VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+    ON CONFLICT (user_id) DO UPDATE SET
+        level = excluded.level,
+        seed = excluded.seed,
+        pass_number = excluded.pass_number,
+        position = excluded.position,
+        updated_at = excluded.updated_at
+    WHERE excluded.level IS NOT lesson_cursor.level
+        OR excluded.seed != lesson_cursor.seed
+        OR (excluded.pass_number, excluded.position) > (lesson_cursor.pass_number, lesson_cursor.position)
+'''
+
+# ユーザーの有効なサブスクリプション（なければ無料プラン）
+ACTIVE_SUBSCRIPTION_QUERY = '''
+    SELECT plan_type, status, expires_at, stripe_subscription_id
+    FROM premium_subscriptions 
+    WHERE user_id = ? AND status = 'active' AND expires_at > CURRENT_TIMESTAMP
+    ORDER BY created_at DESC LIMIT 1
+'''
+
+# 送信中（sending）のまま放置された行を再送対象に戻すまでの秒数
+# プロセスが送信中に落ちた場合、この時間が過ぎると別のワーカーが引き継ぐ
+OUTBOX_LEASE_SECONDS = 300
+
+
 class LearningDatabase:
     def __init__(self, db_path=None):
         if db_path is None:
@@ -11,13 +597,35 @@ class LearningDatabase:
         self.db_path = db_path
         print(f"DBパス: {self.db_path}", flush=True)
         print("LearningDatabaseインスタンス化直後", flush=True)
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        self.pool = ConnectionPool.for_path(self.db_path)
+        self.writer = self.pool.writer
         self.init_database()
     
+    def get_connection(self):
+        """プールから現在のスレッド用の接続を取得
+
+        `with self.get_connection() as conn:` の形で使うと、ブロック終了時に
+        コミット（例外時はロールバック）される。接続自体は閉じずに再利用する。
+        """
+        return self.pool.get_connection()
+    
+    def flush_writes(self):
+        """書き込みキューに残っている記録をすべてコミットする"""
+        self.writer.flush()
+    
     def init_database(self):
-        """データベースとテーブルを初期化"""
-        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
-        
-        with sqlite3.connect(self.db_path) as conn:
+        """データベースとテーブルを初期化（プロセス内でDBパスごとに一度だけ実行）"""
+        with self.pool.init_lock:
+            if self.pool.schema_ready:
+                return
+            self._create_tables()
+            self.run_migrations()
+            self.pool.schema_ready = True
+
+    def _create_tables(self):
+        """基本テーブルを作成"""
+        with self.get_connection() as conn:
             cursor = conn.cursor()
             
             # ユーザーテーブル
@@ -97,12 +705,54 @@ class LearningDatabase:
                     FOREIGN KEY (user_id) REFERENCES users (user_id)
                 )
             ''')
-            
+
             conn.commit()
-    
+
+    def get_schema_version(self):
+        """適用済みの最新スキーマバージョンを取得"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INTEGER PRIMARY KEY,
+                    description TEXT,
+                    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            cursor.execute('SELECT MAX(version) FROM schema_version')
+            result = cursor.fetchone()
+            return result[0] or 0
+
+    def run_migrations(self):
+        """未適用のマイグレーションをバージョン順に適用"""
+        current_version = self.get_schema_version()
+        conn = self.get_connection()
+        for version, description, statements in MIGRATIONS:
+            if version <= current_version:
+                continue
+            try:
+                with conn:
+                    # 他プロセスと同時に適用しないよう書き込みロックを先に取る
+                    conn.execute('BEGIN IMMEDIATE')
+                    applied = conn.execute(
+                        'SELECT 1 FROM schema_version WHERE version = ?', (version,)
+                    ).fetchone()
+                    if applied:
+                        continue
+                    for statement in statements:
+                        conn.execute(statement)
+                    conn.execute('''
+                        INSERT INTO schema_version (version, description)
+                        VALUES (?, ?)
+                    ''', (version, description))
+                print(f"✅ マイグレーション適用: v{version} {description}", flush=True)
+            except Exception as e:
+                print(f"❌ マイグレーション失敗: v{version} {description} - {e}", flush=True)
+                raise
+
     def add_user(self, user_id, level="beginner"):
         """新しいユーザーを追加"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self.get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 INSERT OR REPLACE INTO users (user_id, level, last_activity)
@@ -112,7 +762,7 @@ class LearningDatabase:
     
     def get_user_level(self, user_id):
         """ユーザーの現在のレベルを取得"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self.get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('SELECT level FROM users WHERE user_id = ?', (user_id,))
             result = cursor.fetchone()
@@ -120,7 +770,7 @@ class LearningDatabase:
     
     def get_all_users(self):
         """全ユーザーIDを取得"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self.get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('SELECT user_id FROM users')
             results = cursor.fetchall()
@@ -128,29 +778,75 @@ class LearningDatabase:
             return [row[0] for row in results]
     
     def update_user_level(self, user_id, new_level):
-        """ユーザーのレベルを更新"""
-        with sqlite3.connect(self.db_path) as conn:
+        """ユーザーのレベルを更新（レベルが変わった場合はレッスンカーソルもリセット）"""
+        with self.get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 UPDATE users 
                 SET level = ?, last_activity = CURRENT_TIMESTAMP
                 WHERE user_id = ?
             ''', (new_level, user_id))
+            cursor.execute('''
+                DELETE FROM lesson_cursor WHERE user_id = ? AND level IS NOT ?
+            ''', (user_id, new_level))
+            self._invalidate_delivery_plans(cursor, user_id)
             conn.commit()
     
-    def record_lesson_sent(self, user_id, lesson_id, level):
-        """学習メッセージの送信を記録"""
-        with sqlite3.connect(self.db_path) as conn:
+    def get_lesson_cursor(self, user_id):
+        """ユーザーのレッスンカーソルを取得
+
+        Returns:
+            (level, seed, pass_number, position) のタプル（未作成ならNone）
+        """
+        with self.get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
-                INSERT INTO learning_history (user_id, lesson_id, level)
-                VALUES (?, ?, ?)
-            ''', (user_id, lesson_id, level))
-            conn.commit()
+                SELECT level, seed, pass_number, position
+                FROM lesson_cursor WHERE user_id = ?
+            ''', (user_id,))
+            return cursor.fetchone()
+    
+    def get_all_lesson_cursors(self):
+        """全ユーザーのレッスンカーソルを一括取得
+
+        Returns:
+            {user_id: (level, seed, pass_number, position)} の辞書
+        """
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT user_id, level, seed, pass_number, position FROM lesson_cursor')
+            return {row[0]: tuple(row[1:]) for row in cursor.fetchall()}
+    
+    def save_lesson_cursor(self, user_id, level, seed, pass_number, position):
+        """レッスンカーソルを保存"""
+        self.save_lesson_cursors([(user_id, level, seed, pass_number, position)])
+    
+    def save_lesson_cursors(self, cursors):
+        """複数ユーザーのレッスンカーソルを1トランザクションで保存（保存済みより前のカーソルは無視）
+
+        Args:
+            cursors: (user_id, level, seed, pass_number, position) のリスト
+        """
+        if not cursors:
+            return
+        with self.get_connection() as conn:
+            conn.executemany(LESSON_CURSOR_UPSERT, cursors)
+    
+    def record_lesson_sent(self, user_id, lesson_id, level, sync=False):
+        """学習メッセージの送信を記録
+
+        通常は書き込みキューに積んでまとめてコミットする。
+        直後に同じデータを読む必要がある場合は sync=True を指定する。
+        """
+        self.writer.submit(
+            'INSERT INTO learning_history (user_id, lesson_id, level, sent_at) VALUES (?, ?, ?, ?)',
+            (user_id, lesson_id, level, utc_timestamp()),
+            wait=sync
+        )
     
     def get_recent_lessons(self, user_id, days=7):
         """最近送信されたレッスンを取得"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self.get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 SELECT lesson_id, level, sent_at 
@@ -161,70 +857,99 @@ class LearningDatabase:
             '''.format(days), (user_id,))
             return cursor.fetchall()
     
-    def record_quiz_result(self, user_id, quiz_id, user_answer, correct_answer):
-        """テスト結果を記録"""
+    def record_quiz_result(self, user_id, quiz_id, user_answer, correct_answer, sync=False):
+        """テスト結果を記録し、同じトランザクションで集計テーブルも更新（sync=Trueでコミット完了まで待つ）"""
         is_correct = user_answer == correct_answer
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO quiz_results (user_id, quiz_id, user_answer, correct_answer, is_correct)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (user_id, quiz_id, user_answer, correct_answer, is_correct))
-            conn.commit()
+        correct = 1 if is_correct else 0
+        answered_at = utc_timestamp()
+        level_prefix = quiz_id[:2]
+        self.writer.submit_statements([
+            ('INSERT INTO quiz_results (user_id, quiz_id, user_answer, correct_answer, is_correct, answered_at) '
+             'VALUES (?, ?, ?, ?, ?, ?)',
+             (user_id, quiz_id, user_answer, correct_answer, is_correct, answered_at)),
+            (QUIZ_ROLLUP_UPSERTS['level'], (user_id, level_prefix, correct)),
+            (QUIZ_ROLLUP_UPSERTS['quiz'], (user_id, quiz_id, correct, answered_at)),
+            (QUIZ_ROLLUP_UPSERTS['daily'], (user_id, answered_at[:10], level_prefix, correct)),
+        ], wait=sync)
+    
+    def rebuild_quiz_rollups(self):
+        """quiz_resultsからクイズ統計の集計テーブルを作り直す"""
+        self.flush_writes()
+        conn = self.get_connection()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            for table in ('quiz_stats_by_level', 'quiz_stats_by_quiz', 'quiz_stats_daily'):
+                conn.execute(f'DELETE FROM {table}')
+            for statement in QUIZ_ROLLUP_BACKFILL:
+                conn.execute(statement)
+            rows = conn.execute('SELECT COALESCE(SUM(total), 0) FROM quiz_stats_by_level').fetchone()[0]
+        print(f"✅ クイズ統計の集計テーブルを再構築しました（{rows}件の回答）", flush=True)
+        return rows
+    
+    @staticmethod
+    def _format_quiz_stats(total, correct):
+        """(total_quizzes, correct_answers, accuracy) のタプルに整形（回答がなければ (0, None, None)）"""
+        if not total:
+            return (0, None, None)
+        return (total, correct, correct * 100.0 / total)
     
     def get_quiz_statistics(self, user_id, days=30):
-        """テスト統計を取得"""
-        with sqlite3.connect(self.db_path) as conn:
+        """テスト統計を取得（日別集計テーブルを参照）"""
+        with self.get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
-                SELECT
-                    COUNT(*) as total_quizzes,
-                    SUM(CASE WHEN is_correct THEN 1 ELSE 0 END) as correct_answers,
-                    AVG(CASE WHEN is_correct THEN 1.0 ELSE 0.0 END) * 100 as accuracy
-                FROM quiz_results
+                SELECT SUM(total), SUM(correct)
+                FROM quiz_stats_daily
                 WHERE user_id = ?
-                AND answered_at >= datetime('now', '-{} days')
-            '''.format(days), (user_id,))
-            return cursor.fetchone()
+                AND day >= date('now', ?)
+            ''', (user_id, f'-{int(days)} days'))
+            total, correct = cursor.fetchone()
+            return self._format_quiz_stats(total, correct)
 
-    def get_quiz_statistics_by_level(self, user_id, level_prefix, days=365):
+    def get_quiz_statistics_by_level(self, user_id, level_prefix, days=None):
         """特定レベルのテスト統計を取得
 
         Args:
             user_id: ユーザーID
             level_prefix: クイズIDのプレフィックス（'bq'=初級, 'iq'=中級, 'aq'=上級）
-            days: 集計期間（日数）
+            days: 集計期間（日数）。Noneの場合は全期間をレベル別集計から1行で取得
 
         Returns:
             (total_quizzes, correct_answers, accuracy) のタプル
         """
-        with sqlite3.connect(self.db_path) as conn:
+        with self.get_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute('''
-                SELECT
-                    COUNT(*) as total_quizzes,
-                    SUM(CASE WHEN is_correct THEN 1 ELSE 0 END) as correct_answers,
-                    AVG(CASE WHEN is_correct THEN 1.0 ELSE 0.0 END) * 100 as accuracy
-                FROM quiz_results
-                WHERE user_id = ?
-                AND quiz_id LIKE ?
-                AND answered_at >= datetime('now', '-{} days')
-            '''.format(days), (user_id, level_prefix + '%'))
-            return cursor.fetchone()
+            if days is None:
+                cursor.execute('''
+                    SELECT total, correct FROM quiz_stats_by_level
+                    WHERE user_id = ? AND level_prefix = ?
+                ''', (user_id, level_prefix))
+                result = cursor.fetchone() or (0, 0)
+            else:
+                cursor.execute('''
+                    SELECT SUM(total), SUM(correct)
+                    FROM quiz_stats_daily
+                    WHERE user_id = ?
+                    AND day >= date('now', ?)
+                    AND level_prefix = ?
+                ''', (user_id, f'-{int(days)} days', level_prefix))
+                result = cursor.fetchone()
+            return self._format_quiz_stats(*result)
     
     def add_to_review_queue(self, user_id, lesson_id, level, reason, priority=1):
-        """復習キューに追加"""
-        with sqlite3.connect(self.db_path) as conn:
+        """復習キューに追加（作成済みの配信計画は無効化）"""
+        with self.get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 INSERT INTO review_queue (user_id, lesson_id, level, reason, priority)
                 VALUES (?, ?, ?, ?, ?)
             ''', (user_id, lesson_id, level, reason, priority))
+            self._invalidate_delivery_plans(cursor, user_id)
             conn.commit()
     
     def get_review_items(self, user_id, limit=5):
         """復習アイテムを取得"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self.get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 SELECT lesson_id, level, reason, priority
@@ -234,38 +959,545 @@ class LearningDatabase:
                 LIMIT ?
             ''', (user_id, limit))
             return cursor.fetchall()
+
+    def save_delivery_plans(self, plans):
+        """配信計画を1トランザクションで保存
+
+        Args:
+            plans: (user_id, plan_date, slot, lesson_id, level, rendered_text, lesson_cursor) のリスト
+                （lesson_cursor は送信後の (level, seed, pass_number, position)。復習レッスンはNone）
+        """
+        if not plans:
+            return
+        with self.get_connection() as conn:
+            conn.executemany('''
+                INSERT OR REPLACE INTO delivery_plan
+                (user_id, plan_date, slot, lesson_id, level, rendered_text,
+                 cursor_level, cursor_seed, cursor_pass_number, cursor_position)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', [plan[:6] + tuple(plan[6] or (None, None, None, None)) for plan in plans])
+    
+    def get_delivery_plans(self, plan_date, slot):
+        """指定日・枠の配信計画を取得
+
+        Returns:
+            {user_id: (lesson_id, level, rendered_text, lesson_cursor)} の辞書
+            （lesson_cursor は送信後の (level, seed, pass_number, position) またはNone）
+        """
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT user_id, lesson_id, level, rendered_text,
+                       cursor_level, cursor_seed, cursor_pass_number, cursor_position
+                FROM delivery_plan
+                WHERE plan_date = ? AND slot = ?
+            ''', (plan_date.strftime('%Y-%m-%d'), slot))
+            return {
+                row[0]: tuple(row[1:4]) + (tuple(row[4:]) if row[5] is not None else None,)
+                for row in cursor.fetchall()
+            }
+    
+    def _invalidate_delivery_plans(self, cursor, user_id):
+        """今日以降の配信計画を削除（呼び出し元のトランザクション内で実行）"""
+        cursor.execute('''
+            DELETE FROM delivery_plan WHERE user_id = ? AND plan_date >= ?
+        ''', (user_id, datetime.now().strftime('%Y-%m-%d')))
+    
+    def purge_delivery_plans(self, before_date):
+        """指定日より前の古い配信計画を削除"""
+        with self.get_connection() as conn:
+            cursor = conn.execute(
+                'DELETE FROM delivery_plan WHERE plan_date < ?',
+                (before_date.strftime('%Y-%m-%d'),)
+            )
+            return cursor.rowcount
+    
+    def enqueue_outbox(self, job_id, entries, release_times=None):
+        """配信アウトボックスに送信予定を追加
+
+        同じジョブ・ユーザーの行が既にある場合は追加しない（ジョブの再実行で重複しない）。
+
+        Args:
+            job_id: ジョブID（例: "daily_lesson:morning:2024-01-01"）
+            entries: (user_id, payload) のリスト。payloadはJSON文字列
+            release_times: {user_id: 送信開始時刻（ローカル時刻のdatetime）}。
+                指定したユーザーの行はその時刻まで送信しない（配信枠内での分散用）
+
+        Returns:
+            新たに追加した件数
+        """
+        if not entries:
+            return 0
+        release_times = release_times or {}
+        with self.get_connection() as conn:
+            before = conn.total_changes
+            # 再送キーは行ごとに固定し、再送時も同じキーを X-Line-Retry-Key に使う
+            conn.executemany('''
+                INSERT OR IGNORE INTO delivery_outbox (job_id, user_id, payload, retry_key, next_attempt_at)
+                VALUES (?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP))
+            ''', [
+                (job_id, user_id, payload, str(uuid.uuid4()), self._to_utc_timestamp(release_times.get(user_id)))
+                for user_id, payload in entries
+            ])
+            return conn.total_changes - before
+    
+    @staticmethod
+    def _to_utc_timestamp(moment):
+        """ローカル時刻のdatetimeをCURRENT_TIMESTAMPと同じ形式（UTC）に変換（NoneはNone）"""
+        if moment is None:
+            return None
+        return moment.astimezone(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+    
+    def claim_outbox(self, limit, job_id=None, lease_seconds=OUTBOX_LEASE_SECONDS):
+        """送信期限が来た行を取得して送信中にする
+
+        pending の行と、リース期限切れの sending の行（送信中にプロセスが落ちた分）が対象。
+        取得した行はリース期限まで他のワーカーに取得されない。
+
+        Returns:
+            (id, job_id, user_id, payload, attempts, retry_key) のリスト
+        """
+        job_filter = "AND job_id = ?" if job_id else ""
+        params = (f'+{int(lease_seconds)} seconds',) + ((job_id,) if job_id else ()) + (limit,)
+        with self.get_connection() as conn:
+            cursor = conn.execute(f'''
+                UPDATE delivery_outbox
+                SET state = 'sending', next_attempt_at = datetime('now', ?), updated_at = CURRENT_TIMESTAMP
+                WHERE id IN (
+                    SELECT id FROM delivery_outbox
+                    WHERE state IN ('pending', 'sending')
+                    AND next_attempt_at <= datetime('now')
+                    {job_filter}
+                    ORDER BY next_attempt_at, id
+                    LIMIT ?
+                )
+                RETURNING id, job_id, user_id, payload, attempts, retry_key
+            ''', params)
+            return sorted(cursor.fetchall())
+    
+    def claim_delivery_slots(self, deliveries):
+        """配信台帳に記録し、送信してよい配信だけを返す
+
+        (user_id, slot, delivery_date) ごとに1行の台帳へ、送信直前に1文で記録する。
+        行がなければ作成して送信可、同じ再送キーの行があれば再送として送信可、
+        別の再送キーの行があれば別のスケジューラーが送信済み（または送信中）のため送信しない。
+
+        Args:
+            deliveries: (user_id, slot, delivery_date, retry_key) のリスト
+
+        Returns:
+            送信してよい user_id の集合
+        """
+        allowed = set()
+        with self.get_connection() as conn:
+            for user_id, slot, delivery_date, retry_key in deliveries:
+                cursor = conn.execute('''
+                    INSERT INTO delivery_ledger (user_id, slot, delivery_date, retry_key)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT (user_id, slot, delivery_date) DO UPDATE
+                    SET attempts = attempts + 1
+                    WHERE delivery_ledger.retry_key = excluded.retry_key
+                    RETURNING user_id
+                ''', (user_id, slot, delivery_date, retry_key))
+                if cursor.fetchone():
+                    allowed.add(user_id)
+        return allowed
+    
+    def skip_outbox(self, outbox_ids):
+        """配信台帳で重複と判定した行を送信せずに完了にする"""
+        if not outbox_ids:
+            return
+        with self.get_connection() as conn:
+            conn.executemany('''
+                UPDATE delivery_outbox
+                SET state = 'duplicate', updated_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            ''', [(outbox_id,) for outbox_id in outbox_ids])
+    
+    def purge_delivery_ledger(self, days=7):
+        """古い配信台帳の行を削除"""
+        with self.get_connection() as conn:
+            cursor = conn.execute(
+                "DELETE FROM delivery_ledger WHERE created_at < datetime('now', ?)",
+                (f'-{int(days)} days',)
+            )
+            return cursor.rowcount
+    
+    def complete_outbox(self, outbox_ids, lessons_sent=(), cursors=()):
+        """送信済みにした行と、送信したレッスンの記録・レッスンカーソルを1トランザクションで保存
+
+        Args:
+            outbox_ids: 送信に成功した行のIDリスト
+            lessons_sent: (user_id, lesson_id, level) のリスト
+            cursors: 送信したレッスンで進めた (user_id, level, seed, pass_number, position) のリスト
+        """
+        if not outbox_ids:
+            return
+        with self.get_connection() as conn:
+            conn.executemany('''
+                UPDATE delivery_outbox
+                SET state = 'sent', attempts = attempts + 1, last_error = NULL, updated_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            ''', [(outbox_id,) for outbox_id in outbox_ids])
+            sent_at = utc_timestamp()
+            conn.executemany(
+                'INSERT INTO learning_history (user_id, lesson_id, level, sent_at) VALUES (?, ?, ?, ?)',
+                [(user_id, lesson_id, level, sent_at) for user_id, lesson_id, level in lessons_sent]
+            )
+            conn.executemany(LESSON_CURSOR_UPSERT, cursors)
+    
+    def fail_outbox(self, failures, max_attempts, base_delay_seconds):
+        """送信に失敗した行を指数バックオフで再送待ちに戻す
+
+        試行回数が max_attempts に達した行は failed にする。
+
+        Args:
+            failures: (id, これまでの試行回数, エラー内容) のリスト
+        """
+        if not failures:
+            return
+        rows = []
+        for outbox_id, attempts, error in failures:
+            attempts += 1
+            state = 'failed' if attempts >= max_attempts else 'pending'
+            delay = base_delay_seconds * (2 ** (attempts - 1))
+            rows.append((state, attempts, f'+{int(delay)} seconds', error, outbox_id))
+        with self.get_connection() as conn:
+            conn.executemany('''
+                UPDATE delivery_outbox
+                SET state = ?, attempts = ?, next_attempt_at = datetime('now', ?),
+                    last_error = ?, updated_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            ''', rows)
+    
+    def get_outbox_stats(self):
+        """ジョブ・状態ごとのアウトボックス件数を取得
+
+        Returns:
+            {job_id: {state: 件数}} の辞書
+        """
+        with self.get_connection() as conn:
+            cursor = conn.execute('''
+                SELECT job_id, state, COUNT(*) FROM delivery_outbox
+                GROUP BY job_id, state
+            ''')
+            stats = {}
+            for job_id, state, count in cursor.fetchall():
+                stats.setdefault(job_id, {})[state] = count
+            return stats
+    
+    def purge_outbox(self, days=7):
+        """送信済み・失敗・重複の古い行を削除"""
+        with self.get_connection() as conn:
+            cursor = conn.execute('''
+                DELETE FROM delivery_outbox
+                WHERE state IN ('sent', 'failed', 'duplicate') AND updated_at < datetime('now', ?)
+            ''', (f'-{int(days)} days',))
+            return cursor.rowcount
+    
+    def acquire_lease(self, name, holder, ttl_seconds):
+        """リースを取得または延長（1文で判定）
+
+        リースがない・期限切れ・自分が保持している場合に holder を保持者にして期限を延ばす。
+
+        Returns:
+            リースを保持できたかどうか
+        """
+        with self.get_connection() as conn:
+            cursor = conn.execute('''
+                INSERT INTO scheduler_lease (name, holder, expires_at)
+                VALUES (?, ?, datetime('now', ?))
+                ON CONFLICT (name) DO UPDATE
+                SET acquired_at = CASE WHEN scheduler_lease.holder = excluded.holder
+                                       THEN scheduler_lease.acquired_at ELSE CURRENT_TIMESTAMP END,
+                    holder = excluded.holder,
+                    expires_at = excluded.expires_at
+                WHERE scheduler_lease.holder = excluded.holder
+                   OR scheduler_lease.expires_at <= datetime('now')
+                RETURNING holder
+            ''', (name, holder, f'+{int(ttl_seconds)} seconds'))
+            return cursor.fetchone() is not None
+    
+    def release_lease(self, name, holder):
+        """自分が保持しているリースを手放す（ほかのプロセスがすぐ引き継げる）"""
+        with self.get_connection() as conn:
+            conn.execute(
+                'DELETE FROM scheduler_lease WHERE name = ? AND holder = ?',
+                (name, holder)
+            )
+    
+    def get_lease(self, name):
+        """リースの保持者と期限を取得
+
+        Returns:
+            (holder, acquired_at, expires_at) のタプルまたはNone
+        """
+        with self.get_connection() as conn:
+            cursor = conn.execute(
+                'SELECT holder, acquired_at, expires_at FROM scheduler_lease WHERE name = ?',
+                (name,)
+            )
+            return cursor.fetchone()
+    
+    def seed_job_definitions(self, definitions):
+        """既定のジョブ定義を登録（登録済みのジョブは管理画面での変更を残すため上書きしない）
+
+        Args:
+            definitions: (name, handler, day_of_week, at_time) のリスト
+        """
+        with self.get_connection() as conn:
+            conn.executemany('''
+                INSERT OR IGNORE INTO scheduled_jobs (name, handler, day_of_week, at_time)
+                VALUES (?, ?, ?, ?)
+            ''', definitions)
+
+    def get_job_definitions(self):
+        """ジョブ定義の一覧を取得
+
+        Returns:
+            ジョブ定義の辞書のリスト（last_success_at はスケジュールと同じローカル時刻）
+        """
+        with self.get_connection() as conn:
+            cursor = conn.execute('''
+                SELECT name, handler, day_of_week, at_time, enabled, last_success_at, updated_at
+                FROM scheduled_jobs
+                ORDER BY name
+            ''')
+            return [
+                {
+                    'name': row[0],
+                    'handler': row[1],
+                    'day_of_week': row[2],
+                    'at_time': row[3],
+                    'enabled': bool(row[4]),
+                    'last_success_at': row[5],
+                    'updated_at': row[6],
+                }
+                for row in cursor.fetchall()
+            ]
+
+    def save_job_definition(self, name, handler, day_of_week, at_time, enabled):
+        """ジョブ定義を作成または更新（リビジョンを上げてリーダーに再読み込みさせる）"""
+        with self.get_connection() as conn:
+            conn.execute('''
+                INSERT INTO scheduled_jobs (name, handler, day_of_week, at_time, enabled)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (name) DO UPDATE
+                SET handler = excluded.handler,
+                    day_of_week = excluded.day_of_week,
+                    at_time = excluded.at_time,
+                    enabled = excluded.enabled,
+                    revision = scheduled_jobs.revision + 1,
+                    updated_at = CURRENT_TIMESTAMP
+            ''', (name, handler, day_of_week, at_time, 1 if enabled else 0))
+
+    def get_job_definitions_revision(self):
+        """ジョブ定義全体のリビジョン（いずれかの定義が変わると増える）"""
+        with self.get_connection() as conn:
+            cursor = conn.execute('SELECT COUNT(*), COALESCE(SUM(revision), 0) FROM scheduled_jobs')
+            return tuple(cursor.fetchone())
+
+    def record_job_success(self, name, started_at):
+        """ジョブが最後に成功した開始時刻（ローカル時刻）を記録"""
+        with self.get_connection() as conn:
+            conn.execute(
+                'UPDATE scheduled_jobs SET last_success_at = ? WHERE name = ?',
+                (started_at.strftime('%Y-%m-%d %H:%M:%S'), name)
+            )
+
+    def get_delivery_preferences(self, slot):
+        """配信枠の希望配信時刻を取得
+
+        Returns:
+            {user_id: "HH:MM"} の辞書
+        """
+        with self.get_connection() as conn:
+            cursor = conn.execute(
+                'SELECT user_id, preferred_time FROM delivery_preferences WHERE slot = ?',
+                (slot,)
+            )
+            return dict(cursor.fetchall())
+
+    def set_delivery_preference(self, user_id, slot, preferred_time):
+        """配信枠の希望配信時刻を保存（preferred_time が None の場合は削除して既定の分散に戻す）"""
+        with self.get_connection() as conn:
+            if preferred_time is None:
+                conn.execute(
+                    'DELETE FROM delivery_preferences WHERE user_id = ? AND slot = ?',
+                    (user_id, slot)
+                )
+                return
+            conn.execute('''
+                INSERT INTO delivery_preferences (user_id, slot, preferred_time)
+                VALUES (?, ?, ?)
+                ON CONFLICT (user_id, slot) DO UPDATE
+                SET preferred_time = excluded.preferred_time, updated_at = CURRENT_TIMESTAMP
+            ''', (user_id, slot, preferred_time))
+
+    def claim_webhook_events(self, event_ids):
+        """WebhookイベントIDを記録し、初めて受け取ったIDだけを返す（1文で判定）
+
+        再起動前や別のプロセスで受け取り済みのIDは返さない。
+
+        Returns:
+            初めて受け取った event_id の集合
+        """
+        if not event_ids:
+            return set()
+        placeholders = ", ".join("(?)" for _ in event_ids)
+        with self.get_connection() as conn:
+            cursor = conn.execute(f'''
+                INSERT INTO webhook_events (event_id) VALUES {placeholders}
+                ON CONFLICT (event_id) DO NOTHING
+                RETURNING event_id
+            ''', list(event_ids))
+            return {row[0] for row in cursor.fetchall()}
+
+    def forget_webhook_events(self, event_ids):
+        """記録したWebhookイベントIDを削除（受け付けられなかったイベントを再送で処理できるようにする）"""
+        if not event_ids:
+            return
+        with self.get_connection() as conn:
+            conn.executemany('DELETE FROM webhook_events WHERE event_id = ?', [(event_id,) for event_id in event_ids])
+
+    def get_cached_ai_answer(self, question_key, level, ttl_seconds):
+        """キャッシュしたAI回答を取得（期限切れはNone）
+
+        Returns:
+            (answer, 経過秒数) または None
+        """
+        with self.get_connection() as conn:
+            row = conn.execute('''
+                UPDATE ai_answer_cache
+                SET hit_count = hit_count + 1, last_used_at = CURRENT_TIMESTAMP
+                WHERE question_key = ? AND level = ? AND created_at >= datetime('now', ?)
+                RETURNING answer, (julianday('now') - julianday(created_at)) * 86400
+            ''', (question_key, level, f'-{int(ttl_seconds)} seconds')).fetchone()
+            return (row[0], row[1]) if row else None
+
+    def save_cached_ai_answer(self, question_key, level, answer, max_entries):
+        """AI回答をキャッシュに保存し、件数の上限を超えた分を最終利用の古い順に削除"""
+        with self.get_connection() as conn:
+            conn.execute('''
+                INSERT INTO ai_answer_cache (question_key, level, answer)
+                VALUES (?, ?, ?)
+                ON CONFLICT (question_key, level) DO UPDATE
+                SET answer = excluded.answer, hit_count = 0,
+                    created_at = CURRENT_TIMESTAMP, last_used_at = CURRENT_TIMESTAMP
+            ''', (question_key, level, answer))
+            conn.execute('''
+                DELETE FROM ai_answer_cache WHERE rowid IN (
+                    SELECT rowid FROM ai_answer_cache ORDER BY last_used_at DESC LIMIT -1 OFFSET ?
+                )
+            ''', (max_entries,))
+
+    def purge_cached_ai_answers(self, ttl_seconds):
+        """期限切れのAI回答キャッシュを削除"""
+        with self.get_connection() as conn:
+            cursor = conn.execute(
+                "DELETE FROM ai_answer_cache WHERE created_at < datetime('now', ?)",
+                (f'-{int(ttl_seconds)} seconds',)
+            )
+            return cursor.rowcount
+
+    def get_ai_answer_cache_summary(self, limit=10):
+        """AI回答キャッシュの件数とよく使われる質問"""
+        with self.get_connection() as conn:
+            entries, hits = conn.execute(
+                'SELECT COUNT(*), COALESCE(SUM(hit_count), 0) FROM ai_answer_cache'
+            ).fetchone()
+            top = conn.execute('''
+                SELECT question_key, level, hit_count FROM ai_answer_cache
+                ORDER BY hit_count DESC, last_used_at DESC LIMIT ?
+            ''', (limit,)).fetchall()
+        return {
+            'entries': entries,
+            'hits': hits,
+            'top_questions': [
+                {'question': question_key, 'level': level, 'hits': hit_count}
+                for question_key, level, hit_count in top
+            ],
+        }
+
+    def purge_webhook_events(self, seconds):
+        """指定秒数より古いWebhookイベントIDを削除"""
+        with self.get_connection() as conn:
+            cursor = conn.execute(
+                "DELETE FROM webhook_events WHERE received_at < datetime('now', ?)",
+                (f'-{int(seconds)} seconds',)
+            )
+            return cursor.rowcount
+
+    def get_all_user_levels(self):
+        """全ユーザーのレベルを一括取得
+
+        Returns:
+            {user_id: level} の辞書
+        """
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT user_id, level FROM users')
+            return dict(cursor.fetchall())
+
+    def get_review_items_by_user(self, limit=3):
+        """全ユーザーの優先度上位の復習アイテムを一括取得
+
+        Returns:
+            {user_id: [(lesson_id, level, reason, priority), ...]} の辞書
+        """
+        review_items = {}
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT user_id, lesson_id, level, reason, priority
+                FROM (
+                    SELECT
+                        user_id, lesson_id, level, reason, priority,
+                        ROW_NUMBER() OVER (
+                            PARTITION BY user_id
+                            ORDER BY priority DESC, created_at ASC
+                        ) AS rank
+                    FROM review_queue
+                )
+                WHERE rank <= ?
+                ORDER BY user_id, rank
+            ''', (limit,))
+            for user_id, lesson_id, level, reason, priority in cursor.fetchall():
+                review_items.setdefault(user_id, []).append((lesson_id, level, reason, priority))
+        return review_items
     
     def remove_from_review_queue(self, user_id, lesson_id):
-        """復習キューから削除"""
-        with sqlite3.connect(self.db_path) as conn:
+        """復習キューから削除（作成済みの配信計画は無効化）"""
+        with self.get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 DELETE FROM review_queue 
                 WHERE user_id = ? AND lesson_id = ?
             ''', (user_id, lesson_id))
+            self._invalidate_delivery_plans(cursor, user_id)
             conn.commit()
     
     def get_weak_areas(self, user_id, days=30):
-        """苦手分野を特定"""
-        with sqlite3.connect(self.db_path) as conn:
+        """苦手分野を特定
+
+        指定期間内に回答したクイズのうち、不正解のあるものを正答率の低い順に返す。
+        正答率はクイズ別集計テーブルの全期間の値を使う。
+        """
+        with self.get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
-                SELECT 
-                    q.quiz_id,
-                    COUNT(*) as total_attempts,
-                    SUM(CASE WHEN q.is_correct THEN 1 ELSE 0 END) as correct_attempts
-                FROM quiz_results q
-                WHERE q.user_id = ? 
-                AND q.answered_at >= datetime('now', '-{} days')
-                GROUP BY q.quiz_id
-                HAVING correct_attempts < total_attempts
-                ORDER BY (correct_attempts * 1.0 / total_attempts) ASC
-            '''.format(days), (user_id,))
+                SELECT quiz_id, total, correct
+                FROM quiz_stats_by_quiz
+                WHERE user_id = ?
+                AND last_answered_at >= datetime('now', ?)
+                AND correct < total
+                ORDER BY (correct * 1.0 / total) ASC
+            ''', (user_id, f'-{int(days)} days'))
             return cursor.fetchall()
     
     def get_learning_progress(self, user_id):
         """学習進捗を取得"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self.get_connection() as conn:
             cursor = conn.cursor()
             
             # 総学習回数
@@ -282,10 +1514,10 @@ class LearningDatabase:
             ''', (user_id,))
             weekly_lessons = cursor.fetchone()[0]
             
-            # テスト正答率
+            # テスト正答率（レベル別集計テーブルから算出）
             cursor.execute('''
-                SELECT AVG(CASE WHEN is_correct THEN 1.0 ELSE 0.0 END) * 100
-                FROM quiz_results WHERE user_id = ?
+                SELECT SUM(correct) * 100.0 / SUM(total)
+                FROM quiz_stats_by_level WHERE user_id = ?
             ''', (user_id,))
             quiz_accuracy = cursor.fetchone()[0] or 0
             
@@ -297,14 +1529,8 @@ class LearningDatabase:
 
     def set_last_quiz_id(self, user_id, quiz_id):
         """ユーザーごとに直近出題したクイズIDを保存"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self.get_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS user_state (
-                    user_id TEXT PRIMARY KEY,
-                    last_quiz_id TEXT
-                )
-            ''')
             cursor.execute('''
                 INSERT OR REPLACE INTO user_state (user_id, last_quiz_id)
                 VALUES (?, ?)
@@ -313,79 +1539,78 @@ class LearningDatabase:
 
     def get_last_quiz_id(self, user_id):
         """ユーザーごとに直近出題したクイズIDを取得"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self.get_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS user_state (
-                    user_id TEXT PRIMARY KEY,
-                    last_quiz_id TEXT
-                )
-            ''')
             cursor.execute('SELECT last_quiz_id FROM user_state WHERE user_id = ?', (user_id,))
             result = cursor.fetchone()
             return result[0] if result else None
     
-    def record_question_asked(self, user_id, question=""):
-        """質問を記録"""
+    def record_question_asked(self, user_id, question="", sync=False):
+        """質問を記録（sync=Trueでコミット完了まで待つ）"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                # 日本時間で現在時刻を取得
-                jst_now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                cursor.execute('''
-                    INSERT INTO question_history (user_id, question, asked_at)
-                    VALUES (?, ?, ?)
-                ''', (user_id, question, jst_now))
-                conn.commit()
-                print(f"🔍 デバッグ: 質問記録成功 - user_id={user_id}, question={question[:20]}..., time={jst_now}")
-                
-                # 記録直後に確認
-                cursor.execute('''
-                    SELECT COUNT(*) FROM question_history WHERE user_id = ?
-                ''', (user_id,))
-                total_count = cursor.fetchone()[0]
-                print(f"🔍 デバッグ: このユーザーの総質問数 = {total_count}")
-                
+            # 日本時間で現在時刻を取得
+            jst_now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            self.writer.submit(
+                'INSERT INTO question_history (user_id, question, asked_at) VALUES (?, ?, ?)',
+                (user_id, question, jst_now),
+                wait=sync
+            )
         except Exception as e:
             print(f"❌ 質問記録エラー: {e}")
             raise
     
     def get_daily_question_count(self, user_id, date):
-        """指定日の質問回数を取得"""
+        """指定日の質問回数を取得（daily_question_usageカウンターを参照）"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.get_connection() as conn:
                 cursor = conn.cursor()
-                # 日付を文字列形式に変換
                 date_str = date.strftime('%Y-%m-%d')
-                
-                # まず、実際のasked_atの値を確認
-                cursor.execute('''
-                    SELECT asked_at FROM question_history 
-                    WHERE user_id = ? 
-                    ORDER BY asked_at DESC 
-                    LIMIT 3
-                ''', (user_id,))
-                recent_records = cursor.fetchall()
-                print(f"🔍 デバッグ: 最近のasked_at値 = {recent_records}")
-                
-                # 日付比較（文字列の左側9文字で日付部分を比較）
                 cursor.execute('''
-                    SELECT COUNT(*) FROM question_history 
-                    WHERE user_id = ? AND substr(asked_at, 1, 10) = ?
+                    SELECT count FROM daily_question_usage
+                    WHERE user_id = ? AND day = ?
                 ''', (user_id, date_str))
                 result = cursor.fetchone()
-                count = result[0] if result else 0
-                print(f"🔍 デバッグ: 質問回数取得 - user_id={user_id}, date={date_str}, count={count}")
-                
-                return count
+                return result[0] if result else 0
         except Exception as e:
             print(f"❌ 質問回数取得エラー: {e}")
             return 0
 
+    def try_consume_question(self, user_id, date=None):
+        """プランの確認と質問枠の消費を1トランザクションで行う
+
+        有効なサブスクリプションから上限を決め、その日の質問回数が上限未満なら1増やす。
+        同時に届いたWebhookが両方とも上限をすり抜けないよう、UPSERTの条件で判定する。
+
+        Returns:
+            (消費できたか, 消費後のその日の質問回数, サブスクリプション) のタプル
+        """
+        date_str = (date or datetime.now().date()).strftime('%Y-%m-%d')
+        conn = self.get_connection()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            subscription = self._subscription_from_row(
+                conn.execute(ACTIVE_SUBSCRIPTION_QUERY, (user_id,)).fetchone()
+            )
+            limit = self.get_question_limit_for_user(user_id, subscription)
+            consumed_row = conn.execute('''
+                INSERT INTO daily_question_usage (user_id, day, count)
+                SELECT ?, ?, 1 WHERE ? > 0
+                ON CONFLICT (user_id, day) DO UPDATE SET count = count + 1
+                WHERE count < ?
+                RETURNING count
+            ''', (user_id, date_str, limit, limit)).fetchone()
+            if consumed_row is not None:
+                return True, consumed_row[0], subscription
+            result = conn.execute('''
+                SELECT count FROM daily_question_usage
+                WHERE user_id = ? AND day = ?
+            ''', (user_id, date_str)).fetchone()
+        return False, result[0] if result else 0, subscription
+    
     def get_inactive_users(self, days=7):
         """指定日数以上アクティブでないユーザーを取得"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.get_connection() as conn:
                 cursor = conn.cursor()
                 
                 # 指定日数前の日付を計算
@@ -409,7 +1634,7 @@ class LearningDatabase:
     def create_premium_subscription(self, user_id, stripe_subscription_id, stripe_customer_id):
         """プレミアムサブスクリプションを作成"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.get_connection() as conn:
                 cursor = conn.cursor()
                 started_at = datetime.now()
                 expires_at = started_at + timedelta(days=30)
@@ -426,33 +1651,30 @@ class LearningDatabase:
             print(f"❌ プレミアムサブスクリプション作成エラー: {e}")
             return False
     
+    @staticmethod
+    def _subscription_from_row(result):
+        """ACTIVE_SUBSCRIPTION_QUERY の結果をサブスクリプションの辞書に変換（行がなければ無料プラン）"""
+        if result:
+            return {
+                'plan_type': result[0],
+                'status': result[1],
+                'expires_at': result[2],
+                'stripe_subscription_id': result[3]
+            }
+        return {
+            'plan_type': 'free',
+            'status': 'inactive',
+            'expires_at': None,
+            'stripe_subscription_id': None
+        }
+    
     def get_user_subscription(self, user_id):
         """ユーザーのサブスクリプション状態を取得"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.get_connection() as conn:
                 cursor = conn.cursor()
-                cursor.execute('''
-                    SELECT plan_type, status, expires_at, stripe_subscription_id
-                    FROM premium_subscriptions 
-                    WHERE user_id = ? AND status = 'active' AND expires_at > CURRENT_TIMESTAMP
-                    ORDER BY created_at DESC LIMIT 1
-                ''', (user_id,))
-                result = cursor.fetchone()
-                
-                if result:
-                    return {
-                        'plan_type': result[0],
-                        'status': result[1],
-                        'expires_at': result[2],
-                        'stripe_subscription_id': result[3]
-                    }
-                else:
-                    return {
-                        'plan_type': 'free',
-                        'status': 'inactive',
-                        'expires_at': None,
-                        'stripe_subscription_id': None
-                    }
+                cursor.execute(ACTIVE_SUBSCRIPTION_QUERY, (user_id,))
+                return self._subscription_from_row(cursor.fetchone())
         except Exception as e:
             print(f"❌ サブスクリプション取得エラー: {e}")
             return {'plan_type': 'free', 'status': 'inactive', 'expires_at': None, 'stripe_subscription_id': None}
@@ -460,7 +1682,7 @@ class LearningDatabase:
     def cancel_premium_subscription(self, user_id, stripe_subscription_id):
         """プレミアムサブスクリプションをキャンセル"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.get_connection() as conn:
                 cursor = conn.cursor()
                 cursor.execute('''
                     UPDATE premium_subscriptions 
@@ -474,7 +1696,8 @@ class LearningDatabase:
             print(f"❌ プレミアムサブスクリプションキャンセルエラー: {e}")
             return False
     
-    def get_question_limit_for_user(self, user_id):
-        """ユーザーの1日の質問制限数を取得"""
-        subscription = self.get_user_subscription(user_id)
+    def get_question_limit_for_user(self, user_id, subscription=None):
+        """ユーザーの1日の質問制限数を取得（取得済みのsubscriptionがあれば再検索しない）"""
+        if subscription is None:
+            subscription = self.get_user_subscription(user_id)
         return 10 if subscription['plan_type'] == 'premium' and subscription['status'] == 'active' else 3 
\ No newline at end of file
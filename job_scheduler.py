@@ -0,0 +1,354 @@
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta
+
+WEEKDAYS = ("monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday")
+
+# ジョブごとに保持する実行記録の件数
+JOB_HISTORY_SIZE = 20
+
+
+class ScheduleError(Exception):
+    """ジョブ定義の誤り"""
+
+
+class Job:
+    """定期実行するジョブ（schedule.Job 互換のメソッドを持つ）"""
+
+    def __init__(self, interval, scheduler):
+        self.interval = interval
+        self.scheduler = scheduler
+        self.unit = None
+        self.start_day = None
+        self.at_time = None
+        self.tags = set()
+        self.job_func = None
+        self.next_run = None
+        self.last_run = None
+        self.history = deque(maxlen=JOB_HISTORY_SIZE)
+
+    def __repr__(self):
+        name = getattr(self.job_func, '__name__', repr(self.job_func))
+        return f"Job(every {self.interval} {self.unit}, at={self.at_time}, do={name}, next_run={self.next_run})"
+
+    # 単位の指定（schedule と同じく単数形は interval == 1 のときだけ使える）
+    def _set_unit(self, unit, singular=False):
+        if singular and self.interval != 1:
+            raise ScheduleError(f"every({self.interval}) には複数形の単位を使ってください")
+        self.unit = unit
+        return self
+
+    @property
+    def second(self):
+        return self._set_unit("seconds", singular=True)
+
+    @property
+    def seconds(self):
+        return self._set_unit("seconds")
+
+    @property
+    def minute(self):
+        return self._set_unit("minutes", singular=True)
+
+    @property
+    def minutes(self):
+        return self._set_unit("minutes")
+
+    @property
+    def hour(self):
+        return self._set_unit("hours", singular=True)
+
+    @property
+    def hours(self):
+        return self._set_unit("hours")
+
+    @property
+    def day(self):
+        return self._set_unit("days", singular=True)
+
+    @property
+    def days(self):
+        return self._set_unit("days")
+
+    @property
+    def week(self):
+        return self._set_unit("weeks", singular=True)
+
+    @property
+    def weeks(self):
+        return self._set_unit("weeks")
+
+    def _set_weekday(self, weekday):
+        if self.interval != 1:
+            raise ScheduleError("曜日指定のジョブは every() のみ使えます")
+        self.start_day = weekday
+        self.unit = "weeks"
+        return self
+
+    @property
+    def monday(self):
+        return self._set_weekday("monday")
+
+    @property
+    def tuesday(self):
+        return self._set_weekday("tuesday")
+
+    @property
+    def wednesday(self):
+        return self._set_weekday("wednesday")
+
+    @property
+    def thursday(self):
+        return self._set_weekday("thursday")
+
+    @property
+    def friday(self):
+        return self._set_weekday("friday")
+
+    @property
+    def saturday(self):
+        return self._set_weekday("saturday")
+
+    @property
+    def sunday(self):
+        return self._set_weekday("sunday")
+
+    def at(self, time_str):
+        """実行時刻を "HH:MM" または "HH:MM:SS" で指定（日・週単位のジョブのみ）"""
+        if self.unit not in ("days", "weeks"):
+            raise ScheduleError("at() は日・週単位のジョブにのみ指定できます")
+        try:
+            parts = [int(part) for part in time_str.split(":")]
+            hour, minute = parts[0], parts[1]
+            second = parts[2] if len(parts) > 2 else 0
+            self.at_time = datetime.min.replace(hour=hour, minute=minute, second=second).time()
+        except (ValueError, IndexError):
+            raise ScheduleError(f"時刻の形式が正しくありません: {time_str}")
+        return self
+
+    def tag(self, *tags):
+        """ジョブにタグを付ける（clear(tag) でまとめて削除できる）"""
+        self.tags.update(tags)
+        return self
+
+    def do(self, job_func, *args, **kwargs):
+        """実行する関数を指定してスケジューラーに登録"""
+        if self.unit is None:
+            raise ScheduleError("ジョブの単位（day, minute など）が指定されていません")
+        self.job_func = job_func
+        self.args = args
+        self.kwargs = kwargs
+        self.next_run = self._next_run_after(datetime.now())
+        self.scheduler._add(self)
+        return self
+
+    def _next_run_after(self, moment):
+        """moment より後で最初の予定時刻を計算"""
+        if self.unit in ("seconds", "minutes", "hours") or (self.at_time is None and self.start_day is None):
+            return moment + timedelta(**{self.unit: self.interval})
+
+        candidate = moment.replace(
+            hour=self.at_time.hour, minute=self.at_time.minute, second=self.at_time.second, microsecond=0
+        ) if self.at_time else moment.replace(microsecond=0)
+        if self.start_day is not None:
+            days_ahead = (WEEKDAYS.index(self.start_day) - candidate.weekday()) % 7
+            candidate += timedelta(days=days_ahead)
+            step = timedelta(weeks=self.interval)
+        else:
+            step = timedelta(**{self.unit: self.interval})
+        while candidate <= moment:
+            candidate += step if self.start_day is None else timedelta(weeks=1)
+        return candidate
+
+    def previous_run(self, moment):
+        """moment 以前で最後の予定時刻（時刻指定のない間隔ジョブはNone）
+
+        停止中に予定時刻を過ぎたかどうかの判定に使う。
+        """
+        if self.at_time is None:
+            return None
+        candidate = moment.replace(
+            hour=self.at_time.hour, minute=self.at_time.minute, second=self.at_time.second, microsecond=0
+        )
+        if self.start_day is not None:
+            candidate -= timedelta(days=(candidate.weekday() - WEEKDAYS.index(self.start_day)) % 7)
+            step = timedelta(weeks=1)
+        else:
+            step = timedelta(days=self.interval)
+        while candidate > moment:
+            candidate -= step
+        return candidate
+
+    @property
+    def should_run(self):
+        return self.next_run is not None and datetime.now() >= self.next_run
+
+    def run(self, missed_run=None):
+        """ジョブを実行して実行記録を残し、次回の予定時刻を設定
+
+        missed_run を指定した場合は、停止中に過ぎたその予定時刻の分として実行する
+        （次回の予定時刻は変えない）。
+        """
+        scheduled_at = missed_run or self.next_run
+        started_at = datetime.now()
+        start = time.perf_counter()
+        succeeded = True
+        try:
+            return self.job_func(*self.args, **self.kwargs)
+        except Exception as e:
+            succeeded = False
+            print(f"❌ ジョブ実行エラー: {self.job_func.__name__}: {type(e).__name__}: {e}")
+        finally:
+            duration = time.perf_counter() - start
+            self.last_run = started_at
+            self.history.append({
+                'scheduled_at': scheduled_at,
+                'started_at': started_at,
+                'delay_seconds': round((started_at - scheduled_at).total_seconds(), 3),
+                'duration_seconds': round(duration, 3),
+                'succeeded': succeeded,
+            })
+            # 予定時刻を基準に次回を決める（実行が長引いても時刻がずれない）
+            if missed_run is None:
+                self.next_run = self._next_run_after(max(scheduled_at, datetime.now()))
+
+
+class Scheduler:
+    """ジョブを次の実行時刻のヒープで管理するスケジューラー
+
+    schedule ライブラリと同じ書き方（every().day.at("10:00").tag(...).do(func)）でジョブを登録でき、
+    wait() は次のジョブの予定時刻まで正確に眠る。ジョブの追加・削除や wake() で早めに起こせる。
+    """
+
+    def __init__(self):
+        self.jobs = []
+        self._heap = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        # wait() に入る前に呼ばれた wake() を取りこぼさないための印
+        self._woken = False
+
+    def every(self, interval=1):
+        return Job(interval, self)
+
+    def _add(self, job):
+        with self._condition:
+            self.jobs.append(job)
+            self._push(job)
+            self._condition.notify_all()
+
+    def _push(self, job):
+        heapq.heappush(self._heap, (job.next_run, next(self._counter), job))
+
+    def _pop_due(self, now):
+        """予定時刻を過ぎたジョブを取り出す（削除・再設定済みの古い項目は捨てる）"""
+        with self._condition:
+            while self._heap:
+                next_run, _, job = self._heap[0]
+                if job not in self.jobs or next_run != job.next_run:
+                    heapq.heappop(self._heap)
+                    continue
+                if next_run > now:
+                    return None
+                heapq.heappop(self._heap)
+                return job
+            return None
+
+    def run_pending(self):
+        """予定時刻を過ぎたジョブを予定時刻順に実行
+
+        Returns:
+            実行したジョブの数
+        """
+        ran = 0
+        now = datetime.now()
+        while True:
+            job = self._pop_due(now)
+            if job is None:
+                return ran
+            job.run()
+            ran += 1
+            with self._condition:
+                if job in self.jobs:
+                    self._push(job)
+
+    def cancel_job(self, job):
+        with self._condition:
+            if job in self.jobs:
+                self.jobs.remove(job)
+            self._condition.notify_all()
+
+    def clear(self, tag=None):
+        """ジョブを削除（tagを指定した場合はそのタグのジョブだけ）"""
+        with self._condition:
+            # jobs は module の jobs からも参照されるため、リスト自体は作り直さない
+            self.jobs[:] = [job for job in self.jobs if tag is not None and tag not in job.tags]
+            self._heap = [(job.next_run, next(self._counter), job) for job in self.jobs]
+            heapq.heapify(self._heap)
+            self._condition.notify_all()
+
+    def get_jobs(self, tag=None):
+        return [job for job in self.jobs if tag is None or tag in job.tags]
+
+    @property
+    def next_run(self):
+        """次に実行するジョブの予定時刻（ジョブがなければNone）"""
+        with self._condition:
+            return min((job.next_run for job in self.jobs), default=None)
+
+    @property
+    def idle_seconds(self):
+        next_run = self.next_run
+        if next_run is None:
+            return None
+        return (next_run - datetime.now()).total_seconds()
+
+    def wait(self, max_seconds=None):
+        """次のジョブの予定時刻まで眠る
+
+        ジョブの追加・削除や wake() があった場合、max_seconds を過ぎた場合は早めに戻る。
+        前回の wait() 以降に wake() が呼ばれていれば眠らずに戻る。
+        """
+        with self._condition:
+            if self._woken:
+                self._woken = False
+                return
+            idle = self.idle_seconds
+            if idle is None:
+                timeout = max_seconds
+            else:
+                timeout = max(0.0, idle) if max_seconds is None else max(0.0, min(idle, max_seconds))
+            if timeout == 0:
+                return
+            self._condition.wait(timeout)
+            self._woken = False
+
+    def wake(self):
+        """wait() 中のスレッドを起こす（wait() に入る前なら、次の wait() をすぐに戻す）"""
+        with self._condition:
+            self._woken = True
+            self._condition.notify_all()
+
+
+default_scheduler = Scheduler()
+
+# schedule モジュールと同じ関数・属性
+jobs = default_scheduler.jobs
+every = default_scheduler.every
+run_pending = default_scheduler.run_pending
+cancel_job = default_scheduler.cancel_job
+clear = default_scheduler.clear
+get_jobs = default_scheduler.get_jobs
+wait = default_scheduler.wait
+wake = default_scheduler.wake
+
+
+def next_run():
+    return default_scheduler.next_run
+
+
+def idle_seconds():
+    return default_scheduler.idle_seconds
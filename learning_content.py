@@ -1,7 +1,135 @@
-import json
 import random
+import functools
+import hashlib
+import multiprocessing
 from datetime import datetime, timedelta
 from database import LearningDatabase
+from content_store import get_content_store, extract_lesson_number
+
+@functools.lru_cache(maxsize=4096)
+def lesson_permutation(seed, pass_number, size):
+    """シードと周回数から決まるレッスン順（0〜size-1の順列）"""
+    order = list(range(size))
+    random.Random(f"{seed}:{pass_number}").shuffle(order)
+    return tuple(order)
+
+
+# 複数プロセスでレッスンを選択・整形する場合の、1タスクあたりのユーザー数
+LESSON_RENDER_CHUNK_SIZE = 2000
+
+# ワーカープロセスのコンテンツストア（ワーカーの起動時に読み込む）
+_worker_content_store = None
+
+
+def shard_for_user(user_id, shard_count):
+    """ユーザーIDの安定したハッシュでシャード番号を決める（プロセスや再起動で変わらない）"""
+    digest = hashlib.sha256(user_id.encode()).digest()
+    return int.from_bytes(digest[:8], 'big') % shard_count
+
+
+def advance_lesson_cursor(content_store, user_level, cursor):
+    """レッスンカーソルを1つ進めて次のレッスンを選ぶ
+
+    各ユーザーはシードを持ち、レベル内のレッスンをシードと周回数から決まる
+    順列の順に受け取る。1周の間は同じレッスンが重複しない。
+    レベルが変わった場合（またはカーソル未作成の場合）は新しいシードで最初から始める。
+
+    Args:
+        content_store: レッスンを持つコンテンツストア
+        user_level: ユーザーのレベル
+        cursor: (level, seed, pass_number, position) のタプルまたはNone
+
+    Returns:
+        (lesson, 進めた後のカーソル) のタプル
+    """
+    lessons = content_store.get_lessons(user_level)
+    if not lessons:
+        return None, cursor
+    
+    if cursor is None or cursor[0] != user_level:
+        cursor = (user_level, random.getrandbits(31), 0, 0)
+    level, seed, pass_number, position = cursor
+    
+    # 1周したら次の周回の順列に切り替える
+    if position >= len(lessons):
+        pass_number += 1
+        position = 0
+    
+    order = lesson_permutation(seed, pass_number, len(lessons))
+    return lessons[order[position]], (level, seed, pass_number, position + 1)
+
+
+def format_lesson_message(lesson):
+    """レッスンをメッセージ形式にフォーマット"""
+    if not lesson:
+        return "今日の学習コンテンツを準備中です..."
+    
+    message = f"📚 {lesson['title']}\n\n"
+    
+    # point、description、summaryフィールドを使用
+    if 'point' in lesson:
+        message += lesson['point']
+    elif 'description' in lesson:
+        message += lesson['description']
+    elif 'summary' in lesson:
+        message += lesson['summary']
+    elif 'content' in lesson:
+        message += lesson['content']
+    else:
+        message += "学習コンテンツの詳細がありません。"
+    
+    # 例文があれば追加
+    if 'examples' in lesson and lesson['examples']:
+        message += "\n\n📝 例文:\n"
+        for i, example in enumerate(lesson['examples'][:3], 1):  # 最大3つまで
+            message += f"{i}. {example}\n"
+            # 例文の間にスペースを追加（最後の例文以外）
+            if i < min(3, len(lesson['examples'])):
+                message += "\n"
+    
+    # タグがあれば追加
+    if 'tags' in lesson and lesson['tags']:
+        message += f"\n🏷️ タグ: {', '.join(lesson['tags'])}"
+    
+    return message
+
+
+def render_lesson(lesson):
+    """レッスンを配信用の (lesson_id, level, 整形済みテキスト) にする"""
+    lesson_id = lesson.get('id') or lesson.get('lesson') or lesson.get('lesson_number')
+    return lesson_id, lesson.get('level', 'beginner'), format_lesson_message(lesson)
+
+
+def _init_render_worker(learning_data_path, quiz_data_path):
+    """ワーカープロセスの初期化：親プロセスと同じファイルからコンテンツストアを読み込む"""
+    global _worker_content_store
+    # 新規ユーザーのシードがプロセス間で重ならないよう乱数を初期化し直す
+    random.seed()
+    _worker_content_store = get_content_store(learning_data_path=learning_data_path, quiz_data_path=quiz_data_path)
+
+
+def _render_lesson_chunk(entries):
+    """ワーカープロセスで1チャンク分のレッスンを選択・整形
+
+    DBには触れず、親プロセスから受け取ったレベル・カーソル・復習アイテムだけで計算する。
+
+    Args:
+        entries: (user_id, level, cursor, review_lesson_id) のリスト
+
+    Returns:
+        (user_id, lesson_id, level, 整形済みテキスト, 送信後のカーソル) のリスト
+        （復習レッスンはカーソルを進めないためNone）
+    """
+    rendered = []
+    for user_id, level, cursor, review_lesson_id in entries:
+        lesson = _worker_content_store.get_lesson(review_lesson_id) if review_lesson_id else None
+        new_cursor = None
+        if not lesson:
+            lesson, new_cursor = advance_lesson_cursor(_worker_content_store, level, cursor)
+        if lesson:
+            rendered.append((user_id,) + render_lesson(lesson) + (new_cursor,))
+    return rendered
+
 
 class LearningContentManager:
     def __init__(self, learning_data_path="data/learning_data.json"):
@@ -10,169 +138,171 @@ class LearningContentManager:
         self.load_learning_data()
     
     def load_learning_data(self):
-        """学習データを読み込み"""
-        try:
-            with open(self.learning_data_path, 'r', encoding='utf-8') as f:
-                raw_data = json.load(f)
-                # 配列形式のデータをレベル別に分類
-                self.learning_data = {"beginner": [], "intermediate": [], "advanced": []}
-
-                # レッスン番号に基づいてレベル分類
-                for lesson in raw_data:
-                    # lesson_idを追加（lessonフィールドから生成）
-                    if 'lesson' in lesson:
-                        lesson['id'] = lesson['lesson']
-                    elif 'lesson_number' in lesson:
-                        lesson['id'] = lesson['lesson_number']
-                        lesson['lesson'] = lesson['lesson_number']
-
-                    # contentフィールドを追加（point、description、summaryフィールドを使用）
-                    if 'point' in lesson:
-                        lesson['content'] = lesson['point']
-                    elif 'description' in lesson:
-                        lesson['content'] = lesson['description']
-                    elif 'summary' in lesson:
-                        lesson['content'] = lesson['summary']
-
-                    # レッスン番号からレベルを判定
-                    lesson_num = self.extract_lesson_number(lesson.get('lesson', ''))
-                    if lesson_num <= 80:
-                        lesson['level'] = 'beginner'
-                        self.learning_data['beginner'].append(lesson)
-                    elif lesson_num <= 160:
-                        lesson['level'] = 'intermediate'
-                        self.learning_data['intermediate'].append(lesson)
-                    else:
-                        lesson['level'] = 'advanced'
-                        self.learning_data['advanced'].append(lesson)
-
-                # レベル別データ数をログ出力
-                print(f"Learning data loaded successfully:")
-                print(f"   Beginner: {len(self.learning_data['beginner'])} lessons")
-                print(f"   Intermediate: {len(self.learning_data['intermediate'])} lessons")
-                print(f"   Advanced: {len(self.learning_data['advanced'])} lessons")
-
-        except FileNotFoundError:
-            print(f"学習データファイルが見つかりません: {self.learning_data_path}")
-            self.learning_data = {"beginner": [], "intermediate": [], "advanced": []}
-        except Exception as e:
-            print(f"学習データ読み込みエラー: {e}")
-            self.learning_data = {"beginner": [], "intermediate": [], "advanced": []}
+        """学習データを共有コンテンツストアから取得（JSONの読み込みはプロセス内で一度だけ）"""
+        self.content_store = get_content_store(learning_data_path=self.learning_data_path)
+        self.learning_data = self.content_store.learning_data
 
     def extract_lesson_number(self, lesson_str):
         """レッスン文字列から番号を抽出"""
-        import re
-        if not lesson_str:
-            return 0
-        # "Lesson 001", "Lesson 123"などから数字を抽出
-        match = re.search(r'(\d+)', lesson_str)
-        if match:
-            return int(match.group(1))
-        return 0
+        return extract_lesson_number(lesson_str)
 
     def get_lesson_by_id(self, lesson_id):
-        """IDでレッスンを取得"""
-        for level in self.learning_data.values():
-            for lesson in level:
-                if (lesson.get('id') == lesson_id or 
-                    lesson.get('lesson') == lesson_id or 
-                    lesson.get('lesson_number') == lesson_id):
-                    return lesson
-        return None
+        """IDでレッスンを取得（コンテンツストアの索引を使うO(1)検索）"""
+        return self.content_store.get_lesson(lesson_id)
     
-    def get_random_lesson(self, level, exclude_ids=None):
-        """指定レベルからランダムにレッスンを取得"""
-        if exclude_ids is None:
-            exclude_ids = []
-        
-        available_lessons = [
-            lesson for lesson in self.learning_data.get(level, [])
-            if (lesson.get('id') not in exclude_ids and 
-                lesson.get('lesson') not in exclude_ids and
-                lesson.get('lesson_number') not in exclude_ids)
-        ]
+    def select_next_lesson(self, user_id):
+        """ユーザーの次のレッスンを選ぶ（カーソルは保存しない）
+
+        Returns:
+            (lesson, 送信後に保存するカーソル) のタプル（復習レッスンの場合カーソルはNone）
+        """
+        user_level = self.db.get_user_level(user_id)
         
-        if not available_lessons:
-            return None
+        # 復習アイテムを優先
+        review_items = self.db.get_review_items(user_id, limit=1)
+        review_lesson = self.get_review_item_lesson(review_items)
+        if review_lesson:
+            return review_lesson, None
         
-        return random.choice(available_lessons)
+        # レッスンカーソルを1つ進めて未配信のレッスンを取得
+        cursor = self.db.get_lesson_cursor(user_id)
+        lesson, new_cursor = self.advance_lesson_cursor(user_level, cursor)
+        return lesson, new_cursor if lesson else None
     
     def get_next_lesson(self, user_id):
-        """ユーザーの次のレッスンを取得"""
-        user_level = self.db.get_user_level(user_id)
-        # 重複回避期間を30日に拡張（240レッスンなので約8ヶ月の重複回避）
-        recent_lessons = self.db.get_recent_lessons(user_id, days=30)
-        recent_ids = [lesson[0] for lesson in recent_lessons]
+        """ユーザーの次のレッスンを取得し、カーソルを進める（その場で返信する場合）"""
+        lesson, new_cursor = self.select_next_lesson(user_id)
+        if new_cursor:
+            self.db.save_lesson_cursor(user_id, *new_cursor)
+        return lesson
+    
+    def get_next_lessons(self, user_ids, cursors=None):
+        """複数ユーザーの次のレッスンをまとめて選ぶ（カーソルは保存しない）
 
-        # 復習アイテムを優先
-        review_items = self.db.get_review_items(user_id, limit=3)
-        if review_items:
-            lesson_id = review_items[0][0]
-            lesson = self.get_lesson_by_id(lesson_id)
-            if lesson:
-                return lesson
-
-        # 新しいレッスンを取得（30日以内の重複を避ける）
-        lesson = self.get_random_lesson(user_level, exclude_ids=recent_ids)
-        if lesson:
-            return lesson
+        レベル・レッスンカーソル・復習アイテムを全ユーザー分一括で読み込む。
+        cursors を渡した場合は保存済みのカーソルの代わりに使う（配信計画で前の枠の続きから選ぶ場合）。
 
-        # 30日以内で見つからない場合は14日以内の重複を避ける
-        recent_lessons_14d = self.db.get_recent_lessons(user_id, days=14)
-        recent_ids_14d = [lesson[0] for lesson in recent_lessons_14d]
-        lesson = self.get_random_lesson(user_level, exclude_ids=recent_ids_14d)
-        if lesson:
-            return lesson
+        Returns:
+            {user_id: (lesson, 送信後に保存するカーソル)} の辞書
+            （レッスンが見つからないユーザーは lesson がNone、復習レッスンはカーソルがNone）
+        """
+        levels = self.db.get_all_user_levels()
+        cursors = self.db.get_all_lesson_cursors() if cursors is None else cursors
+        review_by_user = self.db.get_review_items_by_user(limit=1)
+        
+        lessons = {}
+        for user_id in user_ids:
+            lesson = self.get_review_item_lesson(review_by_user.get(user_id))
+            new_cursor = None
+            if not lesson:
+                lesson, new_cursor = self.advance_lesson_cursor(levels.get(user_id), cursors.get(user_id))
+            lessons[user_id] = (lesson, new_cursor if lesson else None)
+        return lessons
+    
+    def iter_rendered_lessons(self, user_ids, processes=1, chunk_size=LESSON_RENDER_CHUNK_SIZE, cursors=None):
+        """複数ユーザーの次のレッスンを選択・整形し、できた分から順に返す
 
-        # それでも見つからない場合は7日以内の重複を避ける
-        recent_lessons_7d = self.db.get_recent_lessons(user_id, days=7)
-        recent_ids_7d = [lesson[0] for lesson in recent_lessons_7d]
-        lesson = self.get_random_lesson(user_level, exclude_ids=recent_ids_7d)
-        if lesson:
-            return lesson
+        processes が2以上でユーザー数が chunk_size を超える場合は、ユーザーIDのハッシュで
+        processes 個のシャードに分けて multiprocessing のプール（spawn）で並列に計算する。
+        ワーカーはコンテンツストアを読み込み直し、DBの読み込みは親プロセスだけが行う。
+        spawn のワーカーは起動時に __main__ のモジュールを読み込み直すため、processes を2以上にするのは
+        plan_deliveries.py などのコマンドラインからだけにする（app.py のプロセスでは1のまま使う）。
+        レッスンが見つからないユーザーは含まれない。
+        カーソルは保存せず結果と一緒に返す（送信に成功した時点で保存するため、
+        配信計画が無効化されてもレッスンを飛ばさない）。
 
-        # 最後の手段：同じレベルから再選択
-        return self.get_random_lesson(user_level)
-    
-    def format_lesson_message(self, lesson):
-        """レッスンをメッセージ形式にフォーマット"""
-        if not lesson:
-            return "今日の学習コンテンツを準備中です..."
-        
-        message = f"📚 {lesson['title']}\n\n"
+        Yields:
+            (user_id, lesson_id, level, 整形済みテキスト, 送信後のカーソル) のリスト（チャンクごと）
+        """
+        if processes <= 1 or len(user_ids) <= chunk_size:
+            lessons = self.get_next_lessons(user_ids, cursors)
+            yield [
+                (user_id,) + render_lesson(lesson) + (new_cursor,)
+                for user_id, (lesson, new_cursor) in lessons.items() if lesson
+            ]
+            return
         
-        # point、description、summaryフィールドを使用
-        if 'point' in lesson:
-            message += lesson['point']
-        elif 'description' in lesson:
-            message += lesson['description']
-        elif 'summary' in lesson:
-            message += lesson['summary']
-        elif 'content' in lesson:
-            message += lesson['content']
-        else:
-            message += "学習コンテンツの詳細がありません。"
+        levels = self.db.get_all_user_levels()
+        cursors = self.db.get_all_lesson_cursors() if cursors is None else cursors
+        review_by_user = self.db.get_review_items_by_user(limit=1)
         
-        # 例文があれば追加
-        if 'examples' in lesson and lesson['examples']:
-            message += "\n\n📝 例文:\n"
-            for i, example in enumerate(lesson['examples'][:3], 1):  # 最大3つまで
-                message += f"{i}. {example}\n"
-                # 例文の間にスペースを追加（最後の例文以外）
-                if i < min(3, len(lesson['examples'])):
-                    message += "\n"
-        
-        # タグがあれば追加
-        if 'tags' in lesson and lesson['tags']:
-            message += f"\n🏷️ タグ: {', '.join(lesson['tags'])}"
+        shards = [[] for _ in range(processes)]
+        for user_id in user_ids:
+            review_items = review_by_user.get(user_id)
+            shards[shard_for_user(user_id, processes)].append((
+                user_id, levels.get(user_id), cursors.get(user_id), review_items[0][0] if review_items else None
+            ))
+        # シャードを交互に並べ、全シャードの結果が早い段階から届くようにする
+        largest = max(len(shard) for shard in shards)
+        tasks = [
+            shard[start:start + chunk_size]
+            for start in range(0, largest, chunk_size)
+            for shard in shards if shard[start:start + chunk_size]
+        ]
         
-        return message
+        # fork はスレッド（書き込みキュー・スケジューラー・リクエスト処理）が持っていたロックを
+        # 子プロセスに引き継いでデッドロックしうるため、新しいインタープリターで起動する spawn を使う
+        context = multiprocessing.get_context("spawn")
+        initargs = (self.content_store.learning_data_path, self.content_store.quiz_data_path)
+        with context.Pool(processes, initializer=_init_render_worker, initargs=initargs) as pool:
+            for rendered in pool.imap_unordered(_render_lesson_chunk, tasks):
+                yield rendered
+    
+    def build_delivery_plans(self, user_ids, plan_date, slot, processes=1, cursors=None):
+        """指定日・枠の配信計画を作成（レッスン選択と整形を事前に済ませる）
+
+        カーソルは進めず、送信後のカーソルを計画に含める（計画を送信した時点で保存される）。
+        cursors には前の枠の計画で進めたカーソルを渡す。
+
+        Returns:
+            (user_id, plan_date, slot, lesson_id, level, rendered_text, 送信後のカーソル) のリスト
+        """
+        plan_date_str = plan_date.strftime('%Y-%m-%d')
+        plans = []
+        for rendered in self.iter_rendered_lessons(user_ids, processes=processes, cursors=cursors):
+            for user_id, lesson_id, level, text, new_cursor in rendered:
+                plans.append((user_id, plan_date_str, slot, lesson_id, level, text, new_cursor))
+        return plans
+    
+    def get_search_message(self, query):
+        """レッスンとクイズ解説を検索した結果のメッセージを作成"""
+        query = query.strip()
+        if not query:
+            return "🔎 検索したい言葉を続けて送信してください。\n\n例：「検索 トーン」「search few-shot」"
+
+        results = self.content_store.search(query)
+        if not results:
+            return f"🔎 「{query}」に一致するレッスンは見つかりませんでした。\n\n別の言葉で検索するか、そのまま質問してください（AI質問の回数を使います）。"
+
+        level_names = {"beginner": "初級", "intermediate": "中級", "advanced": "上級"}
+        message = f"🔎 「{query}」の検索結果\n"
+        for result in results:
+            level = level_names.get(result['level'], result['level'])
+            if result['kind'] == 'lesson':
+                message += f"\n📚 {result['id']}（{level}）{result['title']}\n{result['snippet']}\n"
+            else:
+                message += f"\n💡 クイズ解説（{level}）{result['title']}\n{result['snippet']}\n"
+        return message.rstrip()
+
+    def get_review_item_lesson(self, review_items):
+        """優先度順の復習アイテムの先頭に対応するレッスンを取得"""
+        if not review_items:
+            return None
+        return self.get_lesson_by_id(review_items[0][0])
+    
+    def advance_lesson_cursor(self, user_level, cursor):
+        """レッスンカーソルを1つ進めて次のレッスンを選ぶ（advance_lesson_cursor を参照）"""
+        return advance_lesson_cursor(self.content_store, user_level, cursor)
+    
+    def format_lesson_message(self, lesson):
+        """レッスンをメッセージ形式にフォーマット"""
+        return format_lesson_message(lesson)
     
     def send_daily_lesson(self, user_id, line_bot):
-        """毎日の学習メッセージを送信"""
+        """毎日の学習メッセージを送信（送信に成功した場合だけカーソルを進める）"""
         try:
             print(f"🎯 レッスン取得中: {user_id}")
-            lesson = self.get_next_lesson(user_id)
+            lesson, new_cursor = self.select_next_lesson(user_id)
             if not lesson:
                 print(f"❌ レッスンが見つかりません: {user_id}")
                 return False
@@ -191,6 +321,8 @@ class LearningContentManager:
             lesson_id = lesson.get('id') or lesson.get('lesson') or lesson.get('lesson_number')
             print(f"💾 データベース記録中: {user_id}, レッスンID: {lesson_id}")
             self.db.record_lesson_sent(user_id, lesson_id, lesson.get('level', 'beginner'))
+            if new_cursor:
+                self.db.save_lesson_cursor(user_id, *new_cursor)
 
             print(f"✅ レッスン送信完了: {user_id}")
             return True
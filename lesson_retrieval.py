@@ -0,0 +1,104 @@
+import math
+import os
+import re
+import unicodedata
+from collections import Counter
+
+import numpy as np
+
+# 最も近いレッスンの類似度（コサイン類似度 0〜1）がこれ以上なら、OpenAI を呼ばずにレッスンで答える
+# data/retrieval_eval.tsv で誤ったレッスン回答（別のレッスン・レッスンにない質問）が出ない最小の値
+# （0.3 では 0.32〜0.33 の誤答が入る。benchmark_retrieval.py で確認できる）
+RETRIEVAL_ANSWER_THRESHOLD = float(os.getenv('RETRIEVAL_ANSWER_THRESHOLD', 0.35))
+
+# OpenAI に参考情報として渡すレッスン数
+RETRIEVAL_CONTEXT_LESSONS = int(os.getenv('RETRIEVAL_CONTEXT_LESSONS', 3))
+
+# レッスンの項目ごとの重み（例文は話題が広く誤一致しやすいため軽くする）
+FIELD_WEIGHTS = (('title', 2.0), ('content', 1.0), ('tags', 1.5), ('examples', 0.5))
+
+# 英数字の語と、漢字・カタカナの連続を取り出す
+# ひらがなは助詞・送り仮名・「ですか」などの文末がほとんどで、質問文とレッスンの誤一致の原因になるため使わない
+_TOKEN_RUNS = re.compile(r'[0-9a-z]+|[\u30a0-\u30ff\u3400-\u4dbf\u4e00-\u9fff々]+')
+
+
+def tokenize(text):
+    """テキストを索引語に分割
+
+    英数字は語ごと、漢字・カタカナは分かち書きせずに文字の bigram（1文字だけなら unigram）にする。
+    """
+    text = unicodedata.normalize('NFKC', text or '').casefold()
+    tokens = []
+    for run in _TOKEN_RUNS.findall(text):
+        if run.isascii() or len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+class LessonRetriever:
+    """質問文に近いレッスンを TF-IDF のコサイン類似度で探す
+
+    全レッスンの TF-IDF ベクトル（行ごとに L2 正規化）を NumPy の行列として一度だけ作り、
+    質問のベクトルとの内積で全レッスンの類似度をまとめて計算する。
+    """
+
+    def __init__(self, content_store):
+        self.lessons = list(content_store.iter_lessons())
+        term_counts = [self._weighted_counts(lesson) for lesson in self.lessons]
+
+        self.vocabulary = {}
+        for counts in term_counts:
+            for term in counts:
+                self.vocabulary.setdefault(term, len(self.vocabulary))
+
+        matrix = np.zeros((len(self.lessons), len(self.vocabulary)), dtype=np.float32)
+        for row, counts in enumerate(term_counts):
+            for term, count in counts.items():
+                matrix[row, self.vocabulary[term]] = 1.0 + math.log(count) if count >= 1 else count
+
+        document_frequency = np.count_nonzero(matrix, axis=0)
+        self.idf = (np.log((1 + len(self.lessons)) / (1 + document_frequency)) + 1.0).astype(np.float32)
+        # どのレッスンにもない語の idf（質問のベクトルの長さに含め、レッスンにない話題の質問の類似度を下げる）
+        self.unknown_idf = math.log(1 + len(self.lessons)) + 1.0
+        matrix *= self.idf
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        self.matrix = matrix / np.where(norms == 0, 1.0, norms)
+
+    @staticmethod
+    def _weighted_counts(lesson):
+        counts = Counter()
+        for field, weight in FIELD_WEIGHTS:
+            value = lesson.get(field)
+            if not value:
+                continue
+            text = value if isinstance(value, str) else ' '.join(value)
+            for token in tokenize(text):
+                counts[token] += weight
+        return counts
+
+    def retrieve(self, question, k=RETRIEVAL_CONTEXT_LESSONS):
+        """質問に近いレッスンを類似度の高い順に返す
+
+        Returns:
+            [(lesson, 類似度)] のリスト（索引語が1つも一致しなければ空）
+        """
+        counts = Counter(tokenize(question))
+        known = {term: count for term, count in counts.items() if term in self.vocabulary}
+        if not known:
+            return []
+        columns = np.fromiter((self.vocabulary[term] for term in known), dtype=np.intp, count=len(known))
+        weights = np.fromiter((1.0 + math.log(count) for count in known.values()), dtype=np.float32, count=len(known))
+        weights *= self.idf[columns]
+        unknown_norm_sq = sum(
+            ((1.0 + math.log(count)) * self.unknown_idf) ** 2
+            for term, count in counts.items() if term not in known
+        )
+        weights /= math.sqrt(float(weights @ weights) + unknown_norm_sq)
+
+        scores = self.matrix[:, columns] @ weights
+        k = min(k, len(self.lessons))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(self.lessons[index], float(scores[index])) for index in top if scores[index] > 0]
@@ -0,0 +1,129 @@
+import sqlite3
+import threading
+import unicodedata
+
+# 検索結果の既定件数
+SEARCH_RESULT_LIMIT = 3
+
+# bm25 の列ごとの重み（kind, ref, level は索引しないため0。title, point, examples, tags, explanation）
+BM25_WEIGHTS = (0.0, 0.0, 0.0, 5.0, 2.0, 1.0, 3.0, 1.0)
+
+# trigram トークナイザーで照合できる最短の語の長さ（これより短い語は LIKE で照合する）
+TRIGRAM_LENGTH = 3
+
+
+def normalize_text(text):
+    """全角・半角の違いをそろえる（索引と検索語の両方に使う）"""
+    return unicodedata.normalize('NFKC', text or '')
+
+
+def _quote(term):
+    """FTS5 の文字列リテラルに変換"""
+    return '"' + term.replace('"', '""') + '"'
+
+
+def _escape_like(term):
+    return term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+class LessonSearchIndex:
+    """レッスンとクイズ解説の全文検索索引（SQLite FTS5 + trigram トークナイザー）
+
+    日本語は単語の区切りがないため、3文字ずつの n-gram で索引を作る。
+    索引はプロセス内のメモリ上の SQLite に作り、コンテンツストアの読み込み・
+    再読み込みのたびに作り直す（240レッスン + クイズで数ミリ秒）。
+    """
+
+    def __init__(self, content_store):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(':memory:', check_same_thread=False)
+        self._conn.execute('''
+            CREATE VIRTUAL TABLE content_fts USING fts5(
+                kind UNINDEXED, ref UNINDEXED, level UNINDEXED,
+                title, point, examples, tags, explanation,
+                tokenize = 'trigram'
+            )
+        ''')
+        self._conn.executemany(
+            'INSERT INTO content_fts (kind, ref, level, title, point, examples, tags, explanation) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            list(self._iter_rows(content_store))
+        )
+        self._conn.commit()
+        self.document_count = self._conn.execute('SELECT COUNT(*) FROM content_fts').fetchone()[0]
+
+    @staticmethod
+    def _iter_rows(content_store):
+        for lesson in content_store.iter_lessons():
+            yield (
+                # 一部のレッスンは lesson ではなく lesson_id を持つ（id が補完されない）
+                'lesson', lesson.get('id') or lesson.get('lesson_id'), lesson.get('level'),
+                normalize_text(lesson.get('title')),
+                normalize_text(lesson.get('content')),
+                normalize_text('\n'.join(lesson.get('examples', ()))),
+                normalize_text(' '.join(lesson.get('tags', ()))),
+                '',
+            )
+        for quiz_set, quizzes in content_store.quiz_data.items():
+            for quiz in quizzes:
+                yield (
+                    'quiz', quiz.get('id'), quiz_set.replace('_quiz', ''),
+                    normalize_text(quiz.get('question')),
+                    '', '', '',
+                    normalize_text(quiz.get('explanation')),
+                )
+
+    def search(self, query, limit=SEARCH_RESULT_LIMIT, kind=None):
+        """検索語に一致するレッスン・クイズを関連度の高い順に返す
+
+        3文字以上の語は trigram に分けて OR で照合し bm25 で順位を付ける
+        （質問文のような長い検索語でも、多くの trigram を含むレッスンが上位になる）。
+        2文字以下の語（「口調」など）は部分一致（LIKE）で絞り込む。
+
+        Returns:
+            [{'kind', 'id', 'level', 'title', 'snippet'}] のリスト
+        """
+        terms = normalize_text(query).split()
+        trigrams = list(dict.fromkeys(
+            term[i:i + TRIGRAM_LENGTH].lower()
+            for term in terms if len(term) >= TRIGRAM_LENGTH
+            for i in range(len(term) - TRIGRAM_LENGTH + 1)
+        ))
+        short_terms = [term for term in terms if len(term) < TRIGRAM_LENGTH]
+        if not trigrams and not short_terms:
+            return []
+
+        conditions, params = [], []
+        for term in short_terms:
+            conditions.append(
+                "(title || ' ' || point || ' ' || examples || ' ' || tags || ' ' || explanation) LIKE ? ESCAPE '\\'"
+            )
+            params.append(f'%{_escape_like(term)}%')
+        if kind is not None:
+            conditions.append('kind = ?')
+            params.append(kind)
+
+        if trigrams:
+            conditions.insert(0, 'content_fts MATCH ?')
+            params.insert(0, ' OR '.join(_quote(trigram) for trigram in trigrams))
+            order = 'bm25(content_fts, {})'.format(', '.join(str(weight) for weight in BM25_WEIGHTS))
+        else:
+            order = 'rowid'
+
+        # snippet() は trigram トークナイザーと組み合わせると本文が重複するため、要点・解説をそのまま返す
+        sql = f'''
+            SELECT kind, ref, level, title, CASE WHEN point != '' THEN point ELSE explanation END
+            FROM content_fts
+            WHERE {' AND '.join(conditions)}
+            ORDER BY {order} LIMIT ?
+        '''
+        with self._lock:
+            rows = self._conn.execute(sql, params + [limit]).fetchall()
+        return [
+            {'kind': row_kind, 'id': ref, 'level': level, 'title': title, 'snippet': snippet_text}
+            for row_kind, ref, level, title, snippet_text in rows
+        ]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -1,14 +1,19 @@
 import os
+import time
 import requests
 from database import LearningDatabase
 from learning_content import LearningContentManager
 from quiz_manager import QuizManager
 import openai
 from datetime import datetime, timedelta
+from line_push_client import PushSession
+from ai_answer_cache import AIAnswerCache
+from lesson_retrieval import RETRIEVAL_ANSWER_THRESHOLD
+from webhook_dispatcher import WebhookDispatcher, WebhookEventDeduplicator, DispatcherFullError, LANE_AI, LANE_DEFAULT
 
 # LINE Bot SDKのインポートを試行
 try:
-    from linebot import LineBotApi, WebhookHandler
+    from linebot import LineBotApi, WebhookParser
     from linebot.exceptions import InvalidSignatureError
     from linebot.models import MessageEvent, TextMessage, TextSendMessage
     LINE_BOT_AVAILABLE = True
@@ -16,12 +21,26 @@ except ImportError:
     print("⚠️ LINE Bot SDKが利用できません。テストモードで動作します。")
     LINE_BOT_AVAILABLE = False
 
+# process_command が処理するコマンド（これ以外のメッセージはAI質問として OpenAI に送られる）
+COMMAND_KEYWORDS = frozenset([
+    '1', '2', '3', '4',
+    'help', 'ヘルプ', 'progress', '進捗', 'stats', '統計', 'weak', '苦手', 'level', 'レベル',
+    'lesson', 'レッスン', 'quiz', 'クイズ', 'review', '復習', 'motivation', 'モチベーション',
+    'premium', 'プレミアム', 'plan', 'プラン',
+])
+
+# 検索コマンド（「検索 トーン」「search few-shot」のように検索語を続ける）
+SEARCH_COMMANDS = ('検索', 'search')
+
+# OpenAI API のタイムアウト（秒）。応答が遅い場合もワーカーを占有し続けない
+OPENAI_TIMEOUT_SECONDS = int(os.getenv('OPENAI_TIMEOUT_SECONDS', 20))
+
 class LineBotHandler:
     def __init__(self):
         if not LINE_BOT_AVAILABLE:
             print("⚠️ LINE Bot SDKが利用できないため、テストモードで動作します", flush=True)
             self.line_bot_api = None
-            self.handler = None
+            self.parser = None
             self.channel_access_token = "dummy_token"
             self.channel_secret = "dummy_secret"
         else:
@@ -33,11 +52,11 @@ class LineBotHandler:
                 print("⚠️ 環境変数が設定されていないため、テストモードで動作します", flush=True)
             try:
                 self.line_bot_api = LineBotApi(self.channel_access_token)
-                self.handler = WebhookHandler(self.channel_secret)
+                self.parser = WebhookParser(self.channel_secret)
             except Exception as e:
                 print(f"⚠️ LINE Bot API初期化エラー: {e}", flush=True)
                 self.line_bot_api = None
-                self.handler = None
+                self.parser = None
         
         # 各マネージャーを初期化
         self.db = LearningDatabase()
@@ -55,8 +74,12 @@ class LineBotHandler:
         else:
             print("⚠️ OpenAI APIキーが設定されていません")
         
-        # イベントハンドラーを設定
-        self.setup_handlers()
+        # Webhookのイベントはワーカースレッドで処理する（/callback はすぐに応答を返す）
+        self.dispatcher = WebhookDispatcher()
+        # LINEの再送で同じイベントを二重に処理しない（質問枠の二重消費・OpenAIの二重呼び出しを防ぐ）
+        self.event_deduplicator = WebhookEventDeduplicator(self.db)
+        # 同じ質問への回答を再利用する（質問枠の消費は通常どおり）
+        self.answer_cache = AIAnswerCache(self.db)
         
         print(f"LINE_CHANNEL_ACCESS_TOKEN: {self.channel_access_token}", flush=True)
         print(f"LINE_CHANNEL_SECRET: {self.channel_secret}", flush=True)
@@ -132,45 +155,19 @@ class LineBotHandler:
             
             print(f"📤 既存ユーザー {len(all_users)}人に起動通知を送信中...", flush=True)
             
-            # 各ユーザーに起動通知を送信
-            for user_id in all_users:
-                try:
-                    notification_data = {
-                        "to": user_id,
-                        "messages": [
-                            {
-                                "type": "text",
-                                "text": "🔄 プロンプトエンジニアリング学習Botが再起動しました！\n\n学習スケジュールは継続されます。\n\n今夜20時の学習メッセージをお楽しみに！"
-                            }
-                        ]
-                    }
-                    
-                    response = requests.post("https://api.line.me/v2/bot/message/push", 
-                                          headers=headers, json=notification_data)
-                    
-                    if response.status_code == 200:
-                        print(f"✅ ユーザー {user_id} に起動通知を送信しました", flush=True)
-                    else:
-                        print(f"⚠️ ユーザー {user_id} への起動通知送信に失敗: {response.status_code}", flush=True)
-                        
-                except Exception as e:
-                    print(f"❌ ユーザー {user_id} への起動通知送信エラー: {e}", flush=True)
-                    continue
+            # 全員に同じ内容のため、500人ずつのマルチキャストにまとめて送信
+            notification = "🔄 プロンプトエンジニアリング学習Botが再起動しました！\n\n学習スケジュールは継続されます。\n\n今夜20時の学習メッセージをお楽しみに！"
+            with PushSession(channel_access_token) as push_session:
+                results = push_session.push_many([(user_id, [notification]) for user_id in all_users])
             
-            print(f"✅ 起動通知の送信が完了しました（対象: {len(all_users)}人）", flush=True)
+            sent_count = sum(results.values())
+            print(f"✅ 起動通知の送信が完了しました（対象: {len(all_users)}人, 成功: {sent_count}人, 失敗: {len(all_users) - sent_count}人）", flush=True)
             
         except Exception as e:
             print(f"❌ 起動通知送信エラー: {e}", flush=True)
     
-    def setup_handlers(self):
-        """イベントハンドラーを設定"""
-        if self.handler is not None:
-            @self.handler.add(MessageEvent, message=TextMessage)
-            def handle_message(event):
-                self.handle_text_message(event)
-    
     def handle_text_message(self, event):
-        """テキストメッセージを処理"""
+        """テキストメッセージを処理（ディスパッチャーのワーカースレッドで呼ばれる）"""
         if self.line_bot_api is None:
             print("📱 [テストモード] メッセージ受信: LINE Bot機能は無効化されています")
             return
@@ -182,24 +179,53 @@ class LineBotHandler:
         print(f"📱 メッセージ受信 - ユーザーID: {user_id}, メッセージ: {message_text}")
         
         # ユーザーが存在しない場合は追加
-        if not self.db.get_user_level(user_id):
+        user_level = self.db.get_user_level(user_id)
+        if not user_level:
             print(f"新規ユーザー検出: {user_id}")
-            self.db.add_user(user_id)
+            user_level = "beginner"
+            self.db.add_user(user_id, user_level)
         else:
             print(f"既存ユーザー: {user_id}")
         
-        # コマンド処理
-        response = self.process_command(user_id, message_text)
+        # コマンド処理（取得済みのレベルを渡し、AI質問の処理で再検索しない）
+        response = self.process_command(user_id, message_text, user_level=user_level)
         
         # レスポンスを送信
         if response:
-            self.line_bot_api.reply_message(
-                event.reply_token,
-                TextSendMessage(text=response)
-            )
+            try:
+                self.line_bot_api.reply_message(
+                    event.reply_token,
+                    TextSendMessage(text=response)
+                )
+            except Exception as e:
+                # 処理待ちの間に返信トークンの期限が切れた場合などはプッシュで送る
+                print(f"⚠️ 返信に失敗したためプッシュで送信します: {user_id} - {e}")
+                self.push_message(user_id, response)
     
-    def process_command(self, user_id, message_text):
-        """コマンドを処理"""
+    def is_ai_question(self, message_text):
+        """process_command でAI質問として扱われる（OpenAI を呼ぶ可能性がある）メッセージか"""
+        original_text = message_text.strip()
+        if self.parse_search_query(original_text) is not None:
+            return False
+        return original_text.lower() not in COMMAND_KEYWORDS and original_text not in COMMAND_KEYWORDS
+    
+    @staticmethod
+    def parse_search_query(message_text):
+        """検索コマンドなら検索語を返す（検索コマンドでなければNone）
+
+        コマンドの直後が空白（全角を含む）かメッセージの終わりの場合だけ検索コマンドとして扱う。
+        「検索結果がおかしいのはなぜ？」「searching」のように別の語の一部であればAI質問として扱う。
+        """
+        for command in SEARCH_COMMANDS:
+            if message_text.lower().startswith(command):
+                rest = message_text[len(command):]
+                if rest and not rest[0].isspace():
+                    continue
+                return rest.strip()
+        return None
+    
+    def process_command(self, user_id, message_text, user_level=None):
+        """コマンドを処理（user_levelを渡せばAI質問の処理で再検索しない）"""
         original_text = message_text.strip()
         message_text = message_text.strip().lower()
         
@@ -241,9 +267,12 @@ class LineBotHandler:
         elif message_text == 'plan' or original_text == 'プラン':
             return self.get_plan_info(user_id)
         
+        elif self.parse_search_query(original_text) is not None:
+            return self.learning_manager.get_search_message(self.parse_search_query(original_text))
+        
         else:
             # AI質問回答機能
-            return self.handle_ai_question(user_id, original_text)
+            return self.handle_ai_question(user_id, original_text, user_level=user_level)
     
     def get_help_message(self):
         """ヘルプメッセージを取得"""
@@ -257,6 +286,7 @@ class LineBotHandler:
         message += "📚 苦手 - 苦手分野を確認\n"
         message += "🎯 レベル - 現在のレベルを確認\n"
         message += "💪 モチベーション - 励ましメッセージ\n"
+        message += "🔎 検索 ○○ - レッスンを検索（質問回数を使いません）\n"
         message += "❓ ヘルプ - このメッセージを表示\n\n"
         message += "🤖 AI質問機能：\n"
         message += "プロンプトエンジニアリングに関する質問を自由にしてください！\n"
@@ -267,28 +297,11 @@ class LineBotHandler:
         
         return message
     
-    def check_question_limit(self, user_id):
-        """質問回数制限をチェック"""
-        try:
-            # 今日の質問回数を取得
-            today = datetime.now().date()
-            daily_count = self.db.get_daily_question_count(user_id, today)
-            
-            # ユーザーのサブスクリプション状態を取得
-            subscription = self.db.get_user_subscription(user_id)
-            user_plan = subscription['plan_type']
-            question_limit = self.db.get_question_limit_for_user(user_id)
-            
-            if daily_count >= question_limit:
-                if user_plan == "free":
-                    return False, f"❌ 無料プランは1日{question_limit}回までです。\n\n💎 プレミアムプランなら1日10回まで質問可能！\n「プレミアム」と送信してアップグレードしませんか？"
-                else:
-                    return False, f"❌ 本日の質問上限（{question_limit}回）に達しました。\n\n明日またお試しください！"
-            
-            return True, None
-        except Exception as e:
-            print(f"質問制限チェックエラー: {e}")
-            return True, None
+    def get_question_limit_message(self, user_plan, question_limit):
+        """質問上限に達したときのメッセージを取得"""
+        if user_plan == "free":
+            return f"❌ 無料プランは1日{question_limit}回までです。\n\n💎 プレミアムプランなら1日10回まで質問可能！\n「プレミアム」と送信してアップグレードしませんか？"
+        return f"❌ 本日の質問上限（{question_limit}回）に達しました。\n\n明日またお試しください！"
     
     def is_appropriate_question(self, question):
         """質問内容が適切かチェック"""
@@ -305,36 +318,37 @@ class LineBotHandler:
         
         return True
     
-    def handle_ai_question(self, user_id, question):
-        """AI質問回答機能"""
+    def handle_ai_question(self, user_id, question, user_level=None):
+        """AI質問回答機能（user_levelを渡せば回答キャッシュのためにレベルを再検索しない）"""
         try:
-            # 質問制限チェック
-            can_ask, limit_message = self.check_question_limit(user_id)
-            if not can_ask:
-                return limit_message
-            
             # 不適切な質問チェック
             if not self.is_appropriate_question(question):
                 return "❌ 申し訳ございませんが、その質問にはお答えできません。\n\nプロンプトエンジニアリングやAI活用に関する質問にお答えします。"
             
+            # レッスンの内容で答えられる質問は OpenAI を呼ばずに答える（質問枠も使わない）
+            matches = self.learning_manager.content_store.retrieve_lessons(question)
+            if matches and matches[0][1] >= RETRIEVAL_ANSWER_THRESHOLD:
+                print(f"📚 レッスンで回答: {matches[0][0]['title']}（類似度 {matches[0][1]:.2f}）")
+                return self.get_lesson_answer_message(matches[0][0])
+            
             # OpenAI APIが利用可能かチェック
             if not self.openai_api_key:
                 return "❌ AI回答機能は現在利用できません。\n\nプロンプトエンジニアリングに関する質問は、学習コンテンツで確認してください。"
             
-            # 記録前の質問回数を取得
-            current_count = self.db.get_daily_question_count(user_id, datetime.now().date())
-            print(f"🔍 デバッグ: 記録前の質問回数 = {current_count}")
+            # プランの確認と質問枠の消費を1トランザクションで行う（OpenAI の前のDBアクセスはこの1回）
+            consumed, used_count, subscription = self.db.try_consume_question(user_id)
+            if not consumed:
+                question_limit = self.db.get_question_limit_for_user(user_id, subscription)
+                return self.get_question_limit_message(subscription['plan_type'], question_limit)
             
-            # 質問回数を記録
+            # 質問履歴を記録（書き込みキュー経由）
             self.db.record_question_asked(user_id)
-            print(f"🔍 デバッグ: 質問を記録しました")
-            
-            # 記録後の質問回数を確認
-            after_count = self.db.get_daily_question_count(user_id, datetime.now().date())
-            print(f"🔍 デバッグ: 記録後の質問回数 = {after_count}")
             
-            # AI回答を生成（記録前の回数を使用）
-            response = self.generate_ai_response(user_id, question, current_count)
+            # AI回答を生成（今回の質問を含まない回数を渡す）
+            response = self.generate_ai_response(
+                user_id, question, used_count - 1, subscription=subscription,
+                context_lessons=[lesson for lesson, _ in matches], user_level=user_level
+            )
             
             return response
             
@@ -342,42 +356,31 @@ class LineBotHandler:
             print(f"AI質問処理エラー: {e}")
             return "❌ 申し訳ございませんが、回答の生成中にエラーが発生しました。\n\nしばらく時間をおいてから再度お試しください。"
     
-    def generate_ai_response(self, user_id, question, current_count):
-        """AI回答を生成"""
-        try:
-            # プロンプトエンジニアリングに特化したシステムプロンプト
-            system_prompt = """あなたはプロンプトエンジニアリングの専門家です。
-以下のガイドラインに従って回答してください：
-
-1. プロンプトエンジニアリングやAI活用に関する質問に専門的に回答
-2. 実践的で具体的な例を交えて説明
-3. 日本語で丁寧に回答
-4. 学習者のレベルに合わせた説明
-5. 不適切な内容には回答しない
-
-質問："""
+    def get_lesson_answer_message(self, lesson):
+        """質問に近いレッスンの内容で答えるメッセージ"""
+        message = "📚 学習レッスンの内容でお答えします（AI質問の回数は使っていません）\n\n"
+        message += self.learning_manager.format_lesson_message(lesson)
+        return message
+    
+    def generate_ai_response(self, user_id, question, current_count, subscription=None, context_lessons=None, user_level=None):
+        """AI回答を生成（subscription・user_levelを渡せば再検索しない）
 
-            # OpenAI APIで回答を生成
-            response = openai.ChatCompletion.create(
-                model="gpt-3.5-turbo",
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": question}
-                ],
-                max_tokens=500,
-                temperature=0.7
-            )
-            
-            ai_response = response.choices[0].message.content.strip()
+        同じレベルのユーザーが同じ質問をした場合はキャッシュした回答を返す。
+        context_lessons を渡した場合は、質問に近いレッスンの要点を参考情報として OpenAI に渡す。
+        """
+        try:
+            level = user_level or self.db.get_user_level(user_id) or "beginner"
+            ai_response = self.answer_cache.get(question, level)
+            if ai_response is None:
+                ai_response = self.request_ai_answer(question, level, context_lessons)
             
             # 回答に制限情報を追加（記録前の回数を使用）
-            question_limit = self.db.get_question_limit_for_user(user_id)
+            if subscription is None:
+                subscription = self.db.get_user_subscription(user_id)
+            question_limit = self.db.get_question_limit_for_user(user_id, subscription)
             remaining = max(0, question_limit - (current_count + 1))  # +1は今回の質問
-            subscription = self.db.get_user_subscription(user_id)
             plan_name = "プレミアム" if subscription['plan_type'] == 'premium' else "無料"
-            
-            print(f"🔍 デバッグ: 計算された残り回数 = {remaining} (current_count={current_count})")
-            
+
             response_with_info = f"🤖 AI回答：\n\n{ai_response}\n\n---\n📊 今日の質問残り回数: {remaining}回（{plan_name}プラン）"
             
             return response_with_info
@@ -386,6 +389,45 @@ class LineBotHandler:
             print(f"AI回答生成エラー: {e}")
             return "❌ AI回答の生成に失敗しました。\n\nプロンプトエンジニアリングに関する質問は、学習コンテンツで確認してください。"
     
+    def request_ai_answer(self, question, level, context_lessons=None):
+        """OpenAI APIで回答を生成してキャッシュに保存"""
+        # プロンプトエンジニアリングに特化したシステムプロンプト
+        system_prompt = """あなたはプロンプトエンジニアリングの専門家です。
+以下のガイドラインに従って回答してください：
+
+1. プロンプトエンジニアリングやAI活用に関する質問に専門的に回答
+2. 実践的で具体的な例を交えて説明
+3. 日本語で丁寧に回答
+4. 学習者のレベルに合わせた説明
+5. 不適切な内容には回答しない
+
+質問："""
+
+        messages = [{"role": "system", "content": system_prompt}]
+        if context_lessons:
+            reference = "\n".join(
+                f"- {lesson['title']}: {lesson.get('content', '')}" for lesson in context_lessons
+            )
+            messages.append({
+                "role": "system",
+                "content": f"参考：この学習Botのレッスンのうち質問に近いもの（関係があれば回答に活かしてください）\n{reference}"
+            })
+        messages.append({"role": "user", "content": question})
+
+        start = time.perf_counter()
+        # OpenAI APIで回答を生成
+        response = openai.ChatCompletion.create(
+            model="gpt-3.5-turbo",
+            messages=messages,
+            max_tokens=500,
+            temperature=0.7,
+            request_timeout=OPENAI_TIMEOUT_SECONDS
+        )
+        
+        ai_response = response.choices[0].message.content.strip()
+        self.answer_cache.put(question, level, ai_response, generation_seconds=time.perf_counter() - start)
+        return ai_response
+    
     def get_level_message(self, user_id):
         """レベル情報メッセージを取得"""
         user_level = self.db.get_user_level(user_id)
@@ -462,7 +504,7 @@ class LineBotHandler:
         subscription = self.db.get_user_subscription(user_id)
         today = datetime.now().date()
         daily_count = self.db.get_daily_question_count(user_id, today)
-        question_limit = self.db.get_question_limit_for_user(user_id)
+        question_limit = self.db.get_question_limit_for_user(user_id, subscription)
         
         if subscription['plan_type'] == 'premium' and subscription['status'] == 'active':
             expires_at = subscription['expires_at']
@@ -487,15 +529,22 @@ class LineBotHandler:
         base_url = os.getenv('APP_URL', 'https://your-app.com')
         return f"{base_url}/stripe/checkout?user_id={user_id}"
     
-    def push_message(self, user_id, message):
-        """プッシュメッセージを送信"""
+    def push_message(self, user_id, message, retry_key=None):
+        """プッシュメッセージを送信
+
+        retry_keyを指定すると X-Line-Retry-Key を付けて送信し、
+        同じキーで受付済み（409）の場合は送信済みとして成功扱いにする。
+        """
         if self.line_bot_api is None:
             print(f"📱 [テストモード] ユーザー {user_id} にメッセージを送信: {message[:50]}...")
             return True
         try:
-            self.line_bot_api.push_message(user_id, TextSendMessage(text=message))
+            self.line_bot_api.push_message(user_id, TextSendMessage(text=message), retry_key=retry_key)
             return True
         except Exception as e:
+            if retry_key and getattr(e, 'status_code', None) == 409:
+                print(f"ℹ️ ユーザー {user_id} へは同じ再送キーで送信済みです: {retry_key}")
+                return True
             print(f"❌ ユーザー {user_id} へのプッシュメッセージ送信エラー: {e}")
             print(f"📝 エラータイプ: {type(e).__name__}")
             # LINE APIエラーの詳細を出力
@@ -505,6 +554,29 @@ class LineBotHandler:
                 print(f"📝 エラー詳細: {e.error}")
             return False
     
+    def multicast_message(self, user_ids, message):
+        """複数ユーザー（最大500人）に同じメッセージをマルチキャスト送信"""
+        if self.line_bot_api is None:
+            print(f"📱 [テストモード] {len(user_ids)}人にマルチキャスト送信: {message[:50]}...")
+            return True
+        try:
+            self.line_bot_api.multicast(list(user_ids), TextSendMessage(text=message))
+            return True
+        except Exception as e:
+            print(f"❌ マルチキャスト送信エラー（{len(user_ids)}人）: {e}")
+            if hasattr(e, 'status_code'):
+                print(f"📊 ステータスコード: {e.status_code}")
+            return False
+    
+    def create_push_session(self):
+        """呼び出し元スレッドのイベントループで使う非同期プッシュ送信セッションを作成
+
+        テストモード（LINE Bot APIが無効）の場合はNoneを返す。
+        """
+        if self.line_bot_api is None or self.channel_access_token == "dummy_token":
+            return None
+        return PushSession(self.channel_access_token)
+    
     def broadcast_message(self, message):
         """ブロードキャストメッセージを送信"""
         if self.line_bot_api is None:
@@ -532,13 +604,20 @@ class LineBotHandler:
             return None
     
     def handle_webhook(self, body, signature):
-        """Webhookを処理"""
-        if self.handler is None:
+        """Webhookを処理
+
+        署名を検証してイベントを解析し、ディスパッチャーの処理待ちに積んだらすぐに戻る。
+        返信はワーカースレッドが送る。
+
+        Raises:
+            DispatcherFullError: 処理待ちのイベントが上限に達している場合
+        """
+        if self.parser is None:
             print("📱 [テストモード] Webhook処理: LINE Bot機能は無効化されています")
             return True
         try:
             print("Webhook受信: body=", body)
-            self.handler.handle(body, signature)
+            events = self.parser.parse(body, signature)
         except InvalidSignatureError:
             print("Invalid signature")
             return False
@@ -546,4 +625,40 @@ class LineBotHandler:
             print(f"Webhook処理エラー: {e}")
             return False
         
+        events = [
+            event for event in events
+            if isinstance(event, MessageEvent) and isinstance(event.message, TextMessage)
+        ]
+        
+        # 再送された（処理済みの）イベントはDB・APIの処理より前に捨てる
+        event_ids = [event.webhook_event_id for event in events if getattr(event, 'webhook_event_id', None)]
+        redeliveries = sum(
+            1 for event in events
+            if getattr(getattr(event, 'delivery_context', None), 'is_redelivery', False)
+        )
+        new_ids = self.event_deduplicator.filter_new(event_ids, redeliveries=redeliveries) if event_ids else set()
+        unprocessed = set(new_ids)
+        fresh_events = []
+        for event in events:
+            event_id = getattr(event, 'webhook_event_id', None)
+            if event_id:
+                if event_id not in unprocessed:
+                    continue
+                unprocessed.discard(event_id)
+            fresh_events.append(event)
+        if len(fresh_events) < len(events):
+            print(f"⏭️ 重複したWebhookイベントを {len(events) - len(fresh_events)}件スキップしました")
+        events = fresh_events
+        
+        tasks = []
+        for event in events:
+            lane = LANE_AI if self.is_ai_question(event.message.text) else LANE_DEFAULT
+            tasks.append((event.source.user_id, lane, self.handle_text_message, (event,)))
+        if tasks:
+            try:
+                self.dispatcher.submit_many(tasks)
+            except DispatcherFullError:
+                # 受け付けなかったイベントは再送時に処理できるよう記録から外す
+                self.event_deduplicator.forget(new_ids)
+                raise
         return True 
\ No newline at end of file
@@ -0,0 +1,207 @@
+import asyncio
+import uuid
+
+import aiohttp
+
+LINE_API_BASE_URL = "https://api.line.me"
+PUSH_ENDPOINT = "/v2/bot/message/push"
+MULTICAST_ENDPOINT = "/v2/bot/message/multicast"
+RETRY_KEY_HEADER = "X-Line-Retry-Key"
+
+# 1回のプッシュで送れるメッセージ数の上限（Messaging APIの仕様）
+MAX_MESSAGES_PER_PUSH = 5
+
+# 1回のマルチキャストで送れる宛先数の上限（Messaging APIの仕様）
+MAX_MULTICAST_RECIPIENTS = 500
+
+DEFAULT_MAX_CONNECTIONS = 100
+DEFAULT_TIMEOUT_SECONDS = 10
+KEEPALIVE_TIMEOUT_SECONDS = 60
+
+
+def text_messages(texts):
+    """テキストのリストを Messaging API のメッセージオブジェクトに変換"""
+    return [{"type": "text", "text": text} for text in texts]
+
+
+def request_retry_key(retry_key, index):
+    """1つの配信を複数リクエストに分けて送る場合の、リクエストごとの再送キー
+
+    再送キーはリクエストごとに一意である必要があるため、元のキーとリクエスト番号から
+    決定的に導出する（再送時も同じキーになる）。
+    """
+    if not retry_key or index == 0:
+        return retry_key
+    return str(uuid.uuid5(uuid.UUID(retry_key), str(index)))
+
+
+def plan_deliveries(items):
+    """同じ内容のメッセージをまとめて送信単位に分ける
+
+    同じテキストを受け取るユーザーが2人以上いる場合は
+    最大500人ずつのマルチキャストに、それ以外は個別のプッシュにする。
+
+    Args:
+        items: (user_id, [text, ...]) のリスト
+
+    Returns:
+        (宛先user_idのリスト, テキストのタプル, マルチキャストかどうか) のリスト
+    """
+    recipients_by_texts = {}
+    for user_id, texts in items:
+        recipients_by_texts.setdefault(tuple(texts), []).append(user_id)
+
+    deliveries = []
+    for texts, user_ids in recipients_by_texts.items():
+        if len(user_ids) == 1:
+            deliveries.append((user_ids, texts, False))
+            continue
+        for start in range(0, len(user_ids), MAX_MULTICAST_RECIPIENTS):
+            deliveries.append((user_ids[start:start + MAX_MULTICAST_RECIPIENTS], texts, True))
+    return deliveries
+
+
+class AsyncLinePushClient:
+    """aiohttp で Messaging API にプッシュ送信する非同期クライアント
+
+    1つの ClientSession（keep-alive のコネクションプール）を使い回し、
+    ユーザーごとに TLS ハンドシェイクをやり直さずに多数のプッシュを並行送信する。
+    セッションは最初に使ったイベントループに紐づくため、同じループ内で使うこと。
+    """
+
+    def __init__(self, channel_access_token, base_url=LINE_API_BASE_URL,
+                 max_connections=DEFAULT_MAX_CONNECTIONS, timeout=DEFAULT_TIMEOUT_SECONDS):
+        self.channel_access_token = channel_access_token
+        self.base_url = base_url.rstrip('/')
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.session = None
+
+    async def _get_session(self):
+        """コネクションプール付きのセッションを取得（初回のみ作成）"""
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.max_connections,
+                keepalive_timeout=KEEPALIVE_TIMEOUT_SECONDS,
+            )
+            self.session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                headers={
+                    "Content-Type": "application/json",
+                    "Authorization": f"Bearer {self.channel_access_token}",
+                },
+            )
+        return self.session
+
+    async def _post(self, endpoint, payload, target, retry_key=None):
+        """Messaging APIにPOSTして成功可否を返す
+
+        retry_keyを指定すると X-Line-Retry-Key ヘッダーを付ける。
+        同じキーのリクエストが既に受け付けられている場合（409）は送信済みとして成功扱いにする。
+        """
+        session = await self._get_session()
+        headers = {RETRY_KEY_HEADER: retry_key} if retry_key else None
+        try:
+            async with session.post(self.base_url + endpoint, json=payload, headers=headers) as response:
+                if response.status == 200:
+                    return True
+                if response.status == 409 and retry_key:
+                    print(f"ℹ️ {target} は同じ再送キーで送信済みです: {retry_key}")
+                    return True
+                body = await response.text()
+                print(f"❌ {target} への送信失敗: {response.status} - {body[:200]}")
+                return False
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f"❌ {target} への送信エラー: {type(e).__name__}: {e}")
+            return False
+
+    async def push(self, user_id, texts, retry_key=None):
+        """1ユーザーにテキストメッセージ（最大5件）をプッシュ送信"""
+        payload = {"to": user_id, "messages": text_messages(list(texts)[:MAX_MESSAGES_PER_PUSH])}
+        return await self._post(PUSH_ENDPOINT, payload, f"ユーザー {user_id}", retry_key=retry_key)
+
+    async def multicast(self, user_ids, texts):
+        """最大500人に同じテキストメッセージ（最大5件）をマルチキャスト送信
+
+        失敗はリクエスト単位のため、失敗した場合は宛先全員を失敗として扱う。
+        """
+        payload = {
+            "to": list(user_ids)[:MAX_MULTICAST_RECIPIENTS],
+            "messages": text_messages(list(texts)[:MAX_MESSAGES_PER_PUSH]),
+        }
+        return await self._post(MULTICAST_ENDPOINT, payload, f"マルチキャスト（{len(payload['to'])}人）")
+
+    async def push_many(self, items, concurrency=DEFAULT_MAX_CONNECTIONS, limiter=None, multicast_limiter=None,
+                        retry_keys=None):
+        """複数ユーザーに並行して送信（同じ内容はマルチキャストにまとめる）
+
+        Args:
+            items: (user_id, [text, ...]) のリスト
+            concurrency: 同時リクエスト数の上限
+            limiter: acquire_async() を持つプッシュのレート制限（1リクエストにつき1トークン）
+            multicast_limiter: マルチキャストのレート制限（Noneの場合は limiter を使う）
+            retry_keys: {user_id: 再送キー}。個別プッシュの X-Line-Retry-Key に使う
+                （マルチキャストは再送時に宛先の組み合わせが変わるため付けない）
+
+        Returns:
+            {user_id: 成功可否} の辞書（マルチキャストの宛先もユーザーごとに記録）
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+        multicast_limiter = multicast_limiter or limiter
+        retry_keys = retry_keys or {}
+
+        async def send(user_ids, texts, is_multicast):
+            async with semaphore:
+                request_limiter = multicast_limiter if is_multicast else limiter
+                if request_limiter is not None:
+                    await request_limiter.acquire_async()
+                if is_multicast:
+                    success = await self.multicast(user_ids, texts)
+                else:
+                    success = await self.push(user_ids[0], texts, retry_key=retry_keys.get(user_ids[0]))
+                return [(user_id, success) for user_id in user_ids]
+
+        results = await asyncio.gather(*(send(*delivery) for delivery in plan_deliveries(items)))
+        return {user_id: success for outcomes in results for user_id, success in outcomes}
+
+    async def close(self):
+        """セッションを閉じてコネクションプールを解放"""
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+
+class PushSession:
+    """呼び出し元スレッドのイベントループで AsyncLinePushClient を使う同期ラッパー
+
+    スケジューラーのスレッドで1つ作成して使い回すと、
+    ジョブをまたいでコネクションプールが維持される。
+    """
+
+    def __init__(self, channel_access_token, **client_options):
+        self.loop = asyncio.new_event_loop()
+        self.client = AsyncLinePushClient(channel_access_token, **client_options)
+
+    def push_many(self, items, concurrency=DEFAULT_MAX_CONNECTIONS, limiter=None, multicast_limiter=None,
+                  retry_keys=None):
+        """イベントループ上で並行送信し、{user_id: 成功可否} を返す"""
+        return self.loop.run_until_complete(
+            self.client.push_many(
+                items, concurrency=concurrency, limiter=limiter,
+                multicast_limiter=multicast_limiter, retry_keys=retry_keys
+            )
+        )
+
+    def close(self):
+        """クライアントとイベントループを閉じる"""
+        if self.loop.is_closed():
+            return
+        self.loop.run_until_complete(self.client.close())
+        self.loop.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
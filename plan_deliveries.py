@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+"""
+配信計画の作成（コマンドライン用）
+アプリのプロセスの外で、レッスンの選択・整形を LESSON_RENDER_PROCESSES のプロセスで並列に計算し、
+指定日（省略時は翌日）の配信計画を保存する。スケジューラーの配信計画ジョブ（23:30）より前に
+実行しておくと、ジョブは計画済みのユーザーを作り直さない。
+
+使い方: python plan_deliveries.py [YYYY-MM-DD]
+"""
+
+import os
+import sys
+from datetime import datetime, timedelta
+
+sys.path.append(os.path.dirname(__file__))
+
+from learning_content import LearningContentManager
+from scheduler import LESSON_RENDER_PROCESSES, create_delivery_plans
+
+
+def run(plan_date):
+    manager = LearningContentManager()
+    users = manager.db.get_all_users()
+    print(f"🗓️ 配信計画作成開始: {plan_date} - 対象ユーザー数: {len(users)}（{LESSON_RENDER_PROCESSES}プロセス）")
+    planned_count = create_delivery_plans(manager.db, manager, users, plan_date, processes=LESSON_RENDER_PROCESSES)
+    print(f"✅ 配信計画作成完了: {planned_count}件作成")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        target_date = datetime.strptime(sys.argv[1], '%Y-%m-%d').date()
+    else:
+        target_date = (datetime.now() + timedelta(days=1)).date()
+    run(target_date)
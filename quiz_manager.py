@@ -1,7 +1,7 @@
-import json
 import random
 from datetime import datetime, timedelta
 from database import LearningDatabase
+from content_store import get_content_store
 
 class QuizManager:
     def __init__(self, quiz_data_path="data/quiz_data.json"):
@@ -10,21 +10,13 @@ class QuizManager:
         self.load_quiz_data()
     
     def load_quiz_data(self):
-        """クイズデータを読み込み"""
-        try:
-            with open(self.quiz_data_path, 'r', encoding='utf-8') as f:
-                self.quiz_data = json.load(f)
-        except FileNotFoundError:
-            print(f"クイズデータファイルが見つかりません: {self.quiz_data_path}")
-            self.quiz_data = {"beginner_quiz": [], "intermediate_quiz": [], "advanced_quiz": []}
+        """クイズデータを共有コンテンツストアから取得（JSONの読み込みはプロセス内で一度だけ）"""
+        self.content_store = get_content_store(quiz_data_path=self.quiz_data_path)
+        self.quiz_data = self.content_store.quiz_data
     
     def get_quiz_by_id(self, quiz_id):
-        """IDでクイズを取得"""
-        for level_quizzes in self.quiz_data.values():
-            for quiz in level_quizzes:
-                if quiz['id'] == quiz_id:
-                    return quiz
-        return None
+        """IDでクイズを取得（コンテンツストアの索引を使うO(1)検索）"""
+        return self.content_store.get_quiz(quiz_id)
     
     def get_weekly_quiz(self, user_id):
         """ユーザーのレベルに応じた週間クイズを取得し、出題IDを保存"""
@@ -87,12 +79,13 @@ class QuizManager:
         quiz = self.get_quiz_by_id(quiz_id) if quiz_id else None
         if not quiz:
             return "❌ 有効なクイズが見つかりません。再度クイズを受けてください。"
-        # 結果を記録
+        # 結果を記録（直後に昇格判定で読むためコミット完了まで待つ）
         self.db.record_quiz_result(
             user_id, 
             quiz['id'], 
             user_answer, 
-            quiz['correct_answer']
+            quiz['correct_answer'],
+            sync=True
         )
         # 結果メッセージを作成
         is_correct = user_answer == quiz['correct_answer']
@@ -106,7 +99,7 @@ class QuizManager:
             user_level = self.db.get_user_level(user_id)
             if user_level == "beginner":
                 # 初級クイズ（bqで始まる）の正解数をチェック
-                stats = self.db.get_quiz_statistics_by_level(user_id, 'bq', days=365)
+                stats = self.db.get_quiz_statistics_by_level(user_id, 'bq')
                 if stats:
                     total_quizzes, correct_answers, _ = stats
                     if correct_answers >= 10:
@@ -116,7 +109,7 @@ class QuizManager:
                             line_bot.push_message(user_id, f"🎉 おめでとうございます！初級テスト{correct_answers}回正解達成で中級レベルに昇格しました！")
             elif user_level == "intermediate":
                 # 中級クイズ（iqで始まる）の正解数をチェック
-                stats = self.db.get_quiz_statistics_by_level(user_id, 'iq', days=365)
+                stats = self.db.get_quiz_statistics_by_level(user_id, 'iq')
                 if stats:
                     total_quizzes, correct_answers, _ = stats
                     if correct_answers >= 10:
@@ -1,43 +1,426 @@
-import schedule
+import job_scheduler as schedule
+import asyncio
+import hashlib
+import itertools
+import json
+import os
+import socket
 import time
 import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 from line_bot import LineBotHandler
+from line_push_client import plan_deliveries, request_retry_key
 from database import LearningDatabase
 from learning_content import LearningContentManager
 from quiz_manager import QuizManager
 import sqlite3
 
+# このスケジューラーが登録するジョブのタグ（再登録時にまとめて消す）
+SCHEDULE_TAG = "learning_scheduler"
+
+# リーダー選出のリース名と有効期間（秒）
+# リーダーが落ちてから LEADER_LEASE_TTL_SECONDS 秒程度でほかのプロセスが引き継ぐ
+LEADER_LEASE_NAME = "learning_scheduler"
+LEADER_LEASE_TTL_SECONDS = 15
+
+# 既定のジョブ定義 (name, handler, day_of_week, at_time)
+# 初回起動時に scheduled_jobs へ登録し、以降は管理画面から変更できる（day_of_week が None なら毎日）
+DEFAULT_JOB_DEFINITIONS = [
+    ("send_inactive_user_reengagement", "send_inactive_user_reengagement", "monday", "09:00"),
+    ("plan_next_day_deliveries", "plan_next_day_deliveries", None, "23:30"),
+    ("send_morning_lesson", "send_morning_lesson", None, "10:00"),
+    ("send_afternoon_lesson", "send_afternoon_lesson", None, "15:00"),
+    ("send_evening_lesson", "send_evening_lesson", None, "20:00"),
+    ("send_weekly_quiz", "send_weekly_quiz", "sunday", "20:00"),
+    ("send_weekly_summary", "send_weekly_summary", "saturday", "21:00"),
+    ("send_review_reminder", "send_review_reminder", "wednesday", "19:00"),
+]
+
+# ジョブ定義から呼び出せるメソッド
+JOB_HANDLERS = tuple(sorted({handler for _, handler, _, _ in DEFAULT_JOB_DEFINITIONS}))
+
+# 起動時（リーダー就任時）に実行し直す、停止中に過ぎた予定の猶予時間（分）
+# 予定時刻からこの時間以内であれば1回だけ実行し、それより古い予定は実行しない
+JOB_CATCHUP_GRACE_MINUTES = int(os.getenv('JOB_CATCHUP_GRACE_MINUTES', 120))
+
+# ジョブがない・待機中の場合も、ハートビートログのためにこの秒数ごとに起きる
+SCHEDULER_HEARTBEAT_SECONDS = 600
+
+# stop() が実行中のジョブの終了を待つ最大秒数（過ぎた場合はジョブの終了後にループが止まる）
+SCHEDULER_STOP_TIMEOUT_SECONDS = 30
+
+# 毎日の学習メッセージの配信枠（配信計画のキー）
+DELIVERY_SLOTS = ("morning", "afternoon", "evening")
+
+# 配信枠ごとの送信ジョブ（配信枠の開始時刻はこのジョブの定義の時刻）
+DELIVERY_SLOT_HANDLERS = {
+    "morning": "send_morning_lesson",
+    "afternoon": "send_afternoon_lesson",
+    "evening": "send_evening_lesson",
+}
+
+# レッスンの選択・整形に使うプロセス数（1なら単一スレッド、0ならCPUコア数）
+# 2以上の場合、ユーザーをハッシュでシャードに分けて multiprocessing で並列に計算する。
+# ワーカーは spawn で起動するため、コマンドライン（plan_deliveries.py）の配信計画作成でだけ使い、
+# アプリのプロセス内のスケジューラーは常に1プロセスで計算する
+LESSON_RENDER_PROCESSES = int(os.getenv('LESSON_RENDER_PROCESSES', 1)) or os.cpu_count() or 1
+
+# 配信枠の長さ（分）。枠の開始時刻に一斉送信せず、ユーザーを枠内に分散して送る
+# （例: 10:00 の枠は 10:00〜10:30 に分散）。0 にすると開始時刻に全員へ送信する
+DELIVERY_WINDOW_MINUTES = int(os.getenv('DELIVERY_WINDOW_MINUTES', 30))
+
+# 配信計画の保持日数
+DELIVERY_PLAN_RETENTION_DAYS = 7
+
+# 配信アウトボックスの1回の取得件数・最大試行回数・再送間隔の基準（秒、試行ごとに2倍）
+OUTBOX_BATCH_SIZE = 1000
+OUTBOX_MAX_ATTEMPTS = 5
+OUTBOX_RETRY_BASE_SECONDS = 30
+OUTBOX_RETENTION_DAYS = 7
+
+# LINE Messaging API のレート制限（リクエスト/秒）
+LINE_PUSH_RATE_LIMIT = 2000
+LINE_MULTICAST_RATE_LIMIT = 200
+
+# 配信エンジンの同時送信数と送信レート（環境変数で調整可能）
+# バースト分を含めても上限を超えないよう、既定のレートは上限の9割にする
+DELIVERY_WORKERS = int(os.getenv('DELIVERY_WORKERS', 32))
+DELIVERY_RATE_PER_SECOND = float(os.getenv('DELIVERY_RATE_PER_SECOND', LINE_PUSH_RATE_LIMIT * 0.9))
+
+
+def delivery_offset_seconds(user_id, slot, window_seconds, window_start=None, preferred_time=None):
+    """配信枠の開始から、そのユーザーに送るまでの秒数
+
+    希望配信時刻があればその時刻（枠の外なら枠の端に寄せる）、
+    なければユーザーIDと配信枠のハッシュで枠内に均等に割り振る（毎日同じ時刻になる）。
+    """
+    if window_seconds <= 0:
+        return 0
+    if preferred_time and window_start is not None:
+        hour, minute = (int(part) for part in preferred_time.split(":"))
+        preferred = window_start.replace(hour=hour, minute=minute, second=0, microsecond=0)
+        return min(max(0, int((preferred - window_start).total_seconds())), window_seconds - 1)
+    digest = hashlib.sha256(f"{user_id}:{slot}".encode()).digest()
+    return int.from_bytes(digest[:8], 'big') % window_seconds
+
+
+class TokenBucket:
+    """トークンバケット方式のレート制限（スレッドセーフ）
+
+    rate トークン/秒で補充し、最大 capacity トークン（既定は0.1秒分）まで貯める。
+    acquire() はトークンが足りるまで待機する。
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(1.0, self.rate / 10))
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        """トークンを取得（足りない場合は補充されるまで待機）"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
+
+    async def acquire_async(self, tokens=1):
+        """イベントループをブロックせずにトークンを取得"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            await asyncio.sleep(wait)
+
+
+def create_delivery_plans(db, learning_manager, user_ids, plan_date, processes=1):
+    """指定日の各配信枠の配信計画を作成して保存し、作成した件数を返す
+
+    計画済みのユーザーは作り直さない。レッスンカーソルは計画の送信時に進めるため、
+    同じ日の後の枠は前の枠の計画のカーソルの続きから選ぶ。
+    processes を2以上にするのはコマンドライン（plan_deliveries.py）からだけにする
+    （LearningContentManager.iter_rendered_lessons を参照）。
+    """
+    planned_count = 0
+    cursors = db.get_all_lesson_cursors()
+    for slot in DELIVERY_SLOTS:
+        existing = db.get_delivery_plans(plan_date, slot)
+        cursors.update(
+            (user_id, plan[3]) for user_id, plan in existing.items() if plan[3] is not None
+        )
+        pending_users = [user_id for user_id in user_ids if user_id not in existing]
+        plans = learning_manager.build_delivery_plans(
+            pending_users, plan_date, slot, processes=processes, cursors=cursors
+        )
+        cursors.update((plan[0], plan[6]) for plan in plans if plan[6] is not None)
+        db.save_delivery_plans(plans)
+        planned_count += len(plans)
+        print(f"   - {slot}: 新規 {len(plans)}件 / 計画済み {len(existing)}件")
+    return planned_count
+
+
+class DeliveryEngine:
+    """ユーザーごとの送信を並列に実行する配信エンジン
+
+    同時送信数を workers で、送信レートをトークンバケットで制限する。
+    deliver() は送信内容を事前に用意した (user_id, [text, ...]) のリストを受け取り、
+    非同期プッシュセッションがあればイベントループ上で、なければワーカースレッドで送信する。
+    """
+
+    def __init__(self, workers=DELIVERY_WORKERS, rate_per_second=DELIVERY_RATE_PER_SECOND,
+                 multicast_rate_per_second=LINE_MULTICAST_RATE_LIMIT * 0.9):
+        self.workers = workers
+        self.limiter = TokenBucket(rate_per_second)
+        self.multicast_limiter = TokenBucket(multicast_rate_per_second)
+        # ワーカースレッドは配信のたびに作らず使い回す（スレッドごとのDB接続も使い回される）
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+    def deliver(self, job_name, items, push_session=None, push_func=None, multicast_func=None, retry_keys=None):
+        """用意済みのメッセージを送信し、ジョブの集計結果を返す
+
+        同じ内容のメッセージは最大500人ずつのマルチキャストにまとめ、
+        成功可否は宛先ユーザーごとに集計する。
+
+        Args:
+            items: (user_id, [text, ...]) のリスト（1ユーザーにつき1プッシュ）
+            push_session: PushSession（Noneの場合は push_func / multicast_func をスレッドで実行）
+            push_func: push_message(user_id, text) 互換の関数
+            multicast_func: multicast_message(user_ids, text) 互換の関数
+            retry_keys: {user_id: 再送キー}（個別プッシュの X-Line-Retry-Key）
+        """
+        if push_session is None:
+            return self._deliver_with_threads(job_name, items, push_func, multicast_func, retry_keys or {})
+
+        self._log_start(job_name, len(items), "非同期")
+        start = time.perf_counter()
+        outcomes = push_session.push_many(
+            items, concurrency=self.workers, limiter=self.limiter,
+            multicast_limiter=self.multicast_limiter, retry_keys=retry_keys
+        )
+        return self._summarize(job_name, outcomes, time.perf_counter() - start)
+
+    def _deliver_with_threads(self, job_name, items, push_func, multicast_func, retry_keys):
+        """同期の送信関数をワーカースレッドで実行"""
+        deliveries = plan_deliveries(items)
+        if multicast_func is None:
+            # マルチキャストできない場合は宛先ごとのプッシュに展開
+            deliveries = [([user_id], texts, False) for user_ids, texts, _ in deliveries for user_id in user_ids]
+        self._log_start(job_name, len(items), "スレッド")
+
+        def send(delivery):
+            user_ids, texts, is_multicast = delivery
+            (self.multicast_limiter if is_multicast else self.limiter).acquire(len(texts))
+            try:
+                if is_multicast:
+                    success = all([multicast_func(user_ids, text) for text in texts])
+                elif user_ids[0] in retry_keys:
+                    retry_key = retry_keys[user_ids[0]]
+                    success = all([
+                        push_func(user_ids[0], text, retry_key=request_retry_key(retry_key, index))
+                        for index, text in enumerate(texts)
+                    ])
+                else:
+                    success = all([push_func(user_ids[0], text) for text in texts])
+            except Exception as e:
+                print(f"❌ [{job_name}] {user_ids[0]} ほか{len(user_ids) - 1}人への送信で予期しないエラー: {type(e).__name__}: {e}")
+                success = False
+            return [(user_id, success) for user_id in user_ids]
+
+        start = time.perf_counter()
+        outcomes = {user_id: success for results in self._get_executor().map(send, deliveries) for user_id, success in results}
+        return self._summarize(job_name, outcomes, time.perf_counter() - start)
+
+    def _get_executor(self):
+        """送信用のワーカースレッドプールを取得（初回のみ作成）"""
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="delivery")
+            return self._executor
+
+    def shutdown(self):
+        """ワーカースレッドを停止（実行中の送信は終わるまで待つ）"""
+        with self._executor_lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    def _log_start(self, job_name, total, mode):
+        print(f"📤 [{job_name}] 配信開始：{total}人 ({mode}, 同時 {self.workers}, 上限 {self.limiter.rate:.0f}件/秒)")
+
+    def _summarize(self, job_name, outcomes, elapsed):
+        """ユーザーごとの成功可否からジョブの集計結果を作成"""
+        sent_count = sum(1 for success in outcomes.values() if success)
+        result = {
+            'job': job_name,
+            'total': len(outcomes),
+            'sent': sent_count,
+            'failed': len(outcomes) - sent_count,
+            'failed_user_ids': [user_id for user_id, success in outcomes.items() if not success],
+            'elapsed_seconds': round(elapsed, 3),
+            'throughput_per_second': round(len(outcomes) / elapsed, 1) if elapsed > 0 else 0.0,
+        }
+        print(f"📊 [{job_name}] 配信完了 - 成功: {result['sent']}人, 失敗: {result['failed']}人, "
+              f"{result['elapsed_seconds']}秒 ({result['throughput_per_second']}件/秒)")
+        return result
+
+
+class LeaderElection:
+    """SQLiteのリース行によるリーダー選出
+
+    複数のワーカープロセスが同じDBを共有していても、スケジュールジョブを実行するのは
+    リースを保持している1プロセスだけにする。ハートビート用のスレッドが
+    ttl_seconds の1/3ごとにリースを延長し、リーダーが落ちた場合は
+    リースの期限切れ後（最大 ttl_seconds 秒）にほかのプロセスが引き継ぐ。
+    """
+
+    def __init__(self, db, name=LEADER_LEASE_NAME, ttl_seconds=LEADER_LEASE_TTL_SECONDS, on_change=None):
+        self.db = db
+        self.name = name
+        self.ttl_seconds = ttl_seconds
+        # リーダーになった・ではなくなったときに呼ぶ関数（スケジューラーループを起こす）
+        self.on_change = on_change
+        self.holder = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.is_leader = False
+        self.stop_event = threading.Event()
+        self.changed = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """ハートビートを開始（初回の取得は呼び出し元で同期的に行う）"""
+        self.heartbeat()
+        if self.thread is None or not self.thread.is_alive():
+            self.stop_event.clear()
+            self.thread = threading.Thread(target=self._run, name="scheduler-leader-heartbeat", daemon=True)
+            self.thread.start()
+
+    def heartbeat(self):
+        """リースの取得・延長を試みてリーダーかどうかを更新"""
+        try:
+            is_leader = self.db.acquire_lease(self.name, self.holder, self.ttl_seconds)
+        except Exception as e:
+            # DBに書けない間はリースを延長できないため、リーダーではないものとして扱う
+            print(f"❌ リーダーリース更新エラー: {e}")
+            is_leader = False
+        changed = is_leader != self.is_leader
+        self.is_leader = is_leader
+        if changed:
+            print(f"👑 スケジューラーのリーダーに{'なりました' if is_leader else 'ではなくなりました'}: {self.holder}")
+            self.changed.set()
+            if self.on_change is not None:
+                self.on_change()
+        return is_leader
+
+    def wait_for_change(self, timeout=None):
+        """リーダーの状態が変わるか notify() されるまで待つ"""
+        self.changed.wait(timeout)
+        self.changed.clear()
+
+    def notify(self):
+        """wait_for_change() 中のスレッドを起こす"""
+        self.changed.set()
+
+    def _run(self):
+        while not self.stop_event.wait(self.ttl_seconds / 3):
+            self.heartbeat()
+
+    def stop(self):
+        """ハートビートを止め、保持しているリースを手放す"""
+        self.stop_event.set()
+        # 終了途中のハートビートスレッドが残っていると、直後の start() で作り直されない
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+        if self.is_leader:
+            try:
+                self.db.release_lease(self.name, self.holder)
+            except Exception as e:
+                print(f"❌ リーダーリース解放エラー: {e}")
+        self.is_leader = False
+
+
 class LearningScheduler:
-    def __init__(self):
-        self.line_bot = LineBotHandler()
-        self.db = LearningDatabase()
-        self.learning_manager = LearningContentManager()
-        self.quiz_manager = QuizManager()
+    def __init__(self, line_bot=None):
+        # アプリ側で作成済みのハンドラーがあれば共有する（起動時の二重初期化を避ける）
+        self.line_bot = line_bot or LineBotHandler()
+        self.db = self.line_bot.db
+        self.learning_manager = self.line_bot.learning_manager
+        self.quiz_manager = self.line_bot.quiz_manager
         self.running = False
+        self.delivery_engine = DeliveryEngine()
+        # スケジューラースレッドで使い回す非同期プッシュセッション（コネクションプールを維持）
+        self.scheduler_thread = None
+        self.push_session = None
+        # 複数プロセスのうちリースを保持する1つだけがジョブを実行する
+        self.leader_election = LeaderElection(self.db, on_change=schedule.wake)
+        # ジョブごとの直近の配信結果（スループット確認用）
+        self.last_delivery_stats = {}
+        # 読み込み済みのジョブ定義とそのリビジョン（管理画面での変更検知用）
+        self.job_definitions = {}
+        self.job_definitions_revision = None
+        # start() / stop() の呼び出しを直列化する（管理画面からの再起動と重ならないように）
+        self._lifecycle_lock = threading.Lock()
         
     def start(self):
-        """スケジューラーを開始"""
+        """スケジューラーを開始（スケジューラーループのスレッドを起動してすぐに戻る）
+
+        停止処理中のループが残っている場合は、その終了を待ってから新しいループを起動する。
+        """
+        with self._lifecycle_lock:
+            thread = self.scheduler_thread
+            if thread is not None and thread.is_alive():
+                if self.running:
+                    print("ℹ️ 学習スケジューラーはすでに動作中です")
+                    return
+                thread.join()
+            
+            # スケジューラーを実行可能に設定
+            self.running = True
+            self.scheduler_thread = threading.Thread(
+                target=self._scheduler_main, name="learning-scheduler", daemon=True
+            )
+            self.scheduler_thread.start()
+        
         print("🚀 学習スケジューラーを開始しました")
         
         # 有料プランにアップグレードしたため、配信を再開
         print("✅ 有料プランにアップグレード完了！配信を再開します")
-        
-        # スケジューラーを実行可能に設定
-        self.running = True
-        
-        # スケジュールジョブの設定
-        self.setup_scheduled_jobs()
-        
+    
+    def _scheduler_main(self):
+        """スケジューラースレッドの本体（ジョブの登録はリクエストのスレッドではなくここで行う）"""
+        try:
+            # スケジュールジョブの設定
+            self.setup_scheduled_jobs()
+            self.log_schedule()
+            # スケジューラーループを開始
+            self.run_scheduler()
+        except Exception as e:
+            print(f"❌ スケジューラーの開始に失敗しました: {e}")
+            self.running = False
+    
+    def log_schedule(self):
+        """登録したスケジュールをログ出力"""
         # スケジュール設定の確認
         print(f"📅 スケジュール設定完了:")
-        print(f"   - 非アクティブユーザー再開促し: 毎週月曜 09:00")
-        print(f"   - 朝の学習メッセージ: 毎日 10:00")
-        print(f"   - 午後の学習メッセージ: 毎日 15:00")
-        print(f"   - 夜の学習メッセージ: 毎日 20:00")
-        print(f"   - 週間クイズ: 日曜 20:00")
-        print(f"   - 週間サマリー: 土曜 21:00")
-        print(f"   - 復習リマインダー: 水曜 19:00")
+        for definition in self.job_definitions.values():
+            day_text = definition['day_of_week'] or "毎日"
+            state_text = "" if definition['enabled'] else "（停止中）"
+            print(f"   - {definition['name']}: {day_text} {definition['at_time']}{state_text}")
+        print(f"   - 配信アウトボックスの再送: 毎分")
         
         # 現在のスケジュールを確認
         print(f"📋 現在のスケジュール:")
@@ -45,35 +428,42 @@ class LearningScheduler:
             print(f"   - {job.job_func.__name__}: {job.next_run}")
     
     def run_scheduler(self):
-        """スケジューラーを実行"""
+        """スケジューラーを実行
+
+        次のジョブの予定時刻まで眠り、時刻になったら起きて実行する。
+        ジョブの登録変更・リーダーの交代・停止のときは早めに起きる。
+        リーダーのプロセスだけがスケジュールジョブとアウトボックスの送信を行い、
+        ほかのプロセスは待機してリーダーのリースが切れたら引き継ぐ。
+        """
         print("🔄 スケジューラーループを開始しました")
-        loop_count = 0
+        self.leader_election.start()
+        was_leader = False
         last_heartbeat = datetime.now()
         
         while self.running:
             try:
-                loop_count += 1
                 current_time = datetime.now()
+                is_leader = self.leader_election.is_leader
+                
+                if is_leader and not was_leader:
+                    self.on_became_leader()
+                    self.log_next_job()
+                was_leader = is_leader
                 
                 # 10分ごとにハートビートログ
-                if (current_time - last_heartbeat).seconds >= 600:
-                    print(f"💓 スケジューラーハートビート: {current_time} (ループ {loop_count})")
+                if (current_time - last_heartbeat).total_seconds() >= SCHEDULER_HEARTBEAT_SECONDS:
+                    role = "リーダー" if is_leader else "待機中"
+                    print(f"💓 スケジューラーハートビート: {current_time} ({role})")
                     last_heartbeat = current_time
                 
-                # 60分ごとに詳細ログ
-                if loop_count % 60 == 0:
-                    print(f"🔄 スケジューラーループ実行中... (ループ {loop_count})")
-                
-                schedule.run_pending()
+                if is_leader and schedule.run_pending():
+                    self.log_next_job()
                 
-                # デバッグ用：現在時刻と次のジョブをログ出力
-                if schedule.jobs:
-                    next_job = min(schedule.jobs, key=lambda x: x.next_run)
-                    print(f"⏰ 現在時刻: {current_time}, 次のジョブ: {next_job.job_func.__name__} at {next_job.next_run}")
+                # 待機中はジョブの時刻では起きず、リーダー交代か停止を待つ
+                if is_leader:
+                    schedule.wait(max_seconds=SCHEDULER_HEARTBEAT_SECONDS)
                 else:
-                    print(f"⚠️ スケジュールされたジョブがありません")
-                
-                time.sleep(60)  # 1分ごとにチェック
+                    self.leader_election.wait_for_change(SCHEDULER_HEARTBEAT_SECONDS)
                 
             except Exception as e:
                 print(f"❌ スケジューラーエラー: {e}")
@@ -81,29 +471,69 @@ class LearningScheduler:
                 # エラーが発生してもスケジューラーを停止させない
                 time.sleep(60)
                 continue
+        
+        # ループ終了時にリースを手放し、スケジューラースレッドのプッシュセッションを閉じる
+        self.leader_election.stop()
+        if self.push_session is not None:
+            self.push_session.close()
+            self.push_session = None
     
-    def stop(self):
-        """スケジューラーを停止"""
-        self.running = False
-        print("⏹️ 学習スケジューラーを停止しました")
+    def log_next_job(self):
+        """次に実行するジョブをログ出力"""
+        if schedule.jobs:
+            next_job = min(schedule.jobs, key=lambda x: x.next_run)
+            print(f"⏰ 次のジョブ: {next_job.job_func.__name__} at {next_job.next_run}")
+        else:
+            print(f"⚠️ スケジュールされたジョブがありません")
+    
+    def on_became_leader(self):
+        """リーダーになったときの処理
+
+        待機中に時刻を過ぎたジョブをまとめて実行しないよう、ジョブを現在時刻から登録し直し、
+        前のリーダーが送信しきれなかったアウトボックスの行を再開する。
+        そのうえで、停止中に過ぎた予定のうち猶予時間内のものを1回だけ実行する。
+        """
+        self.setup_scheduled_jobs()
+        try:
+            self.drain_outbox()
+        except Exception as e:
+            print(f"❌ アウトボックス再開エラー: {e}")
+        self.run_missed_jobs()
+    
+    def stop(self, timeout=SCHEDULER_STOP_TIMEOUT_SECONDS):
+        """スケジューラーを停止（眠っているスケジューラーループを起こし、終了を待つ）
+
+        Returns:
+            ループが timeout 以内に終了したか（実行中のジョブがあれば、その終了後に止まる）
+        """
+        with self._lifecycle_lock:
+            self.running = False
+            schedule.wake()
+            self.leader_election.notify()
+            thread = self.scheduler_thread
+            if thread is not None and thread is not threading.current_thread():
+                thread.join(timeout)
+            stopped = thread is None or not thread.is_alive()
+        print("⏹️ 学習スケジューラーを停止しました" if stopped else "⏳ 実行中のジョブの終了後にスケジューラーを停止します")
+        return stopped
     
     def send_morning_lesson(self):
         """朝の学習メッセージを送信"""
         print(f"🌅 朝の学習メッセージを送信中... ({datetime.now()})")
         print(f"🌅 アクティブユーザー数: {len(self.get_active_users())}")
-        self.send_daily_lesson_to_all_users()
+        return self.send_daily_lesson_to_all_users(slot="morning")
     
     def send_afternoon_lesson(self):
         """午後の学習メッセージを送信"""
         print(f"☀️ 午後の学習メッセージを送信中... ({datetime.now()})")
         print(f"☀️ アクティブユーザー数: {len(self.get_active_users())}")
-        self.send_daily_lesson_to_all_users()
+        return self.send_daily_lesson_to_all_users(slot="afternoon")
     
     def send_evening_lesson(self):
         """夜の学習メッセージを送信"""
         print(f"🌙 夜の学習メッセージを送信中... ({datetime.now()})")
         print(f"🌙 アクティブユーザー数: {len(self.get_active_users())}")
-        self.send_daily_lesson_to_all_users()
+        return self.send_daily_lesson_to_all_users(slot="evening")
     
     def send_weekly_quiz(self):
         """週間クイズを送信"""
@@ -127,8 +557,7 @@ class LearningScheduler:
             inactive_users = self.db.get_inactive_users(days=7)
             print(f"📢 非アクティブユーザー再開促し送信開始 - 対象ユーザー数: {len(inactive_users)}")
             
-            for user_id in inactive_users:
-                message = """
+            message = """
 🤖 プロンプトエンジニアリング学習bot
 
 お久しぶりです！学習はお休みですか？
@@ -148,32 +577,67 @@ class LearningScheduler:
 
 一緒にAI時代の勝者になりましょう！
                 """
-                
-                self.line_bot.send_message(user_id, message)
-                print(f"✅ 非アクティブユーザー再開促し送信完了 - user_id: {user_id}")
-                
+            
+            # 全員に同じ内容のため、マルチキャストでまとめて送信
+            result = self._deliver("inactive_reengagement", [(user_id, [message]) for user_id in inactive_users])
+            print(f"✅ 非アクティブユーザー再開促し送信完了 - 成功: {result['sent']}人, 失敗: {result['failed']}人")
+            return result
+            
         except Exception as e:
             print(f"❌ 非アクティブユーザー再開促し送信エラー: {e}")
 
+    def plan_next_day_deliveries(self, plan_date=None):
+        """翌日分の配信計画を作成（配信時間外に実行）
+
+        各配信枠について、レッスンの選択と整形を済ませた結果を delivery_plan に保存する。
+        配信時はこの計画を読み込んで送信するだけになる（create_delivery_plans を参照）。
+        ユーザー数が多い場合は、このジョブの前に plan_deliveries.py で複数プロセスを使って作成しておける。
+        """
+        try:
+            plan_date = plan_date or (datetime.now() + timedelta(days=1)).date()
+            users = self.get_active_users()
+            print(f"🗓️ 配信計画作成開始: {plan_date} - 対象ユーザー数: {len(users)}")
+            
+            planned_count = create_delivery_plans(self.db, self.learning_manager, users, plan_date)
+            
+            purged = self.db.purge_delivery_plans(plan_date - timedelta(days=DELIVERY_PLAN_RETENTION_DAYS))
+            purged_outbox = self.db.purge_outbox(days=OUTBOX_RETENTION_DAYS)
+            self.db.purge_delivery_ledger(days=OUTBOX_RETENTION_DAYS)
+            print(f"✅ 配信計画作成完了: {planned_count}件作成, 古い計画 {purged}件・古いアウトボックス {purged_outbox}件削除")
+            return planned_count
+        except Exception as e:
+            print(f"❌ 配信計画作成エラー: {e}")
+            import traceback
+            print(f"📝 エラー詳細: {traceback.format_exc()}")
+            return 0
+    
     def setup_scheduled_jobs(self):
-        """スケジュールされたジョブを設定"""
+        """スケジュールされたジョブを設定
+
+        ジョブ定義はデータベース（scheduled_jobs）から読み込む。
+        再起動や定義の変更で再度呼ばれても重複登録しないよう、登録済みのジョブを消してから登録する。
+        """
         try:
-            # 非アクティブユーザー再開促し（毎週月曜日AM9:00）
-            schedule.every().monday.at("09:00").do(self.send_inactive_user_reengagement)
+            schedule.clear(SCHEDULE_TAG)
             
-            # 毎日の学習メッセージ（10時、15時、20時）
-            schedule.every().day.at("10:00").do(self.send_morning_lesson)
-            schedule.every().day.at("15:00").do(self.send_afternoon_lesson)
-            schedule.every().day.at("20:00").do(self.send_evening_lesson)
+            self.db.seed_job_definitions(DEFAULT_JOB_DEFINITIONS)
+            self.job_definitions_revision = self.db.get_job_definitions_revision()
+            self.job_definitions = {definition['name']: definition for definition in self.db.get_job_definitions()}
             
-            # 週間クイズ（日曜20時）
-            schedule.every().sunday.at("20:00").do(self.send_weekly_quiz)
+            for definition in self.job_definitions.values():
+                if not definition['enabled']:
+                    continue
+                if definition['handler'] not in JOB_HANDLERS:
+                    print(f"⚠️ 不明なジョブ処理のため登録しません: {definition['name']} ({definition['handler']})")
+                    continue
+                job = self._job_for(definition['day_of_week'], definition['at_time'])
+                job.tag(SCHEDULE_TAG, definition['name']).do(self._job_runner(definition['name'], definition['handler']))
             
-            # 週間サマリー（土曜21時）
-            schedule.every().saturday.at("21:00").do(self.send_weekly_summary)
+            # アウトボックスの再送（毎分、再送期限が来た行だけを送信）
+            schedule.every().minute.tag(SCHEDULE_TAG).do(self.drain_outbox)
             
-            # 復習メッセージ（水曜19時）
-            schedule.every().wednesday.at("19:00").do(self.send_review_reminder)
+            # 管理画面でのジョブ定義の変更を反映（毎分、リビジョンが変わった場合だけ登録し直す）
+            schedule.every().minute.tag(SCHEDULE_TAG).do(self.sync_job_definitions)
             
             print("✅ スケジュールジョブ設定完了")
             
@@ -182,110 +646,389 @@ class LearningScheduler:
             import traceback
             print(f"📝 エラー詳細: {traceback.format_exc()}")
     
-    def send_daily_lesson_to_all_users(self, intro_message=""):
-        """全ユーザーに毎日の学習メッセージを送信"""
-        users = self.get_active_users()
-        print(f"📤 配信開始：{len(users)}人のユーザーに送信中...")
+    @staticmethod
+    def _job_for(day_of_week, at_time):
+        """曜日（Noneなら毎日）と時刻からジョブを作成（不正な値は ScheduleError）"""
+        job = schedule.every()
+        if day_of_week is None:
+            job = job.day
+        elif day_of_week in schedule.WEEKDAYS:
+            job = getattr(job, day_of_week)
+        else:
+            raise schedule.ScheduleError(f"曜日の指定が正しくありません: {day_of_week}")
+        return job.at(at_time)
+    
+    def _job_runner(self, name, handler):
+        """ジョブ定義を実行し、成功したら開始時刻を記録する関数を作成"""
+        def run():
+            started_at = datetime.now()
+            getattr(self, handler)()
+            self.db.record_job_success(name, started_at)
+            if name in self.job_definitions:
+                self.job_definitions[name]['last_success_at'] = started_at.strftime('%Y-%m-%d %H:%M:%S')
+        run.__name__ = name
+        return run
+    
+    def sync_job_definitions(self):
+        """ジョブ定義のリビジョンが変わっていればジョブを登録し直す"""
+        if self.db.get_job_definitions_revision() != self.job_definitions_revision:
+            print("🔁 ジョブ定義の変更を検知しました。ジョブを登録し直します")
+            self.setup_scheduled_jobs()
+            self.log_next_job()
+    
+    def run_missed_jobs(self, now=None):
+        """停止中に予定時刻を過ぎたジョブを1回だけ実行
 
-        sent_count = 0
-        failed_count = 0
+        前回の成功が直近の予定時刻より前で、予定時刻から JOB_CATCHUP_GRACE_MINUTES 分以内のジョブが対象。
+        一度も成功していないジョブ（新規登録直後など）は対象にしない。
+        アウトボックスはジョブ名と日付で重複を除くため、送信済みの配信が再送されることはない。
 
-        for i, user_id in enumerate(users, 1):
-            try:
-                print(f"📨 ユーザー {i}/{len(users)}: {user_id} に送信中...")
-
-                # イントロメッセージを送信
-                if intro_message:
-                    intro_success = self.line_bot.push_message(user_id, intro_message)
-                    if intro_success:
-                        print(f"✅ イントロメッセージ送信成功: {user_id}")
-                    else:
-                        print(f"❌ イントロメッセージ送信失敗: {user_id}")
-                    time.sleep(1)  # 少し待機
-
-                # 学習コンテンツを送信
-                print(f"📚 学習コンテンツを送信中: {user_id}")
-                success = self.learning_manager.send_daily_lesson(user_id, self.line_bot)
-
-                if success:
-                    print(f"✅ ユーザー {user_id} に学習メッセージを送信しました")
-                    sent_count += 1
-                else:
-                    print(f"❌ ユーザー {user_id} への学習メッセージ送信に失敗しました")
-                    failed_count += 1
+        Returns:
+            実行したジョブの数
+        """
+        now = now or datetime.now()
+        grace = timedelta(minutes=JOB_CATCHUP_GRACE_MINUTES)
+        missed = []
+        for name, definition in self.job_definitions.items():
+            if not definition['last_success_at']:
+                continue
+            last_success = datetime.strptime(definition['last_success_at'], '%Y-%m-%d %H:%M:%S')
+            for job in schedule.get_jobs(name):
+                previous = job.previous_run(now)
+                if previous is None or last_success >= previous:
+                    continue
+                if now - previous > grace:
+                    print(f"⏭️ 猶予時間を過ぎたため実行しません: {name}（予定 {previous}）")
+                    continue
+                missed.append((previous, name, job))
+        
+        for previous, name, job in sorted(missed, key=lambda item: item[0]):
+            print(f"⏪ 停止中に過ぎたジョブを実行します: {name}（予定 {previous}）")
+            job.run(missed_run=previous)
+        return len(missed)
+    
+    def update_job_definition(self, name, handler=None, day_of_week=None, at_time=None, enabled=None):
+        """ジョブ定義を作成・変更（管理画面用）
 
-                time.sleep(0.5)  # レート制限を避けるため少し待機
+        指定しなかった項目は現在の値のまま。day_of_week に "daily" を指定すると毎日になる。
+        リーダーのプロセスでは即座に、ほかのプロセスでは1分以内にリーダーが反映する。
 
-            except Exception as e:
-                print(f"❌ ユーザー {user_id} への送信で予期しないエラー: {e}")
-                print(f"📝 エラータイプ: {type(e).__name__}")
-                import traceback
-                print(f"🔍 エラー詳細: {traceback.format_exc()}")
-                failed_count += 1
+        Raises:
+            ValueError: 処理名・曜日・時刻が正しくない場合
+        """
+        current = next((definition for definition in self.db.get_job_definitions() if definition['name'] == name), None)
+        if current is None and (handler is None or at_time is None):
+            raise ValueError(f"新しいジョブには handler と at を指定してください: {name}")
+        
+        if current is not None:
+            handler = handler or current['handler']
+            at_time = at_time or current['at_time']
+            if day_of_week is None:
+                day_of_week = current['day_of_week']
+            if enabled is None:
+                enabled = current['enabled']
+        if day_of_week == "daily":
+            day_of_week = None
+        enabled = True if enabled is None else enabled
+        
+        if handler not in JOB_HANDLERS:
+            raise ValueError(f"不明なジョブ処理です: {handler}（指定できる処理: {', '.join(JOB_HANDLERS)}）")
+        try:
+            # 登録せずに曜日と時刻の形式だけを確かめる
+            self._job_for(day_of_week, at_time)
+        except schedule.ScheduleError as e:
+            raise ValueError(str(e))
+        
+        self.db.save_job_definition(name, handler, day_of_week, at_time, enabled)
+        if self.leader_election.is_leader:
+            self.sync_job_definitions()
+        return next(definition for definition in self.db.get_job_definitions() if definition['name'] == name)
+    
+    def send_daily_lesson_to_all_users(self, intro_message="", slot=None):
+        """全ユーザーに毎日の学習メッセージを送信
+
+        slotを指定した場合は事前に作成した配信計画を読み込んで送信し、
+        計画のないユーザー（新規登録・計画の無効化など）の分だけその場で選択する。
+        その場で選択する分はこのプロセス内で計算し、
+        できたチャンクから順にアウトボックスへ積んで送信する。
+        """
+        users = self.get_active_users()
+        job_name = f"daily_lesson:{slot}" if slot else "daily_lesson"
+
+        plans = self.db.get_delivery_plans(datetime.now().date(), slot) if slot else {}
+        unplanned_users = [user_id for user_id in users if user_id not in plans]
+        if slot:
+            print(f"🗓️ 配信計画: {len(users) - len(unplanned_users)}件 / 計画なし: {len(unplanned_users)}件")
+
+        # 計画済みのユーザー（整形済みのテキスト）を先に、計画のないユーザーは計算できた分から送る
+        planned = [(user_id,) + plans[user_id] for user_id in users if user_id in plans]
+        rendered_batches = (
+            self.learning_manager.iter_rendered_lessons(unplanned_users)
+            if unplanned_users else []
+        )
+
+        result = None
+        delivered_count = 0
+        for batch in itertools.chain([planned], rendered_batches):
+            if not batch:
                 continue
+            # イントロメッセージは同じプッシュにまとめて送る
+            items = [
+                (user_id, [intro_message, message] if intro_message else [message])
+                for user_id, _, _, message, _ in batch
+            ]
+            lessons = {user_id: (lesson_id, level, cursor) for user_id, lesson_id, level, _, cursor in batch}
+            # 配信枠内に分散して送る（枠の開始時刻までに届く分だけ、ここで送信される）
+            release_times = self.delivery_release_times(list(lessons), slot) if slot else None
+            # 配信記録とレッスンカーソルは送信に成功した時点でアウトボックスの更新と同時に保存される
+            batch_result = self._deliver(job_name, items, lessons=lessons, release_times=release_times)
+            result = self._merge_delivery_results(result, batch_result)
+            delivered_count += len(batch)
 
-        print(f"📊 配信完了 - 成功: {sent_count}人, 失敗: {failed_count}人")
+        if delivered_count < len(users):
+            print(f"❌ レッスンが見つからないユーザー: {len(users) - delivered_count}人")
+        return result or self._empty_delivery_result(job_name)
+    
+    def delivery_release_times(self, user_ids, slot, window_start=None):
+        """配信枠内でユーザーごとに送信を始める時刻を決める
+
+        Returns:
+            {user_id: 送信開始時刻} の辞書（配信枠が0分の場合は空）
+        """
+        window_seconds = DELIVERY_WINDOW_MINUTES * 60
+        if window_seconds <= 0:
+            return {}
+        window_start = window_start or datetime.now().replace(second=0, microsecond=0)
+        preferences = self.db.get_delivery_preferences(slot)
+        return {
+            user_id: window_start + timedelta(seconds=delivery_offset_seconds(
+                user_id, slot, window_seconds, window_start, preferences.get(user_id)
+            ))
+            for user_id in user_ids
+        }
+    
+    def project_delivery_load(self):
+        """配信枠ごとの1分あたりの予定送信数を見積もる（管理画面用）
+
+        現在のアクティブユーザーと希望配信時刻から、各配信ジョブの時刻を枠の開始として計算する。
+
+        Returns:
+            {ジョブ名: {'slot', 'window_start', 'window_minutes', 'users', 'peak_per_minute', 'per_minute'}} の辞書
+            （per_minute は {"HH:MM": 件数}）
+        """
+        users = self.get_active_users()
+        today = datetime.now().date()
+        projections = {}
+        for definition in self.db.get_job_definitions():
+            slot = next((slot for slot, handler in DELIVERY_SLOT_HANDLERS.items() if handler == definition['handler']), None)
+            if slot is None or not definition['enabled']:
+                continue
+            hour, minute = (int(part) for part in definition['at_time'].split(":")[:2])
+            window_start = datetime.combine(today, datetime.min.time()).replace(hour=hour, minute=minute)
+            release_times = self.delivery_release_times(users, slot, window_start)
+            per_minute = {}
+            for user_id in users:
+                key = release_times.get(user_id, window_start).strftime('%H:%M')
+                per_minute[key] = per_minute.get(key, 0) + 1
+            projections[definition['name']] = {
+                'slot': slot,
+                'window_start': definition['at_time'],
+                'window_minutes': DELIVERY_WINDOW_MINUTES,
+                'users': len(users),
+                'peak_per_minute': max(per_minute.values(), default=0),
+                'per_minute': dict(sorted(per_minute.items())),
+            }
+        return projections
     
     def send_quiz_to_all_users(self):
         """全ユーザーに週間クイズを送信"""
         users = self.get_active_users()
         
+        items = []
         for user_id in users:
-            try:
-                success = self.quiz_manager.send_weekly_quiz(user_id, self.line_bot)
-                
-                if success:
-                    print(f"✅ ユーザー {user_id} に週間クイズを送信しました")
-                else:
-                    print(f"❌ ユーザー {user_id} への週間クイズ送信に失敗しました")
-                
-                time.sleep(0.5)
-                
-            except Exception as e:
-                print(f"❌ ユーザー {user_id} へのクイズ送信エラー: {e}")
+            quiz = self.quiz_manager.get_weekly_quiz(user_id)
+            if quiz:
+                items.append((user_id, [self.quiz_manager.format_quiz_message(quiz)]))
+        
+        return self._deliver("weekly_quiz", items)
     
     def send_summary_to_all_users(self):
         """全ユーザーに週間サマリーを送信"""
         users = self.get_active_users()
         
-        for user_id in users:
-            try:
-                summary = self.learning_manager.get_weekly_summary(user_id)
-                success = self.line_bot.push_message(user_id, summary)
-                
-                if success:
-                    print(f"✅ ユーザー {user_id} に週間サマリーを送信しました")
-                else:
-                    print(f"❌ ユーザー {user_id} への週間サマリー送信に失敗しました")
-                
-                time.sleep(0.5)
-                
-            except Exception as e:
-                print(f"❌ ユーザー {user_id} へのサマリー送信エラー: {e}")
+        items = [(user_id, [self.learning_manager.get_weekly_summary(user_id)]) for user_id in users]
+        
+        return self._deliver("weekly_summary", items)
     
     def send_review_reminder_to_all_users(self):
         """全ユーザーに復習リマインダーを送信"""
         users = self.get_active_users()
         
+        items = []
         for user_id in users:
-            try:
-                # 復習が必要かチェック
-                if self.quiz_manager.should_send_review_quiz(user_id):
-                    review_quiz = self.quiz_manager.get_review_quiz(user_id)
-                    if review_quiz:
-                        message = "🔄 復習の時間です！\n\n"
-                        message += self.quiz_manager.format_review_quiz_message(review_quiz)
-                        success = self.line_bot.push_message(user_id, message)
-                        
-                        if success:
-                            print(f"✅ ユーザー {user_id} に復習クイズを送信しました")
-                        else:
-                            print(f"❌ ユーザー {user_id} への復習クイズ送信に失敗しました")
-                
-                time.sleep(0.5)
+            # 復習が必要かチェック
+            if not self.quiz_manager.should_send_review_quiz(user_id):
+                continue
+            review_quiz = self.quiz_manager.get_review_quiz(user_id)
+            if review_quiz:
+                message = "🔄 復習の時間です！\n\n"
+                message += self.quiz_manager.format_review_quiz_message(review_quiz)
+                items.append((user_id, [message]))
+        
+        return self._deliver("review_reminder", items)
+    
+    def _deliver(self, job_name, items, lessons=None, release_times=None):
+        """送信予定をアウトボックスに積んでから送信し、ジョブの結果を返す
+
+        途中でプロセスが再起動しても、未送信の行は再起動後の drain_outbox() で再開される。
+
+        Args:
+            items: (user_id, [text, ...]) のリスト
+            lessons: {user_id: (lesson_id, level, 送信後のカーソル)}。送信成功時に学習履歴とカーソルを保存する
+            release_times: {user_id: 送信開始時刻}。指定したユーザーはその時刻以降の
+                毎分のドレインで送信されるため、戻り値の集計には含まれない
+
+        戻り値の already_queued は、同じ日に同じジョブが実行済みだったため新たに積まなかった件数
+        （手動実行を繰り返した場合など。これらは重複防止のため再送しない）。
+        """
+        lessons = lessons or {}
+        job_id = f"{job_name}:{datetime.now().strftime('%Y-%m-%d')}"
+        entries = []
+        for user_id, texts in items:
+            payload = {'texts': list(texts)}
+            if user_id in lessons:
+                payload['lesson_id'], payload['level'], cursor = lessons[user_id]
+                if cursor:
+                    payload['cursor'] = list(cursor)
+            entries.append((user_id, json.dumps(payload, ensure_ascii=False)))
+        enqueued = self.db.enqueue_outbox(job_id, entries, release_times=release_times)
+        print(f"📥 [{job_id}] アウトボックスに追加: {enqueued}件（既存 {len(entries) - enqueued}件）")
+        if release_times:
+            print(f"⏳ [{job_id}] {DELIVERY_WINDOW_MINUTES}分の配信枠に分散して送信します（最終送信 {max(release_times.values()).strftime('%H:%M')}）")
+        
+        result = self.drain_outbox(job_id).get(job_name, self._empty_delivery_result(job_name))
+        return dict(result, already_queued=len(entries) - enqueued)
+    
+    def drain_outbox(self, job_id=None):
+        """アウトボックスの送信期限が来た行を送信する
+
+        job_idを指定した場合はそのジョブの行だけを送信する。
+        失敗した行は指数バックオフで再送待ちに戻り、毎分のドレインで再送される。
+
+        Returns:
+            {ジョブ名: 集計結果} の辞書
+        """
+        results = {}
+        with self._push_session_scope() as push_session:
+            while True:
+                rows = self.db.claim_outbox(OUTBOX_BATCH_SIZE, job_id=job_id)
+                if not rows:
+                    break
                 
-            except Exception as e:
-                print(f"❌ ユーザー {user_id} への復習リマインダー送信エラー: {e}")
+                # マルチキャストの集計はユーザー単位のため、ジョブごとに送信する
+                rows_by_job = {}
+                for row in rows:
+                    rows_by_job.setdefault(row[1], []).append(row)
+                for row_job_id, job_rows in rows_by_job.items():
+                    job_name = row_job_id.rsplit(':', 1)[0]
+                    result = self._send_outbox_rows(job_name, job_rows, push_session)
+                    results[job_name] = self._merge_delivery_results(results.get(job_name), result)
+        
+        for job_name, result in results.items():
+            result['finished_at'] = datetime.now().isoformat()
+            self.last_delivery_stats[job_name] = result
+        return results
+    
+    def _send_outbox_rows(self, job_name, rows, push_session):
+        """アウトボックスの行を送信し、成功・失敗を記録
+
+        送信直前に配信台帳 (user_id, 枠, 日付) を確認し、別のスケジューラーが
+        送信済みの配信は送らずに duplicate として完了にする。
+        """
+        delivery_date = rows[0][1].rsplit(':', 1)[1]
+        allowed = self.db.claim_delivery_slots(
+            [(user_id, job_name, delivery_date, retry_key) for _, _, user_id, _, _, retry_key in rows]
+        )
+        duplicate_ids = [row[0] for row in rows if row[2] not in allowed]
+        if duplicate_ids:
+            self.db.skip_outbox(duplicate_ids)
+            print(f"⏭️ [{job_name}] 配信台帳で重複と判定した {len(duplicate_ids)}件をスキップしました")
+        rows = [row for row in rows if row[2] in allowed]
+        if not rows:
+            return self._empty_delivery_result(job_name)
+        
+        payloads = {row[2]: json.loads(row[3]) for row in rows}
+        items = [(user_id, payload['texts']) for user_id, payload in payloads.items()]
+        result = self.delivery_engine.deliver(
+            job_name, items, push_session=push_session,
+            push_func=self.line_bot.push_message, multicast_func=self.line_bot.multicast_message,
+            retry_keys={row[2]: row[5] for row in rows}
+        )
+        
+        failed_user_ids = set(result['failed_user_ids'])
+        sent_ids = []
+        lessons_sent = []
+        cursors = []
+        failures = []
+        for outbox_id, _, user_id, _, attempts, _ in rows:
+            if user_id in failed_user_ids:
+                failures.append((outbox_id, attempts, "push failed"))
+                continue
+            sent_ids.append(outbox_id)
+            payload = payloads[user_id]
+            if 'lesson_id' in payload:
+                lessons_sent.append((user_id, payload['lesson_id'], payload['level']))
+            if 'cursor' in payload:
+                cursors.append((user_id,) + tuple(payload['cursor']))
+        self.db.complete_outbox(sent_ids, lessons_sent, cursors)
+        self.db.fail_outbox(failures, OUTBOX_MAX_ATTEMPTS, OUTBOX_RETRY_BASE_SECONDS)
+        if failures:
+            print(f"🔁 [{job_name}] 送信失敗 {len(failures)}件を記録しました（試行回数が上限未満の行は再送待ち）")
+        return result
+    
+    @contextmanager
+    def _push_session_scope(self):
+        """送信に使うプッシュセッションを取得
+
+        スケジューラースレッドではイベントループとプッシュセッションを使い回し、
+        管理画面などほかのスレッドから呼ばれた場合は送信の間だけセッションを作る。
+        """
+        if threading.current_thread() is self.scheduler_thread:
+            if self.push_session is None:
+                self.push_session = self.line_bot.create_push_session()
+            yield self.push_session
+            return
+        push_session = self.line_bot.create_push_session()
+        try:
+            yield push_session
+        finally:
+            if push_session is not None:
+                push_session.close()
+    
+    @staticmethod
+    def _empty_delivery_result(job_name):
+        return {
+            'job': job_name, 'total': 0, 'sent': 0, 'failed': 0, 'failed_user_ids': [],
+            'elapsed_seconds': 0.0, 'throughput_per_second': 0.0,
+            'finished_at': datetime.now().isoformat(),
+        }
+    
+    @staticmethod
+    def _merge_delivery_results(total, result):
+        """バッチごとの集計結果をジョブ全体の結果にまとめる"""
+        if total is None:
+            return result
+        merged = dict(total)
+        for key in ('total', 'sent', 'failed'):
+            merged[key] += result[key]
+        merged['failed_user_ids'] = total['failed_user_ids'] + result['failed_user_ids']
+        if 'already_queued' in total or 'already_queued' in result:
+            merged['already_queued'] = total.get('already_queued', 0) + result.get('already_queued', 0)
+        merged['elapsed_seconds'] = round(total['elapsed_seconds'] + result['elapsed_seconds'], 3)
+        merged['throughput_per_second'] = (
+            round(merged['total'] / merged['elapsed_seconds'], 1) if merged['elapsed_seconds'] > 0 else 0.0
+        )
+        return merged
     
     def get_active_users(self):
         """アクティブユーザーのリストを取得"""
@@ -329,12 +1072,18 @@ class LearningScheduler:
             return False
     
     def get_next_scheduled_tasks(self):
-        """次のスケジュールタスクを取得"""
+        """次のスケジュールタスクと直近の実行記録を取得"""
         next_tasks = []
         for job in schedule.jobs:
+            last = job.history[-1] if job.history else None
             next_tasks.append({
                 'function': job.job_func.__name__,
                 'next_run': job.next_run,
-                'interval': str(job.interval)
+                'interval': str(job.interval),
+                'last_scheduled_at': last['scheduled_at'] if last else None,
+                'last_started_at': last['started_at'] if last else None,
+                'last_delay_seconds': last['delay_seconds'] if last else None,
+                'last_duration_seconds': last['duration_seconds'] if last else None,
+                'last_succeeded': last['succeeded'] if last else None,
             })
         return next_tasks 
\ No newline at end of file
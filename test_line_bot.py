@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+"""
+LINE Botのメッセージ振り分けのテスト（pytest test_line_bot.py で実行）
+"""
+
+from line_bot import LineBotHandler
+
+
+def make_handler():
+    """LINE API・DBに接続しないハンドラー（振り分けの判定だけを使う）"""
+    return LineBotHandler.__new__(LineBotHandler)
+
+
+def test_search_command_with_query():
+    assert LineBotHandler.parse_search_query("検索 トーン") == "トーン"
+    assert LineBotHandler.parse_search_query("検索　出力形式") == "出力形式"
+    assert LineBotHandler.parse_search_query("Search few-shot") == "few-shot"
+
+
+def test_search_command_without_query():
+    assert LineBotHandler.parse_search_query("検索") == ""
+    assert LineBotHandler.parse_search_query("search") == ""
+
+
+def test_question_starting_with_search_word_is_not_a_command():
+    """「検索」で始まる質問は検索コマンドではなくAI質問として扱う"""
+    question = "検索結果がおかしいのはなぜ？"
+    assert LineBotHandler.parse_search_query(question) is None
+    assert make_handler().is_ai_question(question)
+
+
+def test_english_word_starting_with_search_is_not_a_command():
+    assert LineBotHandler.parse_search_query("searching for prompts") is None
+
+
+def test_search_command_is_not_an_ai_question():
+    assert not make_handler().is_ai_question("検索 トーン")
@@ -0,0 +1,219 @@
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+# 通常のイベント（コマンド・クイズ回答）を処理するワーカー数
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', 8))
+
+# OpenAI を呼ぶイベント（AI質問）を処理するワーカー数 = OpenAI への同時リクエスト数の上限
+OPENAI_CONCURRENCY = int(os.getenv('OPENAI_CONCURRENCY', 4))
+
+# 処理待ちにできるイベント数の上限（超えた場合は受け付けずに 503 を返し、LINEの再送に任せる）
+WEBHOOK_MAX_PENDING = int(os.getenv('WEBHOOK_MAX_PENDING', 1000))
+
+# 重複判定に使うWebhookイベントIDの保持期間（秒）と、メモリに保持する件数の上限
+WEBHOOK_DEDUP_TTL_SECONDS = int(os.getenv('WEBHOOK_DEDUP_TTL_SECONDS', 24 * 60 * 60))
+WEBHOOK_DEDUP_MAX_ENTRIES = int(os.getenv('WEBHOOK_DEDUP_MAX_ENTRIES', 10000))
+
+# SQLiteから期限切れのイベントIDを削除する間隔（秒）
+WEBHOOK_DEDUP_PURGE_INTERVAL_SECONDS = 3600
+
+LANE_DEFAULT = "default"
+LANE_AI = "ai"
+
+
+class DispatcherFullError(Exception):
+    """処理待ちのイベントが上限に達している"""
+
+
+class WebhookDispatcher:
+    """Webhookのイベントをワーカースレッドで処理するディスパッチャー
+
+    イベントはキー（ユーザーID）ごとの待ち行列に積み、同じユーザーのイベントは
+    受信順に1件ずつ処理する（別のユーザーのイベントは並行して処理される）。
+    ワーカーは通常用とAI用（OpenAI の同時リクエスト数の上限）に分かれており、
+    AI質問が詰まってもコマンドやクイズ回答の処理は待たされない。
+    """
+
+    def __init__(self, workers=WEBHOOK_WORKERS, ai_workers=OPENAI_CONCURRENCY, max_pending=WEBHOOK_MAX_PENDING):
+        self.worker_counts = {LANE_DEFAULT: workers, LANE_AI: ai_workers}
+        self.max_pending = max_pending
+        self._condition = threading.Condition()
+        # キーごとの処理待ちイベント: {key: deque[(lane, func, args, enqueued_at)]}
+        self._pending = {}
+        # 処理できる状態のキー（先頭イベントのレーンごと）
+        self._ready = {lane: deque() for lane in self.worker_counts}
+        # 処理中のキー（同じキーのイベントを同時に処理しない）
+        self._active = set()
+        self._pending_count = 0
+        self._threads = []
+        self._pid = None
+        self.stats = {'accepted': 0, 'rejected': 0, 'processed': 0, 'failed': 0, 'max_wait_seconds': 0.0}
+
+    def _ensure_started(self):
+        """ワーカースレッドを起動（fork後は作り直す）"""
+        if self._threads and self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._threads = []
+        for lane, count in self.worker_counts.items():
+            for index in range(count):
+                thread = threading.Thread(target=self._run, args=(lane,), name=f"webhook-{lane}-{index}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit_many(self, tasks):
+        """複数のイベントをまとめて処理待ちに積む（全件積めない場合は1件も積まない）
+
+        Args:
+            tasks: (key, lane, func, args) のリスト
+
+        Raises:
+            DispatcherFullError: 処理待ちのイベントが上限を超える場合
+        """
+        with self._condition:
+            self._ensure_started()
+            if self._pending_count + len(tasks) > self.max_pending:
+                self.stats['rejected'] += len(tasks)
+                raise DispatcherFullError(f"処理待ちのイベントが上限（{self.max_pending}件）に達しています")
+            now = time.monotonic()
+            for key, lane, func, args in tasks:
+                self._pending.setdefault(key, deque()).append((lane, func, args, now))
+                self._pending_count += 1
+                self._schedule(key)
+            self.stats['accepted'] += len(tasks)
+            self._condition.notify_all()
+
+    def _schedule(self, key):
+        """処理中でないキーに処理待ちがあれば、先頭イベントのレーンで処理できる状態にする（ロック内で呼ぶ）"""
+        if key in self._active or not self._pending.get(key):
+            return
+        lane = self._pending[key][0][0]
+        if key not in self._ready[lane]:
+            self._ready[lane].append(key)
+
+    def _run(self, lane):
+        ready = self._ready[lane]
+        while True:
+            with self._condition:
+                while not ready:
+                    self._condition.wait()
+                key = ready.popleft()
+                self._active.add(key)
+                _, func, args, enqueued_at = self._pending[key].popleft()
+                self._pending_count -= 1
+                wait_seconds = time.monotonic() - enqueued_at
+                self.stats['max_wait_seconds'] = max(self.stats['max_wait_seconds'], round(wait_seconds, 3))
+
+            succeeded = True
+            try:
+                func(*args)
+            except Exception as e:
+                succeeded = False
+                print(f"❌ Webhookイベント処理エラー: {type(e).__name__}: {e}", flush=True)
+
+            with self._condition:
+                self._active.discard(key)
+                self.stats['processed' if succeeded else 'failed'] += 1
+                if self._pending.get(key):
+                    self._schedule(key)
+                    self._condition.notify_all()
+                else:
+                    self._pending.pop(key, None)
+
+    def get_stats(self):
+        """受付・処理件数と現在の処理待ち件数"""
+        with self._condition:
+            return dict(self.stats, pending=self._pending_count, active=len(self._active))
+
+    def join(self, timeout=None):
+        """処理待ちと処理中のイベントがなくなるまで待つ（テスト・ベンチマーク用）"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._condition:
+                if self._pending_count == 0 and not self._active:
+                    return True
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(0.01)
+
+
+class WebhookEventDeduplicator:
+    """webhookEventId で再送（重複）イベントを除くキャッシュ
+
+    メモリ上の期限付きLRU（件数上限あり）で判定し、メモリにないIDは SQLite の
+    webhook_events に1文で記録して判定する。SQLite に残るため、再起動後や
+    別のプロセスが受け取ったイベントの再送も除ける。
+    """
+
+    def __init__(self, db, ttl_seconds=WEBHOOK_DEDUP_TTL_SECONDS, max_entries=WEBHOOK_DEDUP_MAX_ENTRIES):
+        self.db = db
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # {event_id: 受信時刻（monotonic）}。古い順に並ぶ
+        self._seen = OrderedDict()
+        self._last_purge = time.monotonic()
+        self.stats = {'checked': 0, 'memory_hits': 0, 'db_hits': 0, 'redeliveries': 0}
+
+    def _expire(self, now):
+        """期限切れ・上限超過のIDをメモリから捨てる（ロック内で呼ぶ）"""
+        while self._seen:
+            event_id, seen_at = next(iter(self._seen.items()))
+            if now - seen_at < self.ttl_seconds and len(self._seen) <= self.max_entries:
+                break
+            self._seen.popitem(last=False)
+
+    def filter_new(self, event_ids, redeliveries=0):
+        """初めて受け取ったイベントIDだけを返す
+
+        Args:
+            event_ids: webhookEventId のリスト
+            redeliveries: そのうち deliveryContext.isRedelivery が付いていた件数（統計用）
+
+        Returns:
+            初めて受け取った event_id の集合
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            self.stats['checked'] += len(event_ids)
+            self.stats['redeliveries'] += redeliveries
+            unseen = [event_id for event_id in dict.fromkeys(event_ids) if event_id not in self._seen]
+            self.stats['memory_hits'] += len(event_ids) - len(unseen)
+
+        new_ids = self.db.claim_webhook_events(unseen) if unseen else set()
+
+        with self._lock:
+            self.stats['db_hits'] += len(unseen) - len(new_ids)
+            for event_id in unseen:
+                self._seen[event_id] = now
+                self._seen.move_to_end(event_id)
+            self._expire(now)
+            purge_due = now - self._last_purge >= WEBHOOK_DEDUP_PURGE_INTERVAL_SECONDS
+            if purge_due:
+                self._last_purge = now
+
+        if purge_due:
+            try:
+                self.db.purge_webhook_events(self.ttl_seconds)
+            except Exception as e:
+                print(f"⚠️ Webhookイベント記録の削除エラー: {e}", flush=True)
+        return new_ids
+
+    def forget(self, event_ids):
+        """受け付けられなかったイベントのIDを忘れる（LINEの再送で処理されるようにする）"""
+        with self._lock:
+            for event_id in event_ids:
+                self._seen.pop(event_id, None)
+        self.db.forget_webhook_events(list(event_ids))
+
+    def get_stats(self):
+        """重複判定の件数とヒット率"""
+        with self._lock:
+            stats = dict(self.stats, cached=len(self._seen))
+        duplicates = stats['memory_hits'] + stats['db_hits']
+        stats['duplicates'] = duplicates
+        stats['hit_rate'] = round(duplicates / stats['checked'], 4) if stats['checked'] else 0.0
+        return stats